@@ -27,7 +27,8 @@ from mainloop import MainLoop
 from sockserv import ListenServer
 from jm import JsonMachine, JsonNewMessage, JsonEof
 
-from serialise import serialise_artifact, deserialise_artifact
+from serialise import (serialise_artifact, deserialise_artifact,
+                       encode_artifact_graph, decode_artifact_graph)
 from idgen import IdentifierGenerator
 from route_map import RouteMap
 from timer_event_source import TimerEventSource, Timer
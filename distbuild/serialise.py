@@ -25,6 +25,18 @@ import logging
 def serialise_artifact(artifact):
     '''Serialise an Artifact object and its dependencies into string form.'''
 
+    return json.dumps(yaml.dump(encode_artifact_graph(artifact)))
+
+
+def encode_artifact_graph(artifact):
+    '''Encode an Artifact object and its dependencies as plain data.
+
+    The result is made of dicts, lists, strings and numbers only, and
+    can be turned back into Artifact objects with
+    ``decode_artifact_graph``.
+
+    '''
+
     def encode_morphology(morphology):
         result = {}
         for key in morphology.keys():
@@ -110,7 +122,7 @@ def serialise_artifact(artifact):
             'stratum': morphlib.artifactsplitrule.DEFAULT_STRATUM_RULES,
         },
     }
-    return json.dumps(yaml.dump(content))
+    return content
 
 
 def deserialise_artifact(encoded):
@@ -123,6 +135,12 @@ def deserialise_artifact(encoded):
     
     '''
 
+    return decode_artifact_graph(yaml.load(json.loads(encoded)))
+
+
+def decode_artifact_graph(le_dicts):
+    '''Re-construct the Artifact object from ``encode_artifact_graph``.'''
+
     def decode_morphology(le_dict):
         '''Convert a dict into something that kinda acts like a Morphology.
         
@@ -165,7 +183,6 @@ def deserialise_artifact(encoded):
 
         return artifact
 
-    le_dicts = yaml.load(json.loads(encoded))
     artifacts_dict = le_dicts['artifacts']
     sources_dict = le_dicts['sources']
     morphologies_dict = le_dicts['morphologies']
@@ -54,14 +54,17 @@ import bins
 import buildbranch
 import buildcommand
 import buildenvironment
+import buildgraphcache
 import buildsystem
 import builder
 import cachedrepo
 import cachekeycomputer
+import contentstore
 import extensions
 import extractedtarball
 import fsutils
 import git
+import gitcatfile
 import gitdir
 import gitindex
 import localartifactcache
@@ -78,10 +81,13 @@ import savefile
 import source
 import sourcepool
 import sourceresolver
+import sqlitecache
 import stagingarea
 import stopwatch
 import sysbranchdir
 import systemmetadatadir
+import tarmerger
+import unpackedchunkcache
 import util
 import workspace
 
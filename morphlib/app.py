@@ -18,6 +18,7 @@ import logging
 import os
 import pipes
 import sys
+import threading
 import time
 import urlparse
 import extensions
@@ -46,7 +47,8 @@ defaults = {
             'ssh://git@github.com/%s'),
     ],
     'cachedir': os.path.expanduser('~/.cache/morph'),
-    'max-jobs': morphlib.util.make_concurrency()
+    'max-jobs': morphlib.util.make_concurrency(),
+    'unpack-jobs': morphlib.util.cpu_count(),
 }
 
 
@@ -82,6 +84,11 @@ class Morph(cliapp.Application):
                               'do not update the cached git repositories '
                               'automatically',
                               group=group_advanced)
+        self.settings.boolean(['git-object-pool'],
+                              'keep the objects of cached git repositories '
+                              'in one pool that they share, so related '
+                              'repositories do not each store them',
+                              group=group_advanced)
         self.settings.boolean(['build-log-on-stdout'],
                               'write build log on stdout',
                               group=group_advanced)
@@ -129,11 +136,76 @@ class Morph(cliapp.Application):
                               metavar='N',
                               default=defaults['max-jobs'],
                               group=group_build)
+        self.settings.integer(['local-build-jobs'],
+                              'build up to N sources at once in a local '
+                              'build, each in its own staging area, as '
+                              'soon as their dependencies are cached '
+                              '(default: %default)',
+                              metavar='N',
+                              default=1,
+                              group=group_build)
+        self.settings.integer(['unpack-jobs'],
+                              'download and extract up to N artifacts at '
+                              'once when putting a system together, and '
+                              'extract up to N git submodules at once '
+                              '(default is the number of CPUs in the '
+                              'machine running morph)',
+                              metavar='N',
+                              default=defaults['unpack-jobs'],
+                              group=group_build)
+        self.settings.integer(['resolve-jobs'],
+                              'resolve the refs of, and find morphologies '
+                              'for, up to N chunks at once '
+                              '(default: %default)',
+                              metavar='N',
+                              default=8,
+                              group=group_build)
+        self.settings.integer(['git-update-jobs'],
+                              'clone or update up to N cached git '
+                              'repositories at once, in update-gits '
+                              '(default: %default)',
+                              metavar='N',
+                              default=4,
+                              group=group_build)
         self.settings.boolean(['no-ccache'], 'do not use ccache',
                               group=group_build)
         self.settings.boolean(['no-distcc'],
                               'do not use distcc (default: true)',
                               group=group_build, default=True)
+        self.settings.choice(['staging-area-backend'],
+                             ['hardlink', 'overlayfs'],
+                             'how to install build dependencies into '
+                             'staging areas: hardlink every file of each '
+                             'chunk, or stack the chunks as the layers of '
+                             'an overlay filesystem, falling back to '
+                             'hardlinks if overlayfs cannot be mounted, '
+                             'and for chunks beyond the number of layers '
+                             'it can stack. '
+                             'Overlays do not merge a directory in one '
+                             'chunk with a symlink to a directory in '
+                             'another.',
+                             group=group_build)
+        self.settings.choice(['source-extraction'],
+                             ['copy', 'export'],
+                             'how to put the sources of a chunk into its '
+                             'build directory: copy the cached git '
+                             'repository and check the commit out, or '
+                             'export only the files of the commit with '
+                             'git archive, giving them all the time of the '
+                             'commit as their mtime, along with a .git '
+                             'that hard links to the objects of the cached '
+                             'repository',
+                             group=group_build)
+        self.settings.choice(['system-composition'],
+                             ['unpack', 'merge'],
+                             'how to create system artifacts: unpack every '
+                             'chunk into a root filesystem and then archive '
+                             'it, or merge the chunk artifacts into the '
+                             'system artifact directly, only assembling a '
+                             'root filesystem (out of hardlinks to unpacked '
+                             'chunks, under an overlayfs) when ldconfig or '
+                             'system integration commands need to run',
+                             group=group_build)
         self.settings.boolean(['push-build-branches'],
                               'always push temporary build branches to the '
                               'remote repository',
@@ -182,6 +254,42 @@ class Morph(cliapp.Application):
                                metavar='SIZE',
                                group=group_storage,
                                default='4G')
+        self.settings.bytesize(['chunk-cache-max-size'],
+                               'Keep at most SIZE bytes of unpacked chunks, '
+                               'and the same again of staging area '
+                               'snapshots, in the tempdir for reuse when '
+                               'creating staging areas, removing the least '
+                               'recently used first; 0 means no limit '
+                               '(default: %default)',
+                               metavar='SIZE',
+                               group=group_storage,
+                               default='8G')
+        self.settings.choice(['artifact-compression'],
+                             ['none', 'gzip', 'xz', 'zstd'],
+                             'compress chunk and system artifacts with '
+                             'the given program when creating them; '
+                             'artifacts are decompressed automatically '
+                             'when they are used, whatever this is set '
+                             'to (default: none)',
+                             group=group_storage)
+        self.settings.choice(['artifact-cache-layout'],
+                             ['flat', 'sharded'],
+                             'how to lay out the local artifact cache: '
+                             'keep every file in one directory, or shard '
+                             'them into subdirectories named after the '
+                             'start of their cache keys; files in the '
+                             'other layout are still used, and can be '
+                             'moved with migrate-artifact-cache '
+                             '(default: flat)',
+                             group=group_storage)
+        self.settings.boolean(['deduplicate-chunk-artifacts'],
+                              'store each file in the chunk artifacts of '
+                              'the local artifact cache only once, however '
+                              'many chunk artifacts have it, by keeping '
+                              'them as manifests of a shared, uncompressed '
+                              'store of file contents; chunk artifacts '
+                              'stored either way are used',
+                              group=group_storage)
         # The cachedir default size of 4G comes from twice the size of the
         # largest system artifact.
         # It's twice the size because it needs space for all the chunks that
@@ -205,6 +313,8 @@ class Morph(cliapp.Application):
                 'System time is far in the past, please set your system clock')
 
     def setup(self):
+        self._status_lock = threading.Lock()
+        self._thread_status = threading.local()
         self.status_prefix = ''
 
         self.add_subcommand('help-extensions', self.help_extensions)
@@ -264,6 +374,7 @@ class Morph(cliapp.Application):
         tmpdir = self.settings['tempdir']
         for required_dir in (os.path.join(tmpdir, 'chunks'),
                              os.path.join(tmpdir, 'staging'),
+                             os.path.join(tmpdir, 'staging-snapshots'),
                              os.path.join(tmpdir, 'failed'),
                              os.path.join(tmpdir, 'deployments'),
                              self.settings['cachedir']):
@@ -296,10 +407,30 @@ class Morph(cliapp.Application):
                    morphlib.util.sanitise_morphology_path(args[2]))
             args = args[3:]
 
+    @property
+    def status_prefix(self):
+        '''String prepended to status messages from the current thread.
+
+        Threads other than the main thread start out with the main thread's
+        prefix, and can set their own without changing that of any other
+        thread.
+
+        '''
+
+        return getattr(self._thread_status, 'prefix', self._status_prefix)
+
+    @status_prefix.setter
+    def status_prefix(self, prefix):
+        if isinstance(threading.current_thread(), threading._MainThread):
+            self._status_prefix = prefix
+        else:
+            self._thread_status.prefix = prefix
+
     def _write_status(self, text):
         timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
-        self.output.write('%s %s\n' % (timestamp, text))
-        self.output.flush()
+        with self._status_lock:
+            self.output.write('%s %s\n' % (timestamp, text))
+            self.output.flush()
 
     def status(self, **kwargs):
         '''Show user a status update.
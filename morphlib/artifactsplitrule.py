@@ -16,6 +16,8 @@
 import collections
 import itertools
 import re
+import sre_constants
+import sre_parse
 
 import morphlib
 
@@ -34,6 +36,68 @@ class Rule(object):
     def match(self, *args):
         return True
 
+    def pattern(self):
+        '''Return a regular expression which matches the same as this rule.
+
+        SplitRules combines the patterns of all its rules, so that each
+        file or artifact is only matched once. The pattern is matched
+        against the path of a file, or against the source name and the
+        artifact name joined by a NUL character.
+
+        None is returned if the rule can't be expressed this way, in which
+        case match() is used instead.
+
+        '''
+
+        return ''
+
+
+def _walk_regex(parsed):
+    '''Yield every (opcode, argument) pair in a parsed regular expression.'''
+
+    if isinstance(parsed, sre_parse.SubPattern):
+        for op, av in parsed:
+            yield op, av
+            for item in _walk_regex(av):
+                yield item
+    elif isinstance(parsed, (list, tuple)):
+        for av in parsed:
+            for item in _walk_regex(av):
+                yield item
+
+
+def _combine_regexes(regexes, anchored=True):
+    '''Combine a list of compiled regexes into a single pattern.
+
+    The combined pattern matches whatever any of the regexes would match
+    with re.match(). Regexes which use flags, named groups or references
+    to groups can't be embedded in another pattern without changing what
+    they match, so None is returned for them. If ``anchored`` is False,
+    the pattern will not be matched at the start of the string, so
+    regexes which look at the start of the string can't be combined
+    either.
+
+    '''
+
+    for regex in regexes:
+        if regex.flags or regex.groupindex:
+            return None
+        for op, av in _walk_regex(sre_parse.parse(regex.pattern)):
+            if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+                return None
+            if anchored:
+                continue
+            if op == sre_constants.AT and av in (
+                    sre_constants.AT_BEGINNING,
+                    sre_constants.AT_BEGINNING_STRING):
+                return None
+            if (op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT) and
+                    av[0] < 0):
+                return None
+    if not regexes:
+        return '(?!)'
+    return '|'.join('(?:%s)' % regex.pattern for regex in regexes)
+
 
 class FileMatch(Rule):
     '''Match a file path against a list of regular expressions.
@@ -44,12 +108,14 @@ class FileMatch(Rule):
     '''
 
     def __init__(self, regexes):
-        # Possible optimisation: compile regexes as one pattern
         self._regexes = [re.compile(r) for r in regexes]
 
     def match(self, path):
         return any(r.match(path) for r in self._regexes)
 
+    def pattern(self):
+        return _combine_regexes(self._regexes)
+
     def __repr__(self):
         return 'FileMatch(%s)' % '|'.join(r.pattern for r in self._regexes)
 
@@ -59,12 +125,17 @@ class ArtifactMatch(Rule):
     '''
 
     def __init__(self, regexes):
-        # Possible optimisation: compile regexes as one pattern
         self._regexes = [re.compile(r) for r in regexes]
 
     def match(self, (source_name, artifact_name)):
         return any(r.match(artifact_name) for r in self._regexes)
 
+    def pattern(self):
+        combined = _combine_regexes(self._regexes, anchored=False)
+        if combined is None:
+            return None
+        return r'[^\x00]*\x00(?:%s)' % combined
+
     def __repr__(self):
         return 'ArtifactMatch(%s)' % '|'.join(r.pattern for r in self._regexes)
 
@@ -85,6 +156,9 @@ class ArtifactAssign(Rule):
     def match(self, (source_name, artifact_name)):
         return (source_name, artifact_name) == self._key
 
+    def pattern(self):
+        return r'%s\x00%s\Z' % tuple(re.escape(name) for name in self._key)
+
     def __repr__(self):
         return 'ArtifactAssign(%s, %s)' % self._key
 
@@ -104,6 +178,9 @@ class SourceAssign(Rule):
     def match(self, (source_name, artifact_name)):
         return source_name == self._source
 
+    def pattern(self):
+        return r'%s\x00' % re.escape(self._source)
+
     def __repr__(self):
         return 'SourceAssign(%s, *)' % self._source
 
@@ -119,16 +196,70 @@ class SplitRules(collections.Iterable):
     in order, so more specific matches first can be followed by more
     generic catch-all matches.
 
+    The first time something is matched, the rules are compiled into as
+    few regular expressions as possible, so that all the rules are
+    checked in a single pass.
+
     '''
 
+    # Python 2's re module can't compile a pattern with more than 100
+    # groups, so larger rule sets are split between several patterns.
+    _max_groups = 99
+
     def __init__(self, *args):
         self._rules = list(*args)
+        self._compiled = None
 
     def __iter__(self):
         return iter(self._rules)
 
     def add(self, artifact, rule):
         self._rules.append((artifact, rule))
+        self._compiled = None
+
+    def _compile(self):
+        '''Compile the rules into a list of (regex, groups) pairs.
+
+        Each rule is put in an optional lookahead, so matching the regex
+        always succeeds and captures a group for every rule that matches.
+        ``groups`` lists the artifact name of each rule and the index of
+        its group in the match's groups(), in rule order.
+
+        False is returned if any rule can't be compiled.
+
+        '''
+
+        compiled = []
+        parts = []
+        groups = []
+        group_count = 0
+        for artifact, rule in self._rules:
+            pattern = rule.pattern()
+            if pattern is None:
+                return False
+            size = 1 + re.compile(pattern).groups
+            if size > self._max_groups:
+                return False
+            if group_count + size > self._max_groups:
+                compiled.append((re.compile(''.join(parts)), groups))
+                parts, groups, group_count = [], [], 0
+            parts.append('(?:(?=(%s)))?' % pattern)
+            groups.append((artifact, group_count))
+            group_count += size
+        if parts:
+            compiled.append((re.compile(''.join(parts)), groups))
+        return compiled
+
+    def _match_compiled(self, arg):
+        if isinstance(arg, basestring):
+            subject = arg
+        else:
+            subject = '\x00'.join(arg)
+        matched = []
+        for regex, groups in self._compiled:
+            values = regex.match(subject).groups()
+            matched.extend(a for a, i in groups if values[i] is not None)
+        return matched
 
     @property
     def artifacts(self):
@@ -156,7 +287,11 @@ class SplitRules(collections.Iterable):
 
         '''
 
-        return [a for a, r in self._rules if r.match(*args)]
+        if self._compiled is None:
+            self._compiled = self._compile()
+        if self._compiled is False or len(args) != 1:
+            return [a for a, r in self._rules if r.match(*args)]
+        return self._match_compiled(*args)
 
     def partition(self, iterable):
         '''Match many files or artifacts.
@@ -0,0 +1,273 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import re
+import unittest
+
+import morphlib
+from morphlib.artifactsplitrule import (
+    ArtifactAssign, ArtifactMatch, FileMatch, Rule, SourceAssign, SplitRules)
+
+
+PATHS = [
+    'bin/sh',
+    'usr/bin/gcc',
+    'usr/sbin/init',
+    'lib/libc.so.6',
+    'usr/lib64/libfoo.so',
+    'usr/libexec/helper',
+    'usr/include/stdio.h',
+    'usr/lib/libfoo.a',
+    'usr/lib/pkgconfig/foo.pc',
+    'usr/share/doc/foo/README',
+    'usr/share/man/man1/foo.1',
+    'usr/share/locale/de/foo.mo',
+    'USR/BIN/shout',
+    'etc/foo.conf',
+    '',
+]
+
+
+ARTIFACTS = [
+    ('foo', 'foo-bins'),
+    ('foo', 'foo-devel'),
+    ('foo', 'foo-doc'),
+    ('bar', 'bar-misc'),
+    ('bar', 'bar-special'),
+    ('baz', 'baz'),
+    ('foo-devel', 'foo'),
+]
+
+
+class CombineRegexesTests(unittest.TestCase):
+
+    def combine(self, regexes, anchored=True):
+        return morphlib.artifactsplitrule._combine_regexes(
+            [re.compile(r) for r in regexes], anchored=anchored)
+
+    def test_combines_ordinary_regexes(self):
+        self.assertEqual(self.combine(['a.*', 'b|c']), '(?:a.*)|(?:b|c)')
+
+    def test_combined_empty_list_matches_nothing(self):
+        combined = re.compile(self.combine([]))
+        self.assertEqual(combined.match(''), None)
+        self.assertEqual(combined.match('a'), None)
+
+    def test_does_not_combine_regexes_with_flags(self):
+        self.assertEqual(self.combine(['a', '(?i)b']), None)
+
+    def test_does_not_combine_regexes_with_named_groups(self):
+        self.assertEqual(self.combine(['(?P<name>a)']), None)
+
+    def test_does_not_combine_regexes_with_group_references(self):
+        self.assertEqual(self.combine([r'(a)\1']), None)
+        self.assertEqual(self.combine(['(a)?(?(1)b|c)']), None)
+
+    def test_combines_anchors_if_anchored(self):
+        self.assertEqual(self.combine(['^a', r'\Ab', '(?<=c)d']),
+                         r'(?:^a)|(?:\Ab)|(?:(?<=c)d)')
+
+    def test_does_not_combine_anchors_if_not_anchored(self):
+        for regex in ('^a', r'x|\Ab', '(?<=c)d', '(?<!c)d'):
+            self.assertEqual(self.combine([regex], anchored=False), None)
+
+    def test_combines_lookahead_and_end_anchors_if_not_anchored(self):
+        self.assertEqual(self.combine(['a(?=b)', 'c(?!d)', 'e$'],
+                                      anchored=False),
+                         '(?:a(?=b))|(?:c(?!d))|(?:e$)')
+
+
+class SplitRulesTests(unittest.TestCase):
+
+    def assertMatchesAsRulesDo(self, rules, args, compiled=True):
+        for arg in args:
+            self.assertEqual(rules.match(arg),
+                             [a for a, r in rules if r.match(arg)])
+        if compiled:
+            self.assertNotEqual(rules._compiled, False)
+        else:
+            self.assertEqual(rules._compiled, False)
+
+    def test_matches_files_as_rules_do(self):
+        rules = SplitRules()
+        rules.add('foo-special', FileMatch([r'usr/lib/lib.*\.a']))
+        rules.add('foo-none', FileMatch([]))
+        for suffix, regexes in \
+                morphlib.artifactsplitrule.DEFAULT_CHUNK_RULES:
+            rules.add('foo' + suffix, FileMatch(regexes))
+        self.assertMatchesAsRulesDo(rules, PATHS)
+        self.assertEqual(len(rules._compiled), 1)
+        self.assertEqual(rules.match('usr/lib/libfoo.a'),
+                         ['foo-special', 'foo-devel', 'foo-misc'])
+        self.assertEqual(rules.match('bin/sh'), ['foo-bins', 'foo-misc'])
+
+    def test_matches_artifacts_as_rules_do(self):
+        rules = SplitRules()
+        rules.add('s-special', ArtifactAssign('bar', 'bar-special'))
+        rules.add('s-foo', SourceAssign('foo'))
+        rules.add('s-anchored', ArtifactMatch([r'ba.\Z']))
+        for suffix, regexes in \
+                morphlib.artifactsplitrule.DEFAULT_STRATUM_RULES:
+            rules.add('s' + suffix, ArtifactMatch(regexes))
+        self.assertMatchesAsRulesDo(rules, ARTIFACTS)
+        self.assertEqual(rules.match(('bar', 'bar-special')),
+                         ['s-special', 's-runtime'])
+        self.assertEqual(rules.match(('foo-devel', 'foo')),
+                         ['s-runtime'])
+
+    def test_artifact_match_does_not_look_into_source_name(self):
+        rules = SplitRules([('devel', ArtifactMatch(['.*-devel']))])
+        self.assertMatchesAsRulesDo(rules, [('foo-devel', 'foo'),
+                                            ('foo', 'foo-devel')])
+
+    def test_recompiles_when_a_rule_is_added(self):
+        rules = SplitRules([('bins', FileMatch(['bin/.*']))])
+        self.assertEqual(rules.match('bin/sh'), ['bins'])
+        rules.add('all', FileMatch(['.*']))
+        self.assertEqual(rules.match('bin/sh'), ['bins', 'all'])
+
+    def test_falls_back_to_rules_for_flags(self):
+        rules = SplitRules([('bins', FileMatch(['usr/bin/.*'])),
+                            ('shouty', FileMatch(['(?i)usr/bin/.*']))])
+        self.assertMatchesAsRulesDo(rules, PATHS, compiled=False)
+        self.assertEqual(rules.match('USR/BIN/shout'), ['shouty'])
+
+    def test_falls_back_to_rules_for_named_groups(self):
+        rules = SplitRules([('lib', FileMatch([r'(?P<d>usr/)?lib/.*'])),
+                            ('all', FileMatch(['.*']))])
+        self.assertMatchesAsRulesDo(rules, PATHS, compiled=False)
+
+    def test_falls_back_to_rules_for_group_references(self):
+        rules = SplitRules([('twice', FileMatch([r'(\w+)/\1'])),
+                            ('all', FileMatch(['.*']))])
+        self.assertMatchesAsRulesDo(rules, PATHS + ['usr/usr'],
+                                    compiled=False)
+        self.assertEqual(rules.match('usr/usr'), ['twice', 'all'])
+
+    def test_falls_back_to_rules_for_anchored_artifact_matches(self):
+        rules = SplitRules([('foo', ArtifactMatch(['^foo-.*'])),
+                            ('rest', ArtifactMatch(['.*']))])
+        self.assertMatchesAsRulesDo(rules, ARTIFACTS, compiled=False)
+        self.assertEqual(rules.match(('bar', 'foo-bins')), ['foo', 'rest'])
+
+    def test_falls_back_to_rules_for_rules_without_a_pattern(self):
+        class NoPattern(Rule):
+            def pattern(self):
+                return None
+        rules = SplitRules([('bins', FileMatch(['bin/.*'])),
+                            ('all', NoPattern())])
+        self.assertMatchesAsRulesDo(rules, PATHS, compiled=False)
+
+    def test_splits_rules_with_more_than_99_groups(self):
+        rules = SplitRules(
+            ('a%d' % i, FileMatch([r'(usr/)?lib/(lib)?%d\.so' % i]))
+            for i in xrange(60))
+        paths = ['lib/%d.so' % i for i in xrange(61)]
+        paths.extend('usr/lib/lib%d.so' % i for i in xrange(61))
+        self.assertMatchesAsRulesDo(rules, paths)
+        self.assertEqual(len(rules._compiled), 2)
+        self.assertTrue(all(regex.groups <= 99
+                            for regex, groups in rules._compiled))
+        self.assertEqual(rules.match('lib/59.so'), ['a59'])
+
+    def test_falls_back_to_rules_for_a_rule_with_more_than_99_groups(self):
+        rules = SplitRules([('bins', FileMatch(['bin/.*'])),
+                            ('many', FileMatch(['(a)' * 99]))])
+        self.assertMatchesAsRulesDo(rules, PATHS + ['a' * 99],
+                                    compiled=False)
+        self.assertEqual(rules.match('a' * 99), ['many'])
+
+    def test_matches_everything_with_base_rule(self):
+        rules = SplitRules([('all', Rule())])
+        self.assertMatchesAsRulesDo(rules, PATHS + ARTIFACTS)
+
+    def test_partitions_files(self):
+        rules = SplitRules([('bins', FileMatch(['bin/.*'])),
+                            ('sh', FileMatch(['bin/sh'])),
+                            ('etc', FileMatch(['etc/.*']))])
+        matches, overlaps, unmatched = rules.partition(
+            ['bin/sh', 'bin/ls', 'etc/foo.conf', 'usr/bin/gcc'])
+        self.assertEqual(dict(matches), {'bins': ['bin/sh', 'bin/ls'],
+                                         'etc': ['etc/foo.conf']})
+        self.assertEqual(dict(overlaps), {'bin/sh': set(['bins', 'sh'])})
+        self.assertEqual(unmatched, set(['usr/bin/gcc']))
+
+    def test_lists_artifacts_once_in_order(self):
+        rules = SplitRules([('b', FileMatch(['b'])),
+                            ('a', FileMatch(['a'])),
+                            ('b', FileMatch(['c']))])
+        self.assertEqual(rules.artifacts, ['b', 'a'])
+
+    def test_repr(self):
+        rules = SplitRules([('f', FileMatch(['a', 'b'])),
+                            ('m', ArtifactMatch(['c'])),
+                            ('a', ArtifactAssign('s', 'x')),
+                            ('s', SourceAssign('s'))])
+        self.assertEqual(repr(rules),
+                         'SplitRules(f=FileMatch(a|b), '
+                         'm=ArtifactMatch(c), a=ArtifactAssign(s, x), '
+                         's=SourceAssign(s, *))')
+
+
+class UnifyMatchesTests(unittest.TestCase):
+
+    def test_chunk_products_override_default_rules(self):
+        rules = morphlib.artifactsplitrule.unify_chunk_matches({
+            'name': 'foo',
+            'products': [{'artifact': 'foo-devel',
+                          'include': ['usr/include/.*']},
+                         {'artifact': 'foo-extra',
+                          'include': ['etc/.*']}],
+        })
+        self.assertEqual(rules.artifacts,
+                         ['foo-devel', 'foo-extra', 'foo-bins', 'foo-libs',
+                          'foo-doc', 'foo-locale', 'foo-misc'])
+        self.assertEqual(rules.match('usr/lib/libfoo.a'), ['foo-misc'])
+        self.assertEqual(rules.match('etc/foo.conf'),
+                         ['foo-extra', 'foo-misc'])
+
+    def test_stratum_assignments_come_before_matches(self):
+        rules = morphlib.artifactsplitrule.unify_stratum_matches({
+            'name': 's',
+            'chunks': [{'name': 'foo',
+                        'artifacts': {'foo-devel': 's-runtime'}},
+                       {'name': 'bar'}],
+            'products': [{'artifact': 's-devel',
+                          'include': ['.*-devel']}],
+        })
+        self.assertEqual(rules.artifacts, ['s-runtime', 's-devel'])
+        self.assertEqual(rules.match(('foo', 'foo-devel')),
+                         ['s-runtime', 's-devel', 's-runtime'])
+        self.assertEqual(rules.match(('bar', 'bar-devel')),
+                         ['s-devel', 's-runtime'])
+        self.assertEqual(rules.match(('bar', 'bar-doc')), ['s-runtime'])
+
+    def test_system_assigns_strata_to_rootfs(self):
+        rules = morphlib.artifactsplitrule.unify_system_matches({
+            'name': 'sys',
+            'strata': [{'morph': 'core'},
+                       {'name': 'tools', 'morph': 'tools',
+                        'artifacts': ['tools-runtime']}],
+        })
+        self.assertEqual(rules.match(('core', 'core-devel')),
+                         ['sys-rootfs'])
+        self.assertEqual(rules.match(('tools', 'tools-runtime')),
+                         ['sys-rootfs'])
+        self.assertEqual(rules.match(('tools', 'tools-devel')), [])
+
+    def test_cluster_has_no_rules(self):
+        rules = morphlib.artifactsplitrule.unify_cluster_matches({})
+        self.assertEqual(list(rules), [])
+        self.assertEqual(rules.match('anything'), [])
@@ -21,14 +21,19 @@ Binaries are chunks, strata, and system images.
 
 
 import cliapp
+import contextlib
+import grp
 import logging
 import os
+import pwd
 import sys
 import re
 import errno
 import stat
 import shutil
+import subprocess
 import tarfile
+import threading
 
 import morphlib
 
@@ -78,38 +83,230 @@ if sys.version_info < (2, 7, 3): # pragma: no cover
                 raise ExtractError("could not change owner")
     tarfile.TarFile.chown = fixed_chown
 
-def create_chunk(rootdir, f, include, dump_memory_profile=None):
+# Programs used to compress and decompress artifacts, and the magic
+# bytes at the start of files they have compressed.
+COMPRESSION = {
+    'gzip': ('\x1f\x8b', ['gzip', '-c'], ['gzip', '-d', '-c']),
+    'xz': ('\xfd7zXZ\x00', ['xz', '-c'], ['xz', '-d', '-c']),
+    'zstd': ('\x28\xb5\x2f\xfd', ['zstd', '-q', '-c'],
+             ['zstd', '-q', '-d', '-c']),
+}
+
+
+class CompressionError(cliapp.AppException):
+
+    def __init__(self, argv, reason):
+        cliapp.AppException.__init__(
+            self, 'Command %s failed: %s' % (' '.join(argv), reason))
+
+
+def detect_compression(f):
+    '''Return the compression used for the data in an open file, or None.
+
+    The file position is left unchanged.
+
+    '''
+
+    start = f.tell()
+    magic = f.read(6)
+    f.seek(start)
+    for compression, (prefix, compress, decompress) in COMPRESSION.iteritems():
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def _fileno(f):
+    try:
+        return f.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+
+
+def _copy_in_thread(source, target, close=False):
+    '''Copy from one file to another in a separate thread.
+
+    Returns the thread. If ``close`` is set, ``target`` is closed once
+    everything has been copied.
+
+    '''
+
+    def copy():
+        try:
+            shutil.copyfileobj(source, target)
+        except IOError as e:  # pragma: no cover
+            # The other end has gone away; the process will report why.
+            logging.debug('Copying to compression program failed: %s' % e)
+        finally:
+            if close:
+                target.close()
+
+    thread = threading.Thread(target=copy)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class _CompressionProcess(object):
+
+    '''Run data through a compression program as a file object.
+
+    The program runs as a separate process, so that compressing or
+    decompressing happens at the same time as producing or consuming the
+    data. Data is passed directly between the program and ``f`` if it is
+    a real file, or copied by a thread otherwise.
+
+    '''
+
+    def __init__(self, argv, f, writing):
+        self._argv = argv
+        self._thread = None
+        fd = _fileno(f)
+        if writing:
+            f.flush()
+            stdin = subprocess.PIPE
+            stdout = f if fd is not None else subprocess.PIPE
+        else:
+            if fd is not None:
+                # The file object may have read ahead of its position.
+                os.lseek(fd, f.tell(), os.SEEK_SET)
+            stdin = f if fd is not None else subprocess.PIPE
+            stdout = subprocess.PIPE
+        try:
+            self._process = subprocess.Popen(argv, stdin=stdin, stdout=stdout,
+                                             close_fds=True)
+        except OSError as e:
+            raise CompressionError(argv, e.strerror)
+        if fd is None and writing:
+            self._thread = _copy_in_thread(self._process.stdout, f)
+        elif fd is None:
+            self._thread = _copy_in_thread(f, self._process.stdin,
+                                           close=True)
+        self._file = self._process.stdin if writing else self._process.stdout
+
+    def write(self, data):
+        self._file.write(data)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def close(self):
+        '''Wait for the program to finish, and check it succeeded.'''
+
+        if self._file is self._process.stdout:
+            # Tar files can end with padding that the reader doesn't need;
+            # read it anyway so the program doesn't fail writing it.
+            data = self._file.read(16384)
+            while data:
+                data = self._file.read(16384)
+        self._file.close()
+        returncode = self._process.wait()
+        if self._thread is not None:
+            self._thread.join()
+        if returncode != 0:
+            raise CompressionError(self._argv,
+                                   'exit status %d' % returncode)
+
+    def abort(self):
+        '''Stop the program without checking whether it succeeded.'''
+
+        self._file.close()
+        if self._process.poll() is None:
+            self._process.terminate()
+        self._process.wait()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def create_tar(f, compression=None):
+    '''Open a tar file for writing to an open file handle.
+
+    If ``compression`` is the name of one of the programs in COMPRESSION,
+    the tar file is compressed with it. Returns the TarFile and the
+    compression process, which must be closed after the TarFile, or
+    None.
+
+    '''
+
+    if compression is None:
+        return tarfile.open(fileobj=f, mode='w'), None
+    compressor = _CompressionProcess(COMPRESSION[compression][1], f, True)
+    return tarfile.open(fileobj=compressor, mode='w|'), compressor
+
+
+@contextlib.contextmanager
+def open_tar(f, errorlevel=1):
+    '''Open a tar file for reading, decompressing it if necessary.
+
+    Artifacts compressed with any of the programs in COMPRESSION are
+    recognised by their first few bytes, so uncompressed artifacts can
+    still be read.
+
+    '''
+
+    compression = detect_compression(f)
+    if compression is None:
+        tf = tarfile.open(fileobj=f, errorlevel=errorlevel)
+        try:
+            yield tf
+        finally:
+            tf.close()
+        return
+
+    decompressor = _CompressionProcess(COMPRESSION[compression][2], f, False)
+    try:
+        tf = tarfile.open(fileobj=decompressor, mode='r|',
+                          errorlevel=errorlevel)
+        yield tf
+        tf.close()
+    except BaseException:
+        decompressor.abort()
+        raise
+    decompressor.close()
+
+
+# This timestamp is used to normalize the mtime for every file in
+# chunk artifact. This is useful to avoid problems from smallish
+# clock skew. It needs to be recent enough, however, that GNU tar
+# does not complain about an implausibly old timestamp.
+NORMALIZED_TIMESTAMP = 683074800
+
+
+def create_chunk(rootdir, f, include, dump_memory_profile=None,
+                 compression=None):
     '''Create a chunk from the contents of a directory.
     
-    ``f`` is an open file handle, to which the tar file is written.
+    ``f`` is an open file handle, to which the tar file is written,
+    compressed with ``compression`` if it is set.
 
     '''
 
     dump_memory_profile = dump_memory_profile or (lambda msg: None)
 
-    # This timestamp is used to normalize the mtime for every file in
-    # chunk artifact. This is useful to avoid problems from smallish
-    # clock skew. It needs to be recent enough, however, that GNU tar
-    # does not complain about an implausibly old timestamp.
-    normalized_timestamp = 683074800
-
     dump_memory_profile('at beginning of create_chunk')
     
     path_pairs = [(relname, os.path.join(rootdir, relname))
                   for relname in include]
-    tar = tarfile.open(fileobj=f, mode='w')
-    for relname, filename in path_pairs:
-        # Normalize mtime for everything.
-        tarinfo = tar.gettarinfo(filename,
-                                 arcname=relname)
-        tarinfo.ctime = normalized_timestamp
-        tarinfo.mtime = normalized_timestamp
-        if tarinfo.isreg():
-            with open(filename, 'rb') as f:
-                tar.addfile(tarinfo, fileobj=f)
-        else:
-            tar.addfile(tarinfo)
-    tar.close()
+    tar, compressor = create_tar(f, compression)
+    try:
+        for relname, filename in path_pairs:
+            # Normalize mtime for everything.
+            tarinfo = tar.gettarinfo(filename,
+                                     arcname=relname)
+            tarinfo.ctime = NORMALIZED_TIMESTAMP
+            tarinfo.mtime = NORMALIZED_TIMESTAMP
+            if tarinfo.isreg():
+                with open(filename, 'rb') as f:
+                    tar.addfile(tarinfo, fileobj=f)
+            else:
+                tar.addfile(tarinfo)
+        tar.close()
+    except BaseException:
+        if compressor is not None:
+            compressor.abort()
+        raise
+    if compressor is not None:
+        compressor.close()
 
     for relname, filename in reversed(path_pairs):
         if os.path.isdir(filename) and not os.path.islink(filename):
@@ -119,13 +316,223 @@ def create_chunk(rootdir, f, include, dump_memory_profile=None):
     dump_memory_profile('after removing in create_chunks')
 
 
+class ChunkWriter(object):
+
+    '''Create several chunks from the contents of a directory at once.
+
+    ``outputs`` maps the name of each chunk to an open file handle, to
+    which its tar file is written. Files are written to every chunk as
+    they are found, so the directory only needs to be walked once, and
+    each file is removed as soon as it has been written to its chunk.
+    Directories are left in place, so that they can be added to every
+    chunk which has files in them.
+
+    If ``compression`` is set, every chunk is compressed with it, each by
+    its own process.
+
+    '''
+
+    def __init__(self, rootdir, outputs, compression=None):
+        self.rootdir = rootdir
+        self.contents = dict((name, set()) for name in outputs)
+        self._tars = {}
+        self._compressors = []
+        try:
+            for name, f in outputs.iteritems():
+                self._tars[name], compressor = create_tar(f, compression)
+                if compressor is not None:
+                    self._compressors.append(compressor)
+        except BaseException:
+            self.abort()
+            raise
+        self._dirs = {}
+        self._links = {}
+        self._unames = {}
+        self._gnames = {}
+
+    def _lookup(self, cache, lookup, key):
+        if key not in cache:
+            try:
+                cache[key] = lookup(key)[0]
+            except KeyError:
+                cache[key] = ''
+        return cache[key]
+
+    def _tarinfo(self, tar, relname, filename, st):
+        '''Create a TarInfo from an lstat result, like tar.gettarinfo.
+
+        Returns None for files which can't be put in a tar file.
+
+        '''
+
+        tarinfo = tar.tarinfo()
+        tarinfo.name = relname
+        mode = st.st_mode
+        if stat.S_ISREG(mode):
+            inode = (st.st_ino, st.st_dev)
+            if inode in tar.inodes:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = tar.inodes[inode]
+            else:
+                tarinfo.type = tarfile.REGTYPE
+                tarinfo.size = st.st_size
+                if st.st_nlink > 1 and inode not in self._links:
+                    self._links[inode] = st.st_nlink
+                if inode in self._links:
+                    tar.inodes[inode] = relname
+        elif stat.S_ISDIR(mode):
+            tarinfo.type = tarfile.DIRTYPE
+        elif stat.S_ISFIFO(mode):
+            tarinfo.type = tarfile.FIFOTYPE
+        elif stat.S_ISLNK(mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = os.readlink(filename)
+        # Only root can create device nodes, so tests can't.
+        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):  # pragma: no cover
+            if stat.S_ISCHR(mode):
+                tarinfo.type = tarfile.CHRTYPE
+            else:
+                tarinfo.type = tarfile.BLKTYPE
+            tarinfo.devmajor = os.major(st.st_rdev)
+            tarinfo.devminor = os.minor(st.st_rdev)
+        else:
+            return None
+        tarinfo.mode = mode
+        tarinfo.uid = st.st_uid
+        tarinfo.gid = st.st_gid
+        tarinfo.uname = self._lookup(self._unames, pwd.getpwuid, st.st_uid)
+        tarinfo.gname = self._lookup(self._gnames, grp.getgrgid, st.st_gid)
+        tarinfo.mtime = NORMALIZED_TIMESTAMP
+        return tarinfo
+
+    def add(self, name, relname, st=None):
+        '''Add a file to a chunk, along with the directories above it.
+
+        ``relname`` is relative to the root directory. ``st`` is the
+        result of lstat on the file, if the caller already has it.
+
+        '''
+
+        contents = self.contents[name]
+        if relname in contents:
+            return
+        parent = os.path.dirname(relname)
+        if parent:
+            self.add(name, parent)
+
+        filename = os.path.join(self.rootdir, relname)
+        if st is None:
+            st = self._dirs.get(relname) or os.lstat(filename)
+        tar = self._tars[name]
+        tarinfo = self._tarinfo(tar, relname, filename, st)
+        if tarinfo is None:
+            logging.warning('Cannot add %s to chunk %s' % (relname, name))
+            return
+        if tarinfo.isreg():
+            with open(filename, 'rb') as f:
+                tar.addfile(tarinfo, fileobj=f)
+        else:
+            tar.addfile(tarinfo)
+        contents.add(relname)
+        if not stat.S_ISDIR(st.st_mode):
+            os.remove(filename)
+            self._unlinked(st)
+
+    def _unlinked(self, st):
+        # Files are removed as they are written, so the link count of a
+        # hardlinked file can't be used to tell whether its other names
+        # have been written yet. Count them ourselves instead, and forget
+        # about the inode once all of them are gone, as it may be reused.
+        inode = (st.st_ino, st.st_dev)
+        if inode not in self._links:
+            return
+        self._links[inode] -= 1
+        if self._links[inode] == 0:
+            del self._links[inode]
+            for tar in self._tars.itervalues():
+                tar.inodes.pop(inode, None)
+
+    def add_tree(self, classify):
+        '''Add everything in the root directory to the chunks.
+
+        ``classify`` is called with the relative path of each file and
+        directory, and returns the name of the chunk it belongs in, or
+        None if it should not be put in any chunk. Files which are not
+        put in any chunk are left in place, and a list of them is
+        returned.
+
+        '''
+
+        unmatched = []
+
+        def add(relname, st):
+            name = classify(relname)
+            if name is not None:
+                self.add(name, relname, st)
+            elif not stat.S_ISDIR(st.st_mode):
+                unmatched.append(relname)
+
+        def walk(reldir):
+            dirname = os.path.join(self.rootdir, reldir)
+            for basename in sorted(os.listdir(dirname)):
+                if reldir == '.':
+                    relname = basename
+                else:
+                    relname = reldir + '/' + basename
+                st = os.lstat(os.path.join(dirname, basename))
+                if stat.S_ISDIR(st.st_mode):
+                    self._dirs[relname] = st
+                    add(relname, st)
+                    walk(relname)
+                else:
+                    add(relname, st)
+
+        st = os.lstat(self.rootdir)
+        self._dirs['.'] = st
+        add('.', st)
+        walk('.')
+        return unmatched
+
+    def close(self):
+        '''Finish writing the chunks.
+
+        The file handles passed to the constructor are not closed.
+
+        '''
+
+        for tar in self._tars.itervalues():
+            tar.close()
+        for compressor in self._compressors:
+            compressor.close()
+
+    def abort(self):
+        '''Stop writing the chunks, which are left incomplete.'''
+
+        for compressor in self._compressors:
+            compressor.abort()
+
+
 def unpack_binary_from_file(f, dirname):  # pragma: no cover
     '''Unpack a binary into a directory.
 
-    The directory must exist already.
+    The directory must exist already. The binary may be compressed with
+    any of the programs in COMPRESSION. A file with an ``unpack`` method,
+    such as a morphlib.contentstore.RehydratedFile, unpacks itself.
 
     '''
 
+    unpack = getattr(f, 'unpack', None)
+    if unpack is not None:
+        unpack(dirname)
+        return
+
+    with open_tar(f, errorlevel=2) as tf:
+        extract_tar(tf, dirname)
+
+
+def extract_tar(tf, dirname):  # pragma: no cover
+    '''Extract everything in an open TarFile into a directory.'''
+
     # This is evil, but necessary. For some reason Python's system
     # call wrappers (os.mknod and such) do not (always?) set the
     # filename attribute of the OSError exception they raise. We
@@ -195,7 +602,6 @@ def unpack_binary_from_file(f, dirname):  # pragma: no cover
                 return ret
         return make_something
 
-    tf = tarfile.open(fileobj=f, errorlevel=2)
     tf.makedir = monkey_patcher(tf.makedir)
     tf.makefile = monkey_patcher(tf.makefile)
     tf.makeunknown = monkey_patcher(tf.makeunknown)
@@ -203,10 +609,7 @@ def unpack_binary_from_file(f, dirname):  # pragma: no cover
     tf.makedev = monkey_patcher(tf.makedev)
     tf.makelink = monkey_patcher(tf.makelink)
 
-    try:
-        tf.extractall(path=dirname)
-    finally:
-        tf.close()
+    tf.extractall(path=dirname)
 
 
 def unpack_binary(filename, dirname):
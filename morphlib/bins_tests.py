@@ -15,7 +15,9 @@
 
 import gzip
 import os
+import pwd
 import shutil
+import socket
 import stat
 import tempfile
 import tarfile
@@ -23,6 +25,7 @@ import unittest
 import StringIO
 
 import morphlib
+import morphlib.gitdir_tests
 
 
 class BinsTest(unittest.TestCase):
@@ -140,6 +143,227 @@ class ChunkTests(BinsTest):
         self.assertRaises(IOError, f.read)
         f.close()
 
+    def test_detects_uncompressed_artifact(self):
+        self.create_chunk(['bin'])
+        with open(self.chunk_file, 'rb') as f:
+            self.assertEqual(morphlib.bins.detect_compression(f), None)
+
+    def test_creates_and_unpacks_compressed_chunk(self):
+        self.populate_instdir()
+        morphlib.bins.create_chunk(self.instdir, self.chunk_f,
+                                   ['bin', 'bin/foo', 'lib', 'lib/libfoo.so'],
+                                   compression='gzip')
+        self.chunk_f.close()
+        with open(self.chunk_file, 'rb') as f:
+            self.assertEqual(morphlib.bins.detect_compression(f), 'gzip')
+        self.unpack_chunk()
+        self.assertEqual(self.instdir_orig_files,
+                         self.recursive_lstat(self.unpacked))
+
+    def test_compresses_to_and_from_file_objects_without_fileno(self):
+        self.populate_instdir()
+        f = StringIO.StringIO()
+        morphlib.bins.create_chunk(self.instdir, f, ['bin', 'bin/foo'],
+                                   compression='xz')
+        f.seek(0)
+        self.assertEqual(morphlib.bins.detect_compression(f), 'xz')
+        os.mkdir(self.unpacked)
+        morphlib.bins.unpack_binary_from_file(f, self.unpacked)
+        self.assertEqual([x for x, y in self.recursive_lstat(self.unpacked)],
+                         ['.', 'bin', 'bin/foo'])
+
+    def compression_program(self, compress, decompress=None):
+        magic, old_compress, old_decompress = \
+            morphlib.bins.COMPRESSION['gzip']
+        return morphlib.gitdir_tests.monkeypatch(
+            morphlib.bins, 'COMPRESSION',
+            dict(morphlib.bins.COMPRESSION,
+                 gzip=(magic, compress, decompress or old_decompress)))
+
+    def test_reports_missing_compression_program(self):
+        self.populate_instdir()
+        with self.compression_program(['no-such-compression-program']):
+            self.assertRaises(morphlib.bins.CompressionError,
+                              morphlib.bins.create_chunk, self.instdir,
+                              self.chunk_f, ['bin'], compression='gzip')
+
+    def test_reports_failing_compression_program(self):
+        self.populate_instdir()
+        with self.compression_program(['sh', '-c', 'cat >/dev/null; '
+                                       'exit 3']):
+            self.assertRaises(morphlib.bins.CompressionError,
+                              morphlib.bins.create_chunk, self.instdir,
+                              self.chunk_f, ['bin'], compression='gzip')
+
+    def test_stops_compressing_if_chunk_cannot_be_written(self):
+        self.populate_instdir()
+        self.assertRaises(OSError, morphlib.bins.create_chunk, self.instdir,
+                          self.chunk_f, ['bin', 'missing'],
+                          compression='gzip')
+        self.assertTrue(os.path.exists(os.path.join(self.instdir, 'bin')))
+
+    def test_stops_decompressing_what_is_not_a_tar_file(self):
+        f = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=f, mode='w') as gz:
+            gz.write('not a tar file' * 100000)
+        f.seek(0)
+        def read():
+            with morphlib.bins.open_tar(f) as tf:
+                tf.getnames()
+        self.assertRaises(tarfile.ReadError, read)
+
+    def test_reads_padding_after_compressed_tar_file(self):
+        tar = StringIO.StringIO()
+        tf = tarfile.open(fileobj=tar, mode='w')
+        tf.addfile(tarfile.TarInfo('foo'))
+        tf.close()
+        f = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=f, mode='w') as gz:
+            gz.write(tar.getvalue() + '\0' * 100000)
+        f.seek(0)
+        with morphlib.bins.open_tar(f) as tf:
+            self.assertEqual(tf.getnames(), ['foo'])
+
+
+class ChunkWriterTests(BinsTest):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.instdir = os.path.join(self.tempdir, 'inst')
+        os.makedirs(os.path.join(self.instdir, 'bin'))
+        os.makedirs(os.path.join(self.instdir, 'lib'))
+        for name in ('bin/foo', 'lib/libfoo.so', 'README'):
+            with open(os.path.join(self.instdir, name), 'w') as f:
+                f.write(name)
+        os.link(os.path.join(self.instdir, 'bin/foo'),
+                os.path.join(self.instdir, 'bin/bar'))
+        self.outputs = {
+            'bins': StringIO.StringIO(),
+            'libs': StringIO.StringIO(),
+        }
+        self.writer = morphlib.bins.ChunkWriter(self.instdir, self.outputs)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def classify(self, relname):
+        if relname.startswith('bin/'):
+            return 'bins'
+        elif relname.startswith('lib/'):
+            return 'libs'
+
+    def members(self, name):
+        self.writer.close()
+        f = self.outputs[name]
+        f.seek(0)
+        tf = tarfile.open(fileobj=f)
+        return dict((m.name, m) for m in tf.getmembers())
+
+    def test_writes_files_to_their_chunks_with_parents(self):
+        self.writer.add_tree(self.classify)
+        self.assertEqual(sorted(self.members('bins')),
+                         ['bin', 'bin/bar', 'bin/foo'])
+        self.assertEqual(sorted(self.members('libs')),
+                         ['lib', 'lib/libfoo.so'])
+
+    def test_records_contents(self):
+        self.writer.add_tree(self.classify)
+        self.assertEqual(self.writer.contents['libs'],
+                         set(['lib', 'lib/libfoo.so']))
+
+    def test_stores_hardlinks_once(self):
+        self.writer.add_tree(self.classify)
+        members = self.members('bins')
+        self.assertTrue(members['bin/bar'].isreg())
+        self.assertTrue(members['bin/foo'].islnk())
+        self.assertEqual(members['bin/foo'].linkname, 'bin/bar')
+
+    def test_normalizes_mtime(self):
+        self.writer.add_tree(self.classify)
+        for member in self.members('bins').itervalues():
+            self.assertEqual(member.mtime, morphlib.bins.NORMALIZED_TIMESTAMP)
+
+    def test_removes_written_files_and_returns_unmatched_ones(self):
+        unmatched = self.writer.add_tree(self.classify)
+        self.assertEqual(unmatched, ['README'])
+        self.assertEqual([x for x, y in self.recursive_lstat(self.instdir)],
+                         ['.', 'README', 'bin', 'lib'])
+
+    def test_compresses_chunks(self):
+        outputs = dict((name, StringIO.StringIO()) for name in self.outputs)
+        writer = morphlib.bins.ChunkWriter(self.instdir, outputs,
+                                           compression='gzip')
+        writer.add_tree(self.classify)
+        writer.close()
+        f = outputs['libs']
+        f.seek(0)
+        self.assertEqual(morphlib.bins.detect_compression(f), 'gzip')
+        with morphlib.bins.open_tar(f) as tf:
+            self.assertEqual(tf.getnames(), ['lib', 'lib/libfoo.so'])
+
+    def test_adds_single_file(self):
+        self.writer.add('libs', 'README')
+        self.assertEqual(sorted(self.members('libs')), ['README'])
+        self.assertFalse(os.path.exists(os.path.join(self.instdir, 'README')))
+
+
+    def test_writes_fifos_and_symlinks(self):
+        os.mkfifo(os.path.join(self.instdir, 'bin', 'fifo'))
+        os.symlink('foo', os.path.join(self.instdir, 'bin', 'link'))
+        self.writer.add_tree(self.classify)
+        members = self.members('bins')
+        self.assertTrue(members['bin/fifo'].isfifo())
+        self.assertEqual(members['bin/link'].linkname, 'foo')
+
+    def test_leaves_out_files_tar_cannot_hold(self):
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            sock.bind(os.path.join(self.instdir, 'bin', 'socket'))
+            self.writer.add_tree(self.classify)
+        finally:
+            sock.close()
+        self.assertEqual(sorted(self.members('bins')),
+                         ['bin', 'bin/bar', 'bin/foo'])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.instdir, 'bin', 'socket')))
+
+    def test_leaves_names_of_unknown_owners_empty(self):
+        def getpwuid(uid):
+            raise KeyError(uid)
+        with morphlib.gitdir_tests.monkeypatch(pwd, 'getpwuid', getpwuid):
+            self.writer.add_tree(self.classify)
+        for member in self.members('bins').itervalues():
+            self.assertEqual(member.uname, '')
+
+    def test_leaves_unwritten_files_in_place_if_writing_fails(self):
+        class FailingFile(StringIO.StringIO):
+            def write(self, data):
+                raise IOError('disk full')
+        outputs = {'bins': FailingFile(), 'libs': StringIO.StringIO()}
+        writer = morphlib.bins.ChunkWriter(self.instdir, outputs)
+        self.assertRaises(IOError, writer.add_tree, self.classify)
+        writer.abort()
+        self.assertEqual([x for x, y in self.recursive_lstat(self.instdir)],
+                         ['.', 'README', 'bin', 'bin/bar', 'bin/foo', 'lib',
+                          'lib/libfoo.so'])
+
+    def test_stops_compressors_if_one_cannot_be_started(self):
+        started = []
+        create_tar = morphlib.bins.create_tar
+        def fail_second_time(f, compression=None):
+            if started:
+                raise morphlib.bins.CompressionError(['gzip'], 'failed')
+            tar, compressor = create_tar(f, compression)
+            started.append(compressor)
+            return tar, compressor
+        with morphlib.gitdir_tests.monkeypatch(morphlib.bins, 'create_tar',
+                                               fail_second_time):
+            self.assertRaises(morphlib.bins.CompressionError,
+                              morphlib.bins.ChunkWriter, self.instdir,
+                              self.outputs, compression='gzip')
+        compressor, = started
+        self.assertNotEqual(compressor._process.returncode, None)
+
 
 class ExtractTests(unittest.TestCase):
 
@@ -13,11 +13,14 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import hashlib
 import itertools
 import os
 import shutil
+import sys
 import logging
 import tempfile
+import threading
 import datetime
 
 import morphlib
@@ -49,6 +52,10 @@ class BuildCommand(object):
         self.lac, self.rac = self.new_artifact_caches()
         self.lrc, self.rrc = self.new_repo_caches()
 
+        # Serialises updates of the git and artifact caches when several
+        # sources are being built at once.
+        self.fetch_lock = threading.Lock()
+
     def build(self, repo_name, ref, filename, original_ref=None):
         '''Build a given system morphology.'''
 
@@ -57,11 +64,12 @@ class BuildCommand(object):
             repo_name=repo_name, ref=ref, filename=filename)
 
         self.app.status(msg='Deciding on task order')
-        srcpool = self.create_source_pool(
+        root_artifact = self.get_root_artifact(
             repo_name, ref, filename, original_ref)
-        self.validate_sources(srcpool)
-        root_artifact = self.resolve_artifacts(srcpool)
-        self.build_in_order(root_artifact)
+        try:
+            self.build_in_order(root_artifact)
+        finally:
+            self.lac.flush()
 
         self.app.status(
             msg='Build of %(repo_name)s %(ref)s %(filename)s ended '
@@ -98,9 +106,52 @@ class BuildCommand(object):
             cachedir=self.app.settings['cachedir'],
             original_ref=original_ref,
             update_repos=not self.app.settings['no-git-update'],
-            status_cb=self.app.status)
+            status_cb=self.app.status,
+            jobs=self.app.settings['resolve-jobs'])
         return srcpool
 
+    def get_root_artifact(self, repo_name, ref, filename, original_ref=None,
+                          validate=True):
+        '''Return the root artifact of the build graph of a system.
+
+        This is what create_source_pool, validate_sources and
+        resolve_artifacts would give, but the graph is loaded from the
+        build graph cache if it has been resolved before. If 'validate'
+        is False, the root artifact is not checked to be a system that
+        can be built on this machine.
+
+        '''
+
+        resolver = morphlib.sourceresolver.SourceResolver(
+            self.lrc, self.rrc, None, None,
+            not self.app.settings['no-git-update'], self.app.status)
+        graph_cache = morphlib.buildgraphcache.BuildGraphCache(
+            os.path.join(self.app.settings['cachedir'],
+                         morphlib.buildgraphcache.cache_filename),
+            morphlib.buildgraphcache.cache_size)
+        try:
+            key = graph_cache.key(repo_name,
+                                  resolver.resolve_ref(repo_name, ref),
+                                  original_ref or ref, filename)
+            root_artifact = graph_cache.load(key, self.new_build_env,
+                                             resolver.resolve_ref)
+            if root_artifact is not None:
+                self.app.status(msg='Loaded build graph from cache',
+                                chatty=True)
+                if validate:
+                    self._validate_root_artifact(root_artifact)
+                return root_artifact
+
+            srcpool = self.create_source_pool(
+                repo_name, ref, filename, original_ref)
+            self.validate_sources(srcpool)
+            root_artifact = self.resolve_artifacts(srcpool, validate)
+            graph_cache.save(key, root_artifact)
+            return root_artifact
+        finally:
+            graph_cache.close()
+            self.lrc.close()
+
     def validate_sources(self, srcpool):
         self.app.status(
             msg='Validating cross-morphology references', chatty=True)
@@ -173,7 +224,7 @@ class BuildCommand(object):
 
         root_artifact.build_env = build_env
 
-    def resolve_artifacts(self, srcpool):
+    def resolve_artifacts(self, srcpool, validate=True):
         '''Resolve the artifacts that will be built for a set of sources'''
 
         self.app.status(msg='Creating artifact resolver', chatty=True)
@@ -184,13 +235,15 @@ class BuildCommand(object):
 
         if len(root_artifacts) > 1:
             # Validate root artifacts to give a more useful error message
-            for root_artifact in root_artifacts:
-                self._validate_root_artifact(root_artifact)
+            if validate:
+                for root_artifact in root_artifacts:
+                    self._validate_root_artifact(root_artifact)
             raise MultipleRootArtifactsError(root_artifacts)
 
         root_artifact = root_artifacts[0]
-        self.app.status(msg='Validating root artifact', chatty=True)
-        self._validate_root_artifact(root_artifact)
+        if validate:
+            self.app.status(msg='Validating root artifact', chatty=True)
+            self._validate_root_artifact(root_artifact)
 
         self._compute_cache_keys(root_artifact)
 
@@ -274,6 +327,12 @@ class BuildCommand(object):
         self.app.status(msg='Building a set of sources')
         build_env = root_artifact.build_env
         ordered_sources = list(self.get_ordered_sources(root_artifact.walk()))
+
+        jobs = self.app.settings['local-build-jobs']
+        if jobs > 1:
+            self.build_in_parallel(ordered_sources, build_env, jobs)
+            return
+
         old_prefix = self.app.status_prefix
         for i, s in enumerate(ordered_sources):
             self.app.status_prefix = (
@@ -287,6 +346,84 @@ class BuildCommand(object):
 
         self.app.status_prefix = old_prefix
 
+    def build_in_parallel(self, ordered_sources, build_env, jobs):
+        '''Build sources concurrently, using up to ``jobs`` build slots.
+
+        A source is started as soon as every source it depends on has been
+        built and cached. Sources that become ready at the same time are
+        started in build order, and each is numbered in the status output
+        by the order in which it was started.
+
+        If a build fails, no further builds are started. Builds that are
+        already running are allowed to finish, then the error from the
+        failed source that comes first in build order is raised, so the
+        same failure is reported whatever the timing of the builds was.
+
+        '''
+
+        position = dict((s, i) for i, s in enumerate(ordered_sources))
+        waiting_on = dict(
+            (s, set(a.source for a in s.dependencies if a.source in position))
+            for s in ordered_sources)
+
+        old_prefix = self.app.status_prefix
+        total = len(ordered_sources)
+        condition = threading.Condition()
+        pending = list(ordered_sources)
+        running = set()
+        done = set()
+        failures = []
+
+        def build(source, index):
+            self.app.status_prefix = (
+                old_prefix + '[Build %(index)d/%(total)d] [%(name)s] ' % {
+                    'index': index,
+                    'total': total,
+                    'name': source.name,
+                })
+            try:
+                self.cache_or_build_source(source, build_env)
+            except BaseException:
+                with condition:
+                    failures.append((position[source], sys.exc_info()))
+                    running.remove(source)
+                    condition.notify()
+            else:
+                with condition:
+                    done.add(source)
+                    running.remove(source)
+                    condition.notify()
+
+        started = 0
+        with condition:
+            while True:
+                if not failures:
+                    ready = [s for s in pending if waiting_on[s] <= done]
+                    for source in ready[:jobs - len(running)]:
+                        pending.remove(source)
+                        running.add(source)
+                        started += 1
+                        thread = threading.Thread(
+                            target=build, args=(source, started),
+                            name='build-%s' % source.name)
+                        thread.daemon = True
+                        thread.start()
+                if not running:
+                    break
+                # A timeout is needed here so that the main thread can
+                # still be interrupted with Ctrl+C while it waits.
+                condition.wait(1)
+
+        if failures:
+            failures.sort(key=lambda (index, exc_info): index)
+            for index, exc_info in failures[1:]:
+                logging.error('Build of %s also failed: %s' %
+                              (ordered_sources[index].name, exc_info[1]))
+            exc_type, exc_value, exc_tb = failures[0][1]
+            raise exc_type, exc_value, exc_tb
+
+        assert not pending, 'Sources could not be ordered: %r' % pending
+
     def cache_or_build_source(self, source, build_env):
         '''Make artifacts of the built source available in the local cache.
 
@@ -297,7 +434,8 @@ class BuildCommand(object):
         artifacts = source.artifacts.values()
         if self.rac is not None:
             try:
-                self.cache_artifacts_locally(artifacts)
+                with self.fetch_lock:
+                    self.cache_artifacts_locally(artifacts)
             except morphlib.remoteartifactcache.GetError:
                 # Error is logged by the RemoteArtifactCache object.
                 pass
@@ -329,7 +467,8 @@ class BuildCommand(object):
         # quo before build logic was made to work per-source, but we can
         # now do better.
         deps = self.get_recursive_deps(source.artifacts.values())
-        self.cache_artifacts_locally(deps)
+        with self.fetch_lock:
+            self.cache_artifacts_locally(deps)
 
         use_chroot = False
         setup_mounts = False
@@ -386,8 +525,24 @@ class BuildCommand(object):
         '''Update the local git repository cache with the sources.'''
 
         repo_name = source.repo_name
-        source.repo = self.lrc.get_updated_repo(repo_name, ref=source.sha1)
-        self.lrc.ensure_submodules(source.repo, source.sha1)
+        with self.fetch_lock:
+            source.repo = self.lrc.get_updated_repo(repo_name,
+                                                    ref=source.sha1)
+            self.lrc.ensure_submodules(source.repo, source.sha1)
+
+    def update_repos(self, sources):
+        '''Update the local git repository cache with many sources at once.
+
+        The repos of the sources, and their submodules, are cloned or
+        updated as fetch_sources would, but up to 'git-update-jobs' at a
+        time, and without holding the fetch lock. Returns what
+        LocalRepoCache.update_repos does.
+
+        '''
+
+        return self.lrc.update_repos(
+            set((source.repo_name, source.sha1) for source in sources),
+            jobs=self.app.settings['git-update-jobs'])
 
     def cache_artifacts_locally(self, artifacts):
         '''Get artifacts missing from local cache from remote cache.'''
@@ -411,11 +566,19 @@ class BuildCommand(object):
                     remote.close()
                     local.close()
 
+        # Check that the remote cache has every missing artifact in one
+        # request, rather than fetching some and then finding that the
+        # rest are missing.
+        missing = [a for a in artifacts if not self.lac.has(a)]
+        if missing:
+            for artifact, cached in zip(missing, self.rac.has_many(missing)):
+                if not cached:
+                    logging.debug('Artifact %s is not in the artifact cache '
+                                  '%s' % (artifact.basename(), self.rac))
+                    raise morphlib.remoteartifactcache.GetError(self.rac,
+                                                                artifact)
+
         for artifact in artifacts:
-            # This block should fetch all artifact files in one go, using the
-            # 1.0/artifacts method of morph-cache-server. The code to do that
-            # needs bringing in from the distbuild.worker_build_connection
-            # module into morphlib.remoteartififactcache first.
             to_fetch = []
             if not self.lac.has(artifact):
                 to_fetch.append((self.rac.get(artifact),
@@ -482,22 +645,44 @@ class BuildCommand(object):
 
         '''
 
+        to_install = []
         for artifact in artifacts:
             if artifact.source.morphology['kind'] != 'chunk':
                 continue
             if artifact.source.build_mode == 'bootstrap':
                if not self.in_same_stratum(artifact.source, target_source):
                     continue
-            self.app.status(
-                msg='Installing chunk %(chunk_name)s from cache %(cache)s',
-                chunk_name=artifact.name,
-                cache=artifact.source.cache_key[:7],
-                chatty=True)
-            handle = self.lac.get(artifact)
-            staging_area.install_artifact(handle)
-
-        if target_source.build_mode == 'staging':
-            morphlib.builder.ldconfig(self.app.runcmd, staging_area.dirname)
+            to_install.append(artifact)
+        run_ldconfig = target_source.build_mode == 'staging'
+
+        def install(staging_area):
+            for artifact in to_install:
+                self.app.status(
+                    msg='Installing chunk %(chunk_name)s from cache '
+                        '%(cache)s',
+                    chunk_name=artifact.name,
+                    cache=artifact.source.cache_key[:7],
+                    chatty=True)
+                handle = self.lac.get(artifact)
+                staging_area.install_artifact(handle)
+
+            if run_ldconfig:
+                morphlib.builder.ldconfig(self.app.runcmd,
+                                          staging_area.dirname)
+
+        if not to_install:
+            install(staging_area)
+            return
+
+        # Sources with the same dependencies get identical staging areas,
+        # so these are prepared once and then reused from a snapshot. The
+        # order of installation is part of the name, since later chunks
+        # overwrite any files they share with earlier ones.
+        snapshot_id = hashlib.sha256()
+        for artifact in to_install:
+            snapshot_id.update('%s\n' % artifact.basename())
+        snapshot_id.update('ldconfig\n' if run_ldconfig else '\n')
+        staging_area.install_snapshot(snapshot_id.hexdigest(), install)
 
     def build_and_cache(self, staging_area, source, setup_mounts):
         '''Build a source and put its artifacts into the local cache.'''
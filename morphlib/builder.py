@@ -13,13 +13,13 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import errno
 import json
 import logging
 import os
 from os.path import relpath
 import shutil
 import stat
-import tarfile
 import time
 import traceback
 import subprocess
@@ -35,33 +35,45 @@ import morphlib.gitversion
 SYSTEM_INTEGRATION_PATH = os.path.join('baserock', 'system-integration')
 
 def extract_sources(app, repo_cache, repo, sha1, srcdir): #pragma: no cover
-    '''Get sources from git to a source directory, including submodules'''
+    '''Get sources from git to a source directory, including submodules
 
-    def extract_repo(repo, sha1, destdir):
+    With the 'export' source-extraction setting, each repo's files are
+    exported with CachedRepo.export, which gives them all the same
+    mtime already. Otherwise the repo is copied and checked out, and
+    the mtimes are set afterwards. The submodules of each repo are
+    extracted up to 'unpack-jobs' at a time.
+
+    '''
+
+    export = app.settings['source-extraction'] == 'export'
+
+    def extract_repo(item):
+        repo, sha1, destdir = item
         app.status(msg='Extracting %(source)s into %(target)s',
                    source=repo.original_name,
                    target=destdir)
 
-        repo.checkout(sha1, destdir)
-        morphlib.git.reset_workdir(app.runcmd, destdir)
+        if export:
+            repo.export(sha1, destdir)
+        else:
+            repo.checkout(sha1, destdir)
+            morphlib.git.reset_workdir(app.runcmd, destdir)
         submodules = morphlib.git.Submodules(app, repo.path, sha1)
         try:
             submodules.load()
         except morphlib.git.NoModulesFileError:
-            return []
-        else:
-            tuples = []
-            for sub in submodules:
-                cached_repo = repo_cache.get_repo(sub.url)
-                sub_dir = os.path.join(destdir, sub.path)
-                tuples.append((cached_repo, sub.commit, sub_dir))
-            return tuples
-
-    todo = [(repo, sha1, srcdir)]
-    while todo:
-        repo, sha1, srcdir = todo.pop()
-        todo += extract_repo(repo, sha1, srcdir)
-    set_mtime_recursively(srcdir)
+            return
+        tuples = []
+        for sub in submodules:
+            cached_repo = repo_cache.get_repo(sub.url)
+            sub_dir = os.path.join(destdir, sub.path)
+            tuples.append((cached_repo, sub.commit, sub_dir))
+        morphlib.util.map_concurrently(extract_repo, tuples,
+                                       app.settings['unpack-jobs'])
+
+    extract_repo((repo, sha1, srcdir))
+    if not export:
+        set_mtime_recursively(srcdir)
 
 def set_mtime_recursively(root):  # pragma: no cover
     '''Set the mtime for every file in a directory tree to the same.
@@ -122,8 +134,8 @@ def ldconfig(runcmd, rootdir):  # pragma: no cover
         logging.debug('No %s, not running ldconfig' % conf)
 
 
-def download_depends(constituents, lac, rac, metadatas=None):
-    for constituent in constituents:
+def download_depends(constituents, lac, rac, metadatas=None, jobs=1):
+    def download(constituent):
         if not lac.has(constituent):
             source = rac.get(constituent)
             target = lac.put(constituent)
@@ -140,6 +152,8 @@ def download_depends(constituents, lac, rac, metadatas=None):
                         dst.close()
                         src.close()
 
+    morphlib.util.map_concurrently(download, constituents, jobs)
+
 
 class BuilderBase(object):
 
@@ -242,6 +256,12 @@ class BuilderBase(object):
     def runcmd(self, *args, **kwargs):
         return self.staging_area.runcmd(*args, **kwargs)
 
+    def artifact_compression(self):  # pragma: no cover
+        '''Return the program to compress new artifacts with, or None.'''
+
+        compression = self.app.settings['artifact-compression']
+        return None if compression == 'none' else compression
+
 class ChunkBuilder(BuilderBase):
 
     '''Build chunk artifacts.'''
@@ -289,6 +309,7 @@ class ChunkBuilder(BuilderBase):
                 self.create_devices(destdir)
 
                 os.rename(temppath, logpath)
+                cache.add_file(logpath)
             except BaseException as e:
                 logging.error('Caught exception: %s' % str(e))
                 logging.info('Cleaning up staging area')
@@ -300,6 +321,7 @@ class ChunkBuilder(BuilderBase):
                                           line.rstrip('\n'))
 
                     os.rename(temppath, logpath)
+                    cache.add_file(logpath)
                 else:
                     logging.error("Couldn't find build log at %s", temppath)
 
@@ -414,65 +436,58 @@ class ChunkBuilder(BuilderBase):
         return scripts_created
 
     def assemble_chunk_artifacts(self, destdir):  # pragma: no cover
-        built_artifacts = []
-        filenames = []
         source = self.source
         split_rules = source.split_rules
         morphology = source.morphology
         sys_tag = 'system-integration'
-
-        def filepaths(destdir):
-            for dirname, subdirs, basenames in os.walk(destdir):
-                subdirsymlinks = [os.path.join(dirname, x) for x in subdirs
-                                  if os.path.islink(os.path.join(dirname, x))]
-                filenames = [os.path.join(dirname, x) for x in basenames]
-                for relpath in (os.path.relpath(x, destdir) for x in
-                                [dirname] + subdirsymlinks + filenames):
-                    yield relpath
-
-        with self.build_watch('determine-splits'):
-            matches, overlaps, unmatched = \
-                split_rules.partition(filepaths(destdir))
-
         system_integration = morphology.get(sys_tag) or {}
 
-        with self.build_watch('create-chunks'):
+        def classify(relname):
+            matched = split_rules.match(relname)
+            return matched[0] if matched else None
+
+        # All the chunk artifacts are written at the same time, so that
+        # DESTDIR only needs to be walked once.
+        outputs = {}
+        writer = None
+        try:
             for chunk_artifact_name, chunk_artifact \
                 in source.artifacts.iteritems():
-                file_paths = matches[chunk_artifact_name]
-                chunk_artifact = source.artifacts[chunk_artifact_name]
-
-                def all_parents(path):
-                    while path != '':
-                        yield path
-                        path = os.path.dirname(path)
-
-                def parentify(filenames):
-                    names = set()
-                    for name in filenames:
-                        names.update(all_parents(name))
-                    return sorted(names)
-
-                extra_files = self.write_system_integration_commands(
-                                  destdir, system_integration,
-                                  chunk_artifact_name)
-                extra_files += ['baserock/%s.meta' % chunk_artifact_name]
-                parented_paths = parentify(file_paths + extra_files)
-
-                with self.local_artifact_cache.put(chunk_artifact) as f:
+                outputs[chunk_artifact_name] = \
+                    self.local_artifact_cache.put(chunk_artifact)
+
+            with self.build_watch('create-chunks'):
+                self.app.status(msg='Creating chunk artifacts for %(name)s',
+                                name=source.name)
+                writer = morphlib.bins.ChunkWriter(
+                    destdir, outputs, self.artifact_compression())
+                unmatched = writer.add_tree(classify)
+
+                for chunk_artifact_name in source.artifacts:
+                    for relname in self.write_system_integration_commands(
+                            destdir, system_integration, chunk_artifact_name):
+                        writer.add(chunk_artifact_name, relname)
+
+                    meta_path = 'baserock/%s.meta' % chunk_artifact_name
+                    contents = writer.contents[chunk_artifact_name].union(
+                        ['baserock', meta_path])
                     self.write_metadata(destdir, chunk_artifact_name,
-                                        parented_paths)
-
-                    self.app.status(msg='Creating chunk artifact %(name)s',
-                                    name=chunk_artifact_name)
-                    morphlib.bins.create_chunk(destdir, f, parented_paths)
-                built_artifacts.append(chunk_artifact)
+                                        sorted(contents))
+                    writer.add(chunk_artifact_name, meta_path)
+                writer.close()
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            for f in outputs.itervalues():
+                f.abort()
+            raise
+        for f in outputs.itervalues():
+            f.close()
 
-        for dirname, subdirs, files in os.walk(destdir):
-            if files:
-                raise Exception('DESTDIR %s is not empty: %s' %
-                                (destdir, files))
-        return built_artifacts
+        if unmatched:
+            raise Exception('DESTDIR %s is not empty: %s' %
+                            (destdir, unmatched))
+        return source.artifacts.values()
 
     def get_sources(self, srcdir):  # pragma: no cover
         s = self.source
@@ -495,11 +510,11 @@ class StratumBuilder(BuilderBase):
             # the only reason the StratumBuilder has to download chunks is to
             # check for overlap now that strata are lists of chunks
             with self.build_watch('check-chunks'):
-                for a_name, a in self.source.artifacts.iteritems():
-                    # download the chunk artifact if necessary
-                    download_depends(constituents,
-                                     self.local_artifact_cache,
-                                     self.remote_artifact_cache)
+                # download the chunk artifacts if necessary
+                download_depends(constituents,
+                                 self.local_artifact_cache,
+                                 self.remote_artifact_cache,
+                                 jobs=self.app.settings['unpack-jobs'])
 
             with self.build_watch('create-chunk-list'):
                 lac = self.local_artifact_cache
@@ -533,28 +548,29 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
 
             for a_name, artifact in self.source.artifacts.iteritems():
                 handle = self.local_artifact_cache.put(artifact)
+                compressor = None
 
                 try:
                     fs_root = self.staging_area.destdir(self.source)
-                    self.unpack_strata(fs_root)
-                    self.write_metadata(fs_root, a_name)
-                    self.run_system_integration_commands(fs_root)
-                    unslashy_root = fs_root[1:]
-                    def uproot_info(info):
-                        info.name = relpath(info.name, unslashy_root)
-                        if info.islnk():
-                            info.linkname = relpath(info.linkname,
-                                                    unslashy_root)
-                        return info
-                    tar = tarfile.open(fileobj=handle, mode="w", name=a_name)
-                    self.app.status(msg='Constructing tarball of rootfs',
-                                    chatty=True)
-                    tar.add(fs_root, recursive=True, filter=uproot_info)
+                    tar, compressor = morphlib.bins.create_tar(
+                        handle, self.artifact_compression())
+                    merged = False
+                    if self.app.settings['system-composition'] == 'merge':
+                        merged = self.merge_strata(tar, fs_root, a_name)
+                    if not merged:
+                        self.unpack_strata(fs_root)
+                        self.write_metadata(fs_root, a_name)
+                        self.run_system_integration_commands(fs_root)
+                        self.archive_rootfs(tar, fs_root)
                     tar.close()
+                    if compressor is not None:
+                        compressor.close()
                 except BaseException as e:
                     logging.error(traceback.format_exc())
                     self.app.status(msg='Error while building system',
                                     error=True)
+                    if compressor is not None:
+                        compressor.abort()
                     handle.abort()
                     raise
                 else:
@@ -563,17 +579,170 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
         self.save_build_times()
         return self.source.artifacts.itervalues()
 
-    def unpack_one_stratum(self, stratum_artifact, target):
+    def archive_rootfs(self, tar, fs_root):
+        '''Add everything in the root filesystem to the system tarball.'''
+
+        unslashy_root = fs_root[1:]
+        def uproot_info(info):
+            info.name = relpath(info.name, unslashy_root)
+            if info.islnk():
+                info.linkname = relpath(info.linkname,
+                                        unslashy_root)
+            return info
+        self.app.status(msg='Constructing tarball of rootfs',
+                        chatty=True)
+        tar.add(fs_root, recursive=True, filter=uproot_info)
+
+    def merge_strata(self, tar, fs_root, a_name):
+        '''Write the system tarball by merging the chunk artifacts.
+
+        The chunks are only unpacked if ldconfig or system integration
+        commands need to be run on the root filesystem, which is then
+        assembled by merge_into_rootfs.
+
+        Returns False, without having written anything, if the root
+        filesystem is needed but cannot be assembled that way.
+
+        '''
+
+        with self.build_watch('merge-strata'):
+            merger, chunks = self.read_strata()
+
+            metadir = tempfile.mkdtemp(dir=os.path.dirname(fs_root))
+            try:
+                self.write_metadata(metadir, a_name)
+                for dirname, subdirs, basenames in os.walk(metadir):
+                    for basename in basenames:
+                        filename = os.path.join(dirname, basename)
+                        with open(filename) as f:
+                            merger.add_file(
+                                os.path.relpath(filename, metadir), f.read(),
+                                os.stat(filename).st_mode & 0o7777)
+            finally:
+                shutil.rmtree(metadir)
+
+        if (merger.lookup('etc/ld.so.conf') is None and
+                not merger.listdir(SYSTEM_INTEGRATION_PATH)):
+            self.app.status(msg='Merging chunks into system tarball',
+                            chatty=True)
+            merger.write(tar)
+            return True
+        return self.merge_into_rootfs(tar, fs_root, merger, chunks)
+
+    def merge_into_rootfs(self, tar, fs_root, merger, chunks):
+        '''Assemble the merged root filesystem, integrate and archive it.
+
+        Files in the root filesystem are hardlinks to the chunks unpacked
+        in the tempdir, which are shared with staging areas, so it is
+        mounted as the lower layer of an overlayfs in case the system
+        integration commands change files in place.
+
+        '''
+
+        cache = self.local_artifact_cache
+        chunk_cache = morphlib.unpackedchunkcache.UnpackedChunkCache(
+            os.path.join(self.app.settings['tempdir'], 'chunks'),
+            self.app.settings['chunk-cache-max-size'])
+        overlay = tempfile.mkdtemp(dir=os.path.dirname(fs_root))
+        lower, upper, work = (os.path.join(overlay, subdir)
+                              for subdir in ('lower', 'upper', 'work'))
+        uses = []
+        mounted = False
+        try:
+            source_dirs = []
+            for chunk in chunks:
+                with cache.get(chunk) as f:
+                    use = chunk_cache.get(f, status=self.app.status)
+                    source_dirs.append(use.__enter__())
+                uses.append(use)
+
+            for dirname in (lower, upper, work):
+                os.mkdir(dirname)
+            try:
+                merger.materialise(lower, source_dirs)
+                self.app.runcmd(
+                    ['mount', '-t', 'overlay', 'overlay', '-o',
+                     'lowerdir=%s,upperdir=%s,workdir=%s' % (
+                        lower, upper, work), fs_root])
+            except (OSError, cliapp.AppException) as e:
+                if isinstance(e, OSError) and e.errno != errno.EXDEV:
+                    raise
+                logging.warning('Cannot assemble the system with overlayfs, '
+                                'unpacking it instead: %s' % e)
+                return False
+            mounted = True
+
+            ldconfig(self.app.runcmd, fs_root)
+            self.run_system_integration_commands(fs_root)
+            self.archive_rootfs(tar, fs_root)
+            return True
+        finally:
+            if mounted:
+                self.app.runcmd(['umount', fs_root])
+            for use in uses:
+                use.__exit__(None, None, None)
+            shutil.rmtree(overlay)
+
+    def fetch_strata(self):
+        '''Download the strata and their chunks, if necessary.
+
+        Returns a list of the stratum artifacts, each with a list of its
+        chunk artifacts, in the order they are unpacked in.
+
+        '''
+
+        cache = self.local_artifact_cache
+        jobs = self.app.settings['unpack-jobs']
+        download_depends(self.source.dependencies,
+                         cache, self.remote_artifact_cache, ('meta',),
+                         jobs=jobs)
+
+        strata = []
+        all_chunks = {}
+        for stratum_artifact in self.source.dependencies:
+            with cache.get(stratum_artifact) as f:
+                chunks = [ArtifactCacheReference(c) for c in json.load(f)]
+            strata.append((stratum_artifact, chunks))
+            for chunk in chunks:
+                all_chunks.setdefault(chunk.basename(), chunk)
+        download_depends(all_chunks.values(),
+                         cache, self.remote_artifact_cache, jobs=jobs)
+        return strata
+
+    def read_strata(self):
+        '''Work out what each file in the system comes from.
+
+        Returns a TarMerger with the chunks and metadata of the strata
+        added in the order they are unpacked in, and the list of chunk
+        artifacts in that order.
+
+        '''
+
+        cache = self.local_artifact_cache
+        merger = morphlib.tarmerger.TarMerger()
+        chunks = []
+        for stratum_artifact, stratum_chunks in self.fetch_strata():
+            self.app.status(msg='Reading chunks of %(stratum)s',
+                            stratum=stratum_artifact.name, chatty=True)
+            merger.add_tars(
+                (lambda chunk=chunk: cache.get(chunk)
+                 for chunk in stratum_chunks),
+                self.app.settings['unpack-jobs'])
+            chunks.extend(stratum_chunks)
+            with cache.get_artifact_metadata(stratum_artifact, 'meta') as f:
+                merger.add_file('baserock/%s.meta' % stratum_artifact.name,
+                                f.read(), 0o600)
+        return merger, chunks
+
+    def unpack_one_stratum(self, stratum_artifact, chunks, target):
         '''Unpack a single stratum into a target directory'''
 
         cache = self.local_artifact_cache
-        with cache.get(stratum_artifact) as stratum_file:
-            artifact_list = json.load(stratum_file, encoding='unicode-escape')
-            for chunk in (ArtifactCacheReference(a) for a in artifact_list):
-                self.app.status(msg='Unpacking chunk %(basename)s',
-                                basename=chunk.basename(), chatty=True)
-                with cache.get(chunk) as chunk_file:
-                    morphlib.bins.unpack_binary_from_file(chunk_file, target)
+        for chunk in chunks:
+            self.app.status(msg='Unpacking chunk %(basename)s',
+                            basename=chunk.basename(), chatty=True)
+            with cache.get(chunk) as chunk_file:
+                morphlib.bins.unpack_binary_from_file(chunk_file, target)
 
         target_metadata = os.path.join(
                 target, 'baserock', '%s.meta' % stratum_artifact.name)
@@ -582,31 +751,26 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
                 shutil.copyfileobj(meta_src, meta_dst)
 
     def unpack_strata(self, path):
-        '''Unpack strata into a directory.'''
+        '''Unpack strata into a directory.
+
+        With more than one unpack job, the chunks are extracted
+        concurrently. Files that are in more than one chunk still end up
+        as they would if the chunks were unpacked one after another.
+
+        '''
 
         self.app.status(msg='Unpacking strata to %(path)s',
                         path=path, chatty=True)
+        jobs = self.app.settings['unpack-jobs']
         with self.build_watch('unpack-strata'):
-            for a_name, a in self.source.artifacts.iteritems():
-                # download the stratum artifacts if necessary
-                download_depends(self.source.dependencies,
-                                 self.local_artifact_cache,
-                                 self.remote_artifact_cache,
-                                 ('meta',))
-
-                # download the chunk artifacts if necessary
-                for stratum_artifact in self.source.dependencies:
-                    f = self.local_artifact_cache.get(stratum_artifact)
-                    chunks = [ArtifactCacheReference(c) for c in json.load(f)]
-                    download_depends(chunks,
-                                     self.local_artifact_cache,
-                                     self.remote_artifact_cache)
-                    f.close()
-
-                # unpack it from the local artifact cache
-                for stratum_artifact in self.source.dependencies:
-                    self.unpack_one_stratum(stratum_artifact, path)
-
+            if jobs > 1:
+                merger, chunks = self.read_strata()
+                self.app.status(msg='Extracting %(count)d chunks',
+                                count=len(chunks), chatty=True)
+                merger.extract(path, jobs)
+            else:
+                for stratum_artifact, chunks in self.fetch_strata():
+                    self.unpack_one_stratum(stratum_artifact, chunks, path)
             ldconfig(self.app.runcmd, path)
 
     def write_metadata(self, instdir, artifact_name):
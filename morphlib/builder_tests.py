@@ -197,6 +197,17 @@ class BuilderBaseTests(unittest.TestCase):
         morphlib.builder.download_depends(afacts, lac, rac)
         self.assertTrue(all(lac.has(a) for a in afacts))
 
+    def test_downloads_depends_concurrently(self):
+        lac = FakeArtifactCache()
+        rac = FakeArtifactCache()
+        afacts = [FakeArtifact(name) for name in ('a', 'b', 'c', 'd')]
+        for a in afacts:
+            fh = rac.put(a)
+            fh.write(a.name)
+            fh.close()
+        morphlib.builder.download_depends(afacts, lac, rac, jobs=3)
+        self.assertTrue(all(lac.has(a) for a in afacts))
+
     def test_downloads_depends_metadata(self):
         lac = FakeArtifactCache()
         rac = FakeArtifactCache()
@@ -0,0 +1,125 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+
+import distbuild
+import morphlib
+
+
+cache_filename = 'build-graphs.cache.sqlite'
+cache_size = 100
+
+
+class BuildGraphCache(object):
+
+    '''Keep resolved build graphs, so they need not be resolved again.
+
+    The build graph of a system, with the cache keys of its sources, is
+    determined by the commit of the definitions repo it comes from, the
+    commits the named refs in it point to, the build environment for its
+    architecture and the version of Morph. A graph is saved under a key
+    made of the commit of the definitions and the name of the system,
+    along with the named refs it used and the part of the build
+    environment that cache keys depend on. It is loaded only if those
+    are all still the same.
+
+    The graphs are kept as distbuild encodes them, in an SQLite cache.
+
+    '''
+
+    def __init__(self, filename, size):
+        self._cache = morphlib.sqlitecache.SqliteCache(filename, size)
+
+    @staticmethod
+    def key(repo_name, sha1, original_ref, filename):
+        '''Return the key to save the graph of a system under.
+
+        Returns None if graphs shouldn't be cached, which is the case
+        when Morph has uncommitted changes, so its version doesn't say
+        how it resolves graphs.
+
+        '''
+
+        version = morphlib.__version__
+        if version.endswith('-unreproducible'):
+            return None
+        return (repo_name, sha1, original_ref, filename, version)
+
+    def load(self, key, new_build_env, resolve_ref):
+        '''Return the root artifact of a saved build graph, or None.
+
+        ``new_build_env`` is called with the architecture of the system
+        to get its BuildEnvironment, which is set as the ``build_env``
+        of the root artifact as BuildCommand.resolve_artifacts does.
+        ``resolve_ref`` is called with a repo and a named ref to get the
+        commit the ref points to now.
+
+        '''
+
+        if key is None:
+            return None
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+
+        build_env = new_build_env(entry['arch'])
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
+        if ckc.get_filtered_env() != entry['env']:
+            logging.debug('Build environment of saved graph has changed')
+            return None
+        for repo_name, ref, sha1 in entry['refs']:
+            if resolve_ref(repo_name, ref) != sha1:
+                logging.debug('%s %s has changed since the graph was saved',
+                              repo_name, ref)
+                return None
+
+        root_artifact = distbuild.decode_artifact_graph(entry['graph'])
+        root_artifact.build_env = build_env
+        return root_artifact
+
+    def save(self, key, root_artifact):
+        '''Save the build graph of a root artifact from resolve_artifacts.
+
+        Sources from the same commit as the root artifact's come from
+        the definitions, which the key already identifies. The refs of
+        any other sources that aren't SHA1s are saved, to be checked
+        when the graph is loaded.
+
+        '''
+
+        if key is None:
+            return
+        root_source = root_artifact.source
+        refs = set()
+        for source in set(a.source for a in root_artifact.walk()):
+            from_definitions = (
+                (source.repo_name, source.sha1) ==
+                (root_source.repo_name, root_source.sha1))
+            if source.original_ref != source.sha1 and not from_definitions:
+                refs.add((source.repo_name, source.original_ref,
+                          source.sha1))
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(
+            root_artifact.build_env)
+        self._cache[key] = {
+            'arch': root_source.morphology['arch'],
+            'env': ckc.get_filtered_env(),
+            'refs': sorted(refs),
+            'graph': distbuild.encode_artifact_graph(root_artifact),
+        }
+        self._cache.save()
+
+    def close(self):
+        self._cache.close()
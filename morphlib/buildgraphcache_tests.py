@@ -0,0 +1,157 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+system_morph = '''
+name: system
+kind: system
+arch: x86_64
+strata:
+- name: stratum
+  morph: strata/stratum.morph
+'''
+
+stratum_morph = '''
+name: stratum
+kind: stratum
+chunks:
+- name: chunk
+  morph: chunk.morph
+  repo: chunk-repo
+  ref: master
+  build-mode: bootstrap
+  build-depends: []
+'''
+
+chunk_morph = '''
+name: chunk
+kind: chunk
+'''
+
+
+class BuildGraphCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'graphs.sqlite')
+        self.version = morphlib.__version__
+        morphlib.__version__ = 'cafef00d'
+        self.settings = {'no-ccache': True, 'no-distcc': True}
+        self.refs = {('chunk-repo', 'master'): 'chunk-sha1'}
+        self.root_artifact = self.resolve()
+        self.key = morphlib.buildgraphcache.BuildGraphCache.key(
+            'definitions', 'definitions-sha1', 'master', 'system.morph')
+
+    def tearDown(self):
+        morphlib.__version__ = self.version
+        shutil.rmtree(self.tempdir)
+
+    def new_build_env(self, arch):
+        return morphlib.buildenvironment.BuildEnvironment(self.settings, arch)
+
+    def resolve_ref(self, repo_name, ref):
+        return self.refs[(repo_name, ref)]
+
+    def resolve(self):
+        loader = morphlib.morphloader.MorphologyLoader()
+        pool = morphlib.sourcepool.SourcePool()
+        for repo, sha1, filename, text in [
+                ('definitions', 'definitions-sha1', 'system.morph',
+                 system_morph),
+                ('definitions', 'definitions-sha1', 'strata/stratum.morph',
+                 stratum_morph),
+                ('chunk-repo', 'chunk-sha1', 'chunk.morph', chunk_morph)]:
+            for source in morphlib.source.make_sources(
+                    repo, 'master', filename, sha1, 'tree',
+                    loader.load_from_string(text)):
+                pool.add(source)
+        resolver = morphlib.artifactresolver.ArtifactResolver()
+        root_artifact, = resolver.resolve_root_artifacts(pool)
+        build_env = self.new_build_env('x86_64')
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
+        for source in set(a.source for a in root_artifact.walk()):
+            source.cache_key = ckc.compute_key(source)
+            source.cache_id = ckc.get_cache_id(source)
+        root_artifact.build_env = build_env
+        return root_artifact
+
+    def save(self):
+        cache = morphlib.buildgraphcache.BuildGraphCache(self.filename, 10)
+        cache.save(self.key, self.root_artifact)
+        cache.close()
+
+    def load(self):
+        cache = morphlib.buildgraphcache.BuildGraphCache(self.filename, 10)
+        try:
+            return cache.load(self.key, self.new_build_env, self.resolve_ref)
+        finally:
+            cache.close()
+
+    def test_loads_nothing_initially(self):
+        self.assertEqual(self.load(), None)
+
+    def test_loads_saved_graph(self):
+        self.assertTrue(any(a.source.repo_name == 'chunk-repo'
+                            for a in self.root_artifact.walk()))
+        self.save()
+        loaded = self.load()
+        self.assertEqual(
+            sorted(a.basename() for a in loaded.walk()),
+            sorted(a.basename() for a in self.root_artifact.walk()))
+        self.assertEqual(loaded.build_env.env,
+                         self.root_artifact.build_env.env)
+
+    def test_does_not_check_refs_of_definitions_or_sha1_refs(self):
+        for artifact in self.root_artifact.walk():
+            if artifact.source.repo_name == 'chunk-repo':
+                artifact.source.original_ref = artifact.source.sha1
+        self.save()
+        self.refs = {}
+        self.assertNotEqual(self.load(), None)
+
+    def test_saves_and_loads_nothing_without_a_key(self):
+        key = self.key
+        self.key = None
+        self.save()
+        self.key = key
+        self.assertEqual(self.load(), None)
+        self.save()
+        self.key = None
+        self.assertEqual(self.load(), None)
+
+    def test_does_not_load_graph_if_named_ref_has_moved(self):
+        self.save()
+        self.refs[('chunk-repo', 'master')] = 'other-sha1'
+        self.assertEqual(self.load(), None)
+
+    def test_does_not_load_graph_if_build_environment_has_changed(self):
+        self.save()
+        self.new_build_env = lambda arch: \
+            morphlib.buildenvironment.BuildEnvironment(self.settings,
+                                                       'armv7l')
+        self.assertEqual(self.load(), None)
+
+    def test_does_not_cache_graphs_for_modified_morph(self):
+        morphlib.__version__ = 'cafef00d-unreproducible'
+        self.assertEqual(morphlib.buildgraphcache.BuildGraphCache.key(
+            'definitions', 'definitions-sha1', 'master', 'system.morph'),
+            None)
@@ -79,9 +79,17 @@ class CachedRepo(object):
     repo may be updated from it's origin remote using the update()
     method.
 
+    If an object pool is given, the repo keeps its objects there, so
+    that related repos, such as forks of the same project, share them.
+    The pool is a bare repository which has the refs of each repo that
+    uses it under refs/repos/NAME/, where NAME is the repo's URL quoted
+    as it is for the name of its directory in the cache. Updates fetch
+    into the pool, which downloads only the objects it doesn't have yet,
+    and then copy the refs from there.
+
     '''
 
-    def __init__(self, app, original_name, url, path):
+    def __init__(self, app, original_name, url, path, object_pool=None):
         '''Creates a new CachedRepo for a repo name, URL and local path.'''
 
         self.app = app
@@ -90,8 +98,9 @@ class CachedRepo(object):
         self.path = path
         self.is_mirror = not url.startswith('file://')
         self.already_updated = False
+        self.object_pool = object_pool
 
-        self._gitdir = morphlib.gitdir.GitDirectory(path)
+        self._gitdir = morphlib.gitdir.GitDirectory(path, cat_file=True)
 
     def ref_exists(self, ref):  # pragma: no cover
         '''Returns True if the given ref exists in the repo'''
@@ -113,15 +122,19 @@ class CachedRepo(object):
         '''
         return self._gitdir.resolve_ref_to_tree(ref)
 
-    def read_file(self, filename, ref):  # pragma: no cover
+    def read_file(self, filename, ref,
+                  follow_symlinks=False):  # pragma: no cover
         '''Attempts to read a file from a given ref.
 
+        If follow_symlinks is True, symbolic links are followed as they
+        would be in a checkout of the ref.
+
         Raises a gitdir.InvalidRefError if the ref is not found in the
         repository. Raises an IOError if the requested file is not found in
         the ref.
 
         '''
-        return self._gitdir.read_file(filename, ref)
+        return self._gitdir.read_file(filename, ref, follow_symlinks)
 
     def list_files(self, ref, recurse=True):  # pragma: no cover
         '''Return filenames found in the tree pointed to by the given ref.
@@ -170,6 +183,28 @@ class CachedRepo(object):
 
         self._checkout_ref_in_clone(ref, target_dir)
 
+    def export(self, ref, target_dir):
+        '''Extract the files of a commit, with a .git that shares objects.
+
+        This gives a directory that can be used like the result of
+        checkout(), but more quickly: only the commit's files are
+        written, streamed out of the repository by 'git archive', and
+        the .git in the directory hard links to the cached repository's
+        objects instead of copying them. Every file gets the time of the
+        commit as its modification time, so they need not be set again.
+
+        Raises a gitdir.InvalidRefError if the ref is not found in the
+        repository. Raises a CheckoutError if something else goes wrong.
+
+        '''
+
+        commit = self._gitdir.resolve_ref_to_commit(ref)
+
+        if not os.path.exists(target_dir):
+            os.makedirs(target_dir)
+
+        self._export_commit(commit, target_dir)
+
     def extract_commit(self, ref, target_dir):
         '''Extract files from a given commit into target_dir.
 
@@ -228,11 +263,48 @@ class CachedRepo(object):
             return
 
         try:
-            self._gitdir.update_remotes(
-                echo_stderr=self.app.settings['verbose'])
+            if self.object_pool:
+                self._update_through_object_pool()
+            else:
+                self._gitdir.update_remotes(
+                    echo_stderr=self.app.settings['verbose'])
             self.already_updated = True
         except cliapp.AppException:
             raise UpdateError(self)
+        finally:
+            # Make sure the git processes reading objects see the update.
+            self._gitdir.close()
+
+    def _update_through_object_pool(self):  # pragma: no cover
+        namespace = 'refs/repos/%s/' % morphlib.localrepocache.quote_url(
+            self.url)
+        pool_objects = os.path.join(self.object_pool, 'objects')
+        verbose = self.app.settings['verbose']
+
+        morphlib.git.init_object_pool(self._runcmd, self.object_pool)
+        if pool_objects not in morphlib.git.get_alternates(self.path):
+            # This repo was cached before the pool was used, or seeded
+            # from a tarball: hand its objects to the pool, then drop
+            # its own copies of them.
+            morphlib.git.gitcmd(self._runcmd, 'fetch', '--quiet',
+                                '--no-tags', self.path,
+                                '+refs/*:%s*' % namespace,
+                                cwd=self.object_pool)
+            morphlib.git.set_alternates(self.path, [pool_objects])
+            morphlib.git.gitcmd(self._runcmd, 'repack', '-a', '-d', '-l',
+                                '-q')
+
+        morphlib.git.gitcmd(self._runcmd, 'fetch', '--prune', '--no-tags',
+                            self.url, '+refs/*:%s*' % namespace,
+                            cwd=self.object_pool, echo_stderr=verbose)
+        # The pool has all the objects, so this only copies refs.
+        morphlib.git.gitcmd(self._runcmd, 'fetch', '--quiet', '--prune',
+                            '--no-tags', self.object_pool,
+                            '+%s*:refs/*' % namespace)
+
+    def close(self):
+        '''Stop any git processes kept running for this repository.'''
+        self._gitdir.close()
 
     def _runcmd(self, *args, **kwargs):  # pragma: no cover
         if not 'cwd' in kwargs:
@@ -254,6 +326,25 @@ class CachedRepo(object):
         except cliapp.AppException:
             raise CopyError(self, target_dir)
 
+    def _export_commit(self, commit, target_dir):  # pragma: no cover
+        try:
+            morphlib.git.link_repository(self._runcmd, self.path,
+                                         target_dir, commit, self.is_mirror)
+            # The files must be as a checkout would leave them, whatever
+            # .gitattributes says about exporting them.
+            attributes = os.path.join(target_dir, '.git', 'info',
+                                      'attributes')
+            with open(attributes, 'w') as f:
+                f.write('* -export-ignore -export-subst\n')
+            # git archive masks modes with 002 by default, and tar run
+            # as root keeps them, so use the umask a checkout would.
+            self._runcmd(['git', '-c', 'tar.umask=user', 'archive',
+                          '--format=tar', commit],
+                         ['tar', '-xf', '-'], cwd=target_dir)
+            os.remove(attributes)
+        except (cliapp.AppException, OSError, IOError):
+            raise CheckoutError(self, commit, target_dir)
+
     def _checkout_ref_in_clone(self, ref, clone_dir):  # pragma: no cover
         # This is a separate GitDirectory instance. Don't confuse it with the
         # internal ._gitdir attribute!
@@ -13,8 +13,12 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import errno
 import logging
 import os
+import shutil
+import stat
+import tempfile
 import unittest
 
 import fs.tempfs
@@ -158,6 +162,17 @@ class CachedRepoTests(unittest.TestCase):
         morph_filename = os.path.join(unpack_dir, 'foo.morph')
         self.assertTrue(os.path.exists(morph_filename))
 
+    def test_export_resolved_commit_into_new_directory(self):
+        exported = []
+        self.repo._gitdir._rev_parse = self.rev_parse
+        self.repo._export_commit = \
+            lambda commit, target_dir: exported.append((commit, target_dir))
+        unpack_dir = self.tempfs.getsyspath('unpack-dir')
+        self.repo.export('master', unpack_dir)
+        self.assertTrue(os.path.exists(unpack_dir))
+        self.assertEqual(exported, [
+            ('e28a23812eadf2fce6583b8819b9c5dbd36b9fb9', unpack_dir)])
+
     def test_extract_commit_into_new_directory(self):
         self.repo._gitdir.get_index = self.get_index
         unpack_dir = self.tempfs.getsyspath('unpack-dir')
@@ -176,6 +191,16 @@ class CachedRepoTests(unittest.TestCase):
         self.repo._gitdir.update_remotes = self.update_with_failure
         self.assertRaises(morphlib.cachedrepo.UpdateError, self.repo.update)
 
+    def test_updates_through_object_pool_if_it_has_one(self):
+        pool_updates = []
+        self.repo.object_pool = '/tmp/object-pool.git'
+        self.repo._gitdir.update_remotes = self.update_with_failure
+        self.repo._update_through_object_pool = \
+            lambda: pool_updates.append(self.repo)
+        self.repo.update()
+        self.assertEqual(pool_updates, [self.repo])
+        self.assertTrue(self.repo.already_updated)
+
     def test_no_update_if_local(self):
         with morphlib.gitdir_tests.allow_nonexistant_git_repos():
             self.repo = morphlib.cachedrepo.CachedRepo(
@@ -210,3 +235,140 @@ class CachedRepoTests(unittest.TestCase):
         self.assertTrue(self.repo.requires_update_for_ref('named_ref'))
         self.repo.update()
         self.assertFalse(self.repo.requires_update_for_ref('named_ref'))
+
+
+class RunningApplication(object):
+
+    def __init__(self):
+        self.settings = {'verbose': True}
+
+    def runcmd(self, *args, **kwargs):
+        return cliapp.runcmd(*args, **kwargs)
+
+
+class CachedRepoExportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.umask = os.umask(0o022)
+        source = os.path.join(self.tempdir, 'source')
+        os.makedirs(os.path.join(source, 'dir'))
+        for relname, mode in (('plain', 0o644), ('script', 0o755),
+                              ('dir/file', 0o644)):
+            filename = os.path.join(source, relname)
+            with open(filename, 'w') as f:
+                f.write(relname)
+            os.chmod(filename, mode)
+        gd = morphlib.gitdir.init(source)
+        gd._runcmd(['git', 'add', '.'])
+        gd._runcmd(['git', '-c', 'user.name=Test',
+                    '-c', 'user.email=test@example.com',
+                    'commit', '-q', '-m', 'Initial commit'])
+        self.commit = gd.resolve_ref_to_commit('HEAD')
+        cached = os.path.join(self.tempdir, 'cached.git')
+        cliapp.runcmd(['git', 'clone', '-q', '--mirror', source, cached])
+        self.repo = morphlib.cachedrepo.CachedRepo(
+            RunningApplication(), 'source', 'git://example.com/source',
+            cached)
+
+    def tearDown(self):
+        os.umask(self.umask)
+        shutil.rmtree(self.tempdir)
+
+    def test_close_stops_git_processes_until_needed_again(self):
+        self.assertEqual(self.repo.read_file('plain', self.commit), 'plain')
+        cat_file = self.repo._gitdir._cat_file
+        self.repo.close()
+        self.assertRaises(IOError, cat_file.info, self.commit)
+        self.assertEqual(self.repo.read_file('plain', self.commit), 'plain')
+        self.repo.close()
+
+    def modes(self, dirname):
+        modes = {}
+        for path, subdirs, basenames in os.walk(dirname):
+            subdirs[:] = [d for d in subdirs if d != '.git']
+            for basename in subdirs + basenames:
+                filename = os.path.join(path, basename)
+                modes[os.path.relpath(filename, dirname)] = \
+                    stat.S_IMODE(os.lstat(filename).st_mode)
+        return modes
+
+    def test_export_gives_files_the_modes_checkout_does(self):
+        checked_out = os.path.join(self.tempdir, 'checked-out')
+        exported = os.path.join(self.tempdir, 'exported')
+        self.repo.checkout(self.commit, checked_out)
+        self.repo.export(self.commit, exported)
+
+        modes = self.modes(checked_out)
+        self.assertEqual(sorted(modes), ['dir', 'dir/file', 'plain',
+                                         'script'])
+        self.assertEqual(self.modes(exported), modes)
+
+    def use_object_pool(self):
+        pool = os.path.join(self.tempdir, 'object-pool.git')
+        morphlib.git.init_object_pool(cliapp.runcmd, pool)
+        morphlib.git.gitcmd(cliapp.runcmd, 'fetch', '--quiet', self.repo.path,
+                            '+refs/*:refs/repos/source/*', cwd=pool)
+        other = morphlib.git.gitcmd(cliapp.runcmd, 'hash-object', '-w',
+                                    '--stdin', feed_stdin='not in source',
+                                    cwd=pool).strip()
+        morphlib.git.set_alternates(self.repo.path,
+                                    [os.path.join(pool, 'objects')])
+        morphlib.git.gitcmd(cliapp.runcmd, 'repack', '-a', '-d', '-l', '-q',
+                            cwd=self.repo.path)
+        return other
+
+    def assertHasObjects(self, dirname, other):
+        gitdir = os.path.join(dirname, '.git')
+        self.assertEqual(morphlib.git.get_alternates(gitdir), [])
+        morphlib.git.gitcmd(cliapp.runcmd, 'fsck', '--no-progress',
+                            cwd=dirname)
+        if other:
+            morphlib.git.gitcmd(cliapp.runcmd, 'cat-file', '-e',
+                                self.other, cwd=dirname)
+        else:
+            self.assertRaises(cliapp.AppException, morphlib.git.gitcmd,
+                              cliapp.runcmd, 'cat-file', '-e', self.other,
+                              cwd=dirname)
+
+    def assertLinksPoolPacks(self, dirname):
+        pool_packs = os.path.join(self.tempdir, 'object-pool.git', 'objects',
+                                  'pack')
+        packs = os.path.join(dirname, '.git', 'objects', 'pack')
+        for basename in os.listdir(pool_packs):
+            self.assertTrue(os.path.samefile(
+                os.path.join(pool_packs, basename),
+                os.path.join(packs, basename)))
+
+    def cross_filesystems(self):
+        def link(source, target):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        return morphlib.gitdir_tests.monkeypatch(os, 'link', link)
+
+    def test_checkout_links_object_pool_on_same_filesystem(self):
+        self.other = self.use_object_pool()
+        checked_out = os.path.join(self.tempdir, 'checked-out')
+        self.repo.checkout(self.commit, checked_out)
+        self.assertHasObjects(checked_out, other=True)
+        self.assertLinksPoolPacks(checked_out)
+
+    def test_export_links_object_pool_on_same_filesystem(self):
+        self.other = self.use_object_pool()
+        exported = os.path.join(self.tempdir, 'exported')
+        self.repo.export(self.commit, exported)
+        self.assertHasObjects(exported, other=True)
+        self.assertLinksPoolPacks(exported)
+
+    def test_checkout_takes_only_needed_objects_across_filesystems(self):
+        self.other = self.use_object_pool()
+        checked_out = os.path.join(self.tempdir, 'checked-out')
+        with self.cross_filesystems():
+            self.repo.checkout(self.commit, checked_out)
+        self.assertHasObjects(checked_out, other=False)
+
+    def test_export_takes_only_needed_objects_across_filesystems(self):
+        self.other = self.use_object_pool()
+        exported = os.path.join(self.tempdir, 'exported')
+        with self.cross_filesystems():
+            self.repo.export(self.commit, exported)
+        self.assertHasObjects(exported, other=False)
@@ -31,6 +31,10 @@ class CacheKeyComputer(object):
                 "USER", "USERNAME"]
         return dict([(k, env[k]) for k in keys])
 
+    def get_filtered_env(self):
+        '''Return the part of the build environment cache keys depend on.'''
+        return self._filterenv(self._build_env.env)
+
     def compute_key(self, source):
         try:
             return self._hashed[source]
@@ -80,7 +84,7 @@ class CacheKeyComputer(object):
 
     def _calculate(self, source):
         keys = {
-            'env': self._filterenv(self._build_env.env),
+            'env': self.get_filtered_env(),
             'kids': [{'artifact': a.name,
                       'cache-key': self.compute_key(a.source)}
                      for a in source.dependencies],
@@ -0,0 +1,272 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import errno
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+import morphlib
+
+
+# Keys of the pax headers that mark a tar file as a manifest, and give
+# the SHA256 of the contents of each file in it.
+MANIFEST_KEY = 'MORPH.manifest'
+BLOB_KEY = 'MORPH.sha256'
+
+
+def is_manifest(f):
+    '''Return whether an open file is a manifest.
+
+    The file position is left unchanged.
+
+    '''
+
+    start = f.tell()
+    head = f.read(2 * tarfile.BLOCKSIZE)
+    f.seek(start)
+    return (len(head) > 156 and head[156] == tarfile.XGLTYPE and
+            (MANIFEST_KEY + '=') in head)
+
+
+def _makedirs(dirname):
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise  # pragma: no cover
+
+
+class ContentStore(object):
+
+    '''Store of files named by the SHA256 of their contents.
+
+    Successive builds of a chunk usually produce mostly the same files,
+    so rather than keeping every chunk artifact as a whole tar file, it
+    can be kept as a manifest: a tar file with the same members, except
+    that each regular file with any contents has none, and a pax header
+    with the SHA256 of its contents instead. The contents are kept once
+    in the store, however many manifests use them, as blobs called
+    DIR/ab/cdef..., where abcdef... is their SHA256.
+
+    Nothing records which manifests use each blob, so blobs that are no
+    longer used are found by looking through every manifest, with
+    remove_unused.
+
+    '''
+
+    # Blobs added or reused in the last grace_period seconds are not
+    # removed by remove_unused, as the manifest that uses them may still
+    # be being written.
+    grace_period = 60 * 60
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def _path(self, sha256):
+        return os.path.join(self.dirname, sha256[:2], sha256[2:])
+
+    def add(self, f):
+        '''Store the contents of an open file, and return their SHA256.'''
+
+        _makedirs(self.dirname)
+        fd, tempname = tempfile.mkstemp(dir=self.dirname)
+        try:
+            checksum = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as blob:
+                while True:
+                    data = f.read(65536)
+                    if not data:
+                        break
+                    checksum.update(data)
+                    blob.write(data)
+            sha256 = checksum.hexdigest()
+            path = self._path(sha256)
+            try:
+                # Keep remove_unused from removing the blob before the
+                # manifest that reuses it is saved.
+                os.utime(path, None)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise  # pragma: no cover
+                _makedirs(os.path.dirname(path))
+                os.chmod(tempname, 0o444)
+                os.rename(tempname, path)
+                tempname = None
+        finally:
+            if tempname is not None:
+                os.remove(tempname)
+        return sha256
+
+    def create_manifest(self, f, manifest):
+        '''Store the files of a tar file and write a manifest of it.
+
+        ``f`` is an open tar file, which may be compressed with any of
+        the programs in morphlib.bins.COMPRESSION, and ``manifest`` an
+        open file to write the manifest to.
+
+        '''
+
+        with morphlib.bins.open_tar(f) as tf:
+            out = tarfile.open(fileobj=manifest, mode='w',
+                               format=tarfile.PAX_FORMAT,
+                               pax_headers={MANIFEST_KEY: u'1'})
+            for member in tf:
+                if member.isreg() and member.size > 0:
+                    sha256 = self.add(tf.extractfile(member))
+                    member.pax_headers = dict(member.pax_headers)
+                    member.pax_headers[BLOB_KEY] = unicode(sha256)
+                    member.size = 0
+                out.addfile(member)
+            out.close()
+
+    def rehydrate(self, manifest, f):
+        '''Write the tar file a manifest was made from to an open file.'''
+
+        tf = tarfile.open(fileobj=manifest)
+        try:
+            out = tarfile.open(fileobj=f, mode='w')
+            for member in tf:
+                sha256 = member.pax_headers.get(BLOB_KEY)
+                if sha256 is None:
+                    out.addfile(member)
+                    continue
+                path = self._path(str(sha256))
+                member.size = os.path.getsize(path)
+                with open(path, 'rb') as blob:
+                    out.addfile(member, blob)
+            out.close()
+        finally:
+            tf.close()
+
+    def unpack(self, manifest, dirname):
+        '''Unpack the tar file a manifest was made from into a directory.
+
+        The files are copied straight out of the store, without writing
+        the tar file first.
+
+        '''
+
+        tf = tarfile.open(fileobj=manifest, errorlevel=2)
+        try:
+            makefile = tf.makefile
+
+            def make_stored_file(tarinfo, targetpath):
+                sha256 = tarinfo.pax_headers.get(BLOB_KEY)
+                if sha256 is None:
+                    return makefile(tarinfo, targetpath)
+                with open(self._path(str(sha256)), 'rb') as blob:
+                    with open(targetpath, 'wb') as target:
+                        shutil.copyfileobj(blob, target)
+
+            tf.makefile = make_stored_file
+            morphlib.bins.extract_tar(tf, dirname)
+        finally:
+            tf.close()
+
+    def remove_unused(self, filenames):
+        '''Remove every blob that none of the given manifests use.
+
+        ``filenames`` are the files that may be manifests using the
+        store. Files that are not manifests, or that have gone, are
+        ignored, and none are looked at if the store has never been
+        used. Returns the number of bytes freed.
+
+        '''
+
+        if not os.path.isdir(self.dirname):
+            return 0
+        used = set()
+        for filename in filenames:
+            try:
+                with open(filename, 'rb') as f:
+                    if not is_manifest(f):
+                        continue
+                    tf = tarfile.open(fileobj=f)
+                    used.update(str(member.pax_headers[BLOB_KEY])
+                                for member in tf
+                                if BLOB_KEY in member.pax_headers)
+                    tf.close()
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise  # pragma: no cover
+
+        cutoff = time.time() - self.grace_period
+        freed = 0
+        for prefix in os.listdir(self.dirname):
+            dirname = os.path.join(self.dirname, prefix)
+            # Blobs being added are written to temporary files here.
+            if len(prefix) == 2 and os.path.isdir(dirname):
+                for rest in os.listdir(dirname):
+                    if prefix + rest in used:
+                        continue
+                    path = os.path.join(dirname, rest)
+                    st = os.stat(path)
+                    if st.st_mtime < cutoff:
+                        os.remove(path)
+                        freed += st.st_size
+        return freed
+
+
+class RehydratedFile(object):
+
+    '''The tar file a manifest was made from, as a read-only file.
+
+    The tar file is only written, to an unnamed temporary file, when it
+    is first read, so that it can be unpacked with ``unpack`` without
+    writing it at all. ``name`` is the name of the manifest.
+
+    '''
+
+    def __init__(self, store, manifest):
+        self.name = manifest.name
+        self._store = store
+        self._manifest = manifest
+        self._file = None
+
+    def _rehydrated(self):
+        if self._file is None:
+            f = tempfile.TemporaryFile(dir=self._store.dirname)
+            try:
+                self._store.rehydrate(self._manifest, f)
+            except BaseException:
+                f.close()
+                raise
+            f.seek(0)
+            self._file = f
+        return self._file
+
+    def __getattr__(self, name):
+        return getattr(self._rehydrated(), name)
+
+    def __iter__(self):
+        return iter(self._rehydrated())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def unpack(self, dirname):
+        self._store.unpack(self._manifest, dirname)
+
+    def close(self):
+        self._manifest.close()
+        if self._file is not None:
+            self._file.close()
@@ -0,0 +1,179 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import unittest
+
+import morphlib
+import morphlib.gitdir_tests
+
+
+class ContentStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.store = morphlib.contentstore.ContentStore(
+            os.path.join(self.tempdir, 'blobs'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def path(self, *parts):
+        return os.path.join(self.tempdir, *parts)
+
+    def create_tar(self, name, files):
+        rootdir = self.path(name + '.d')
+        os.mkdir(rootdir)
+        for relname, contents in files:
+            with open(os.path.join(rootdir, relname), 'w') as f:
+                f.write(contents)
+        os.symlink(files[0][0], os.path.join(rootdir, 'link'))
+        filename = self.path(name + '.tar')
+        with open(filename, 'w') as f:
+            tf = tarfile.open(fileobj=f, mode='w')
+            tf.add(rootdir, arcname='.')
+            tf.close()
+        return filename
+
+    def create_manifest(self, tar_filename):
+        manifest = tar_filename + '.manifest'
+        with open(tar_filename) as f, open(manifest, 'w') as m:
+            self.store.create_manifest(f, m)
+        return manifest
+
+    def blobs(self):
+        return sorted(prefix + rest
+                      for prefix in os.listdir(self.store.dirname)
+                      if len(prefix) == 2
+                      for rest in os.listdir(
+                          os.path.join(self.store.dirname, prefix)))
+
+    def members(self, f):
+        tf = tarfile.open(fileobj=f)
+        members = [(m.name, m.type, m.linkname,
+                    tf.extractfile(m).read() if m.isreg() else None)
+                   for m in tf]
+        tf.close()
+        return members
+
+    def test_stores_each_file_once(self):
+        first = self.create_manifest(self.create_tar(
+            'first', [('a', 'same'), ('b', 'first'), ('empty', '')]))
+        second = self.create_manifest(self.create_tar(
+            'second', [('a', 'same'), ('b', 'second'), ('empty', '')]))
+
+        self.assertEqual(len(self.blobs()), 3)
+        for manifest in (first, second):
+            with open(manifest) as f:
+                self.assertTrue(morphlib.contentstore.is_manifest(f))
+                self.assertEqual(f.tell(), 0)
+        with open(self.path('first.tar')) as f:
+            self.assertFalse(morphlib.contentstore.is_manifest(f))
+
+    def test_rehydrates_tar_the_manifest_was_made_from(self):
+        filename = self.create_tar('chunk', [('a', 'aaa'), ('b', 'bbbb')])
+        manifest = self.create_manifest(filename)
+
+        with open(manifest) as m:
+            rehydrated = morphlib.contentstore.RehydratedFile(self.store, m)
+            with rehydrated as f:
+                self.assertEqual(f.name, manifest)
+                members = self.members(f)
+        with open(filename) as f:
+            self.assertEqual(members, self.members(f))
+
+    def test_unpacks_manifest_without_rehydrating_it(self):
+        filename = self.create_tar('chunk', [('a', 'aaa'), ('b', 'bbbb'),
+                                             ('empty', '')])
+        manifest = self.create_manifest(filename)
+        unpacked = self.path('unpacked')
+        os.mkdir(unpacked)
+
+        with open(manifest) as m:
+            rehydrated = morphlib.contentstore.RehydratedFile(self.store, m)
+            morphlib.bins.unpack_binary_from_file(rehydrated, unpacked)
+            self.assertEqual(rehydrated._file, None)
+
+        self.assertEqual(sorted(os.listdir(unpacked)),
+                         ['a', 'b', 'empty', 'link'])
+        with open(os.path.join(unpacked, 'b')) as f:
+            self.assertEqual(f.read(), 'bbbb')
+        self.assertEqual(os.path.getsize(os.path.join(unpacked, 'empty')), 0)
+        self.assertEqual(os.readlink(os.path.join(unpacked, 'link')), 'a')
+
+    def test_removes_old_blobs_no_manifest_uses(self):
+        first = self.create_manifest(self.create_tar(
+            'first', [('a', 'same'), ('b', 'first')]))
+        second = self.create_manifest(self.create_tar(
+            'second', [('a', 'same'), ('b', 'second')]))
+        self.assertEqual(len(self.blobs()), 3)
+
+        # Files that are not manifests are ignored, as are files in the
+        # store that are not blobs.
+        open(os.path.join(self.store.dirname, 'tmpXYZ'), 'w').close()
+        first_tar = self.path('first.tar')
+        later = time.time() + self.store.grace_period + 1
+        self.assertEqual(
+            self.store.remove_unused([first_tar, first, second]), 0)
+        with morphlib.gitdir_tests.monkeypatch(time, 'time', lambda: later):
+            self.assertEqual(self.store.remove_unused([first, second]), 0)
+            os.remove(second)
+            self.assertEqual(
+                self.store.remove_unused([first, second]), len('second'))
+        self.assertEqual(len(self.blobs()), 2)
+
+        with open(first) as m:
+            rehydrated = morphlib.contentstore.RehydratedFile(self.store, m)
+            self.assertEqual(sorted(contents for name, t, l, contents
+                                    in self.members(rehydrated) if contents),
+                             ['first', 'same'])
+
+    def test_keeps_new_blobs_no_manifest_uses(self):
+        self.create_manifest(self.create_tar('chunk', [('a', 'aaa')]))
+        self.assertEqual(self.store.remove_unused([]), 0)
+        self.assertEqual(len(self.blobs()), 1)
+
+    def test_does_not_look_at_manifests_if_store_is_unused(self):
+        def filenames():
+            raise AssertionError('Manifests were looked at')
+            yield
+        self.assertEqual(self.store.remove_unused(filenames()), 0)
+
+    def test_reads_rehydrated_file_by_line(self):
+        manifest = self.create_manifest(self.create_tar(
+            'chunk', [('a', 'aaa\nbbb\n')]))
+
+        with open(manifest) as m:
+            rehydrated = morphlib.contentstore.RehydratedFile(self.store, m)
+            with rehydrated as f:
+                contents = f.read()
+                f.seek(0)
+                self.assertEqual(''.join(f), contents)
+
+    def test_fails_to_rehydrate_manifest_with_missing_blob(self):
+        manifest = self.create_manifest(self.create_tar(
+            'chunk', [('a', 'aaa')]))
+        shutil.rmtree(self.store.dirname)
+        os.mkdir(self.store.dirname)
+
+        with open(manifest) as m:
+            rehydrated = morphlib.contentstore.RehydratedFile(self.store, m)
+            self.assertRaises(OSError, lambda: rehydrated.read())
+            self.assertEqual(rehydrated._file, None)
+            rehydrated.close()
@@ -15,9 +15,11 @@
 
 import cliapp
 import ConfigParser
+import errno
 import logging
 import os
 import re
+import shutil
 import string
 import StringIO
 import sys
@@ -233,6 +235,8 @@ def copy_repository(runcmd, repo, destdir, is_mirror=True):
         return
 
     runcmd(['cp', '-a', repo, os.path.join(destdir, '.git')])
+    # the copy must not depend on an object pool outside the build dir
+    take_alternate_objects(runcmd, os.path.join(destdir, '.git'))
     # core.bare should be false so that git believes work trees are possible
     gitcmd(runcmd, 'config', 'core.bare', 'false', cwd=destdir)
     # we do not want the origin remote to behave as a mirror for pulls
@@ -252,7 +256,7 @@ def copy_repository(runcmd, repo, destdir, is_mirror=True):
     with open(os.path.join(destdir, ".git", "packed-refs"), "w") as ref_fh:
         ref_fh.write(pack_lines.pop(0) + "\n")
         for refline in pack_lines:
-            if ' refs/remotes/' in refline:
+            if not refline or ' refs/remotes/' in refline:
                 continue
             if ' refs/heads/' in refline:
                 sha, ref = refline[:40], refline[41:]
@@ -264,6 +268,138 @@ def copy_repository(runcmd, repo, destdir, is_mirror=True):
     gitcmd(runcmd, 'remote', 'update', 'origin', '--prune', cwd=destdir)
 
 
+def link_repository(runcmd, repo, destdir, commit, is_mirror=True):
+    '''Make a .git in a directory that shares a cached repo's objects.
+
+    The result is like what copy_repository and a checkout of 'commit'
+    give, with HEAD detached at the commit, but the objects are hard
+    linked rather than copied, with link_objects, and the index is set
+    to the commit's tree without any files being written. Any objects
+    the cached repo borrows from an object pool are then taken into the
+    .git, as copy_repository does.
+    Git will see the files as changed until it refreshes the index,
+    which 'git status' and 'git describe --dirty' do by themselves.
+
+    '''
+    source_gitdir = repo if is_mirror else os.path.join(repo, '.git')
+    gitdir = os.path.join(destdir, '.git')
+    gitcmd(runcmd, 'init', '--quiet', destdir)
+    link_objects(os.path.join(source_gitdir, 'objects'), gitdir)
+    alternates = get_alternates(source_gitdir)
+    if alternates:
+        set_alternates(gitdir, alternates)
+    # a traditional refs/heads -> refs/remotes/origin ref mapping
+    refs = {}
+    output = gitcmd(runcmd, 'for-each-ref',
+                    '--format=%(objectname) %(refname)', cwd=repo)
+    for line in output.splitlines():
+        sha1, ref = line.split(' ', 1)
+        if ref.startswith('refs/remotes/'):
+            continue
+        if ref.startswith('refs/heads/'):
+            ref = 'refs/remotes/origin/' + ref[len('refs/heads/'):]
+        refs[ref] = sha1
+    with open(os.path.join(gitdir, 'packed-refs'), 'w') as f:
+        for ref in sorted(refs):
+            f.write('%s %s\n' % (refs[ref], ref))
+    gitcmd(runcmd, 'config', 'remote.origin.url', repo, cwd=destdir)
+    gitcmd(runcmd, 'config', 'remote.origin.fetch',
+           '+refs/heads/*:refs/remotes/origin/*', cwd=destdir)
+    with open(os.path.join(gitdir, 'HEAD'), 'w') as f:
+        f.write('%s\n' % commit)
+    gitcmd(runcmd, 'read-tree', commit, cwd=destdir)
+    take_alternate_objects(runcmd, gitdir)
+
+
+def init_object_pool(runcmd, pool):
+    '''Create a bare repository for others to share objects through.'''
+    if os.path.exists(pool):
+        return
+    gitcmd(runcmd, 'init', '--quiet', '--bare', pool)
+    # keep everything fetched as packs, which copies can link to
+    gitcmd(runcmd, 'config', 'transfer.unpackLimit', '1', cwd=pool)
+
+
+def get_alternates(gitdir):
+    '''Return the object directories a repository borrows objects from.'''
+    objects = os.path.join(gitdir, 'objects')
+    try:
+        with open(os.path.join(objects, 'info', 'alternates')) as f:
+            lines = f.read().splitlines()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+    return [os.path.join(objects, line) for line in lines
+            if line and not line.startswith('#')]
+
+
+def set_alternates(gitdir, object_dirs):
+    '''Make a repository borrow objects from other object directories.'''
+    with open(os.path.join(gitdir, 'objects', 'info', 'alternates'),
+              'w') as f:
+        for object_dir in object_dirs:
+            f.write('%s\n' % object_dir)
+
+
+def link_objects(object_dir, gitdir, copy=True):
+    '''Give a repository the objects of an object directory.
+
+    The files of the object directory are hard linked into the
+    repository, or copied if they are on another filesystem and 'copy'
+    is set. Object files never change once written, so they can safely
+    be shared. Objects the directory's repository borrows through its
+    alternates are not linked.
+
+    '''
+    objects = os.path.join(gitdir, 'objects')
+    for dirname, subdirs, filenames in os.walk(object_dir):
+        relative = os.path.relpath(dirname, object_dir)
+        if relative == '.':
+            subdirs[:] = [d for d in subdirs if d != 'info']
+        target_dir = os.path.normpath(os.path.join(objects, relative))
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        for filename in filenames:
+            # files being written by git are not objects yet
+            if filename.startswith('tmp_'):
+                continue
+            source = os.path.join(dirname, filename)
+            target = os.path.join(target_dir, filename)
+            if os.path.exists(target):
+                continue
+            try:
+                os.link(source, target)
+            except OSError as e:
+                if e.errno != errno.EXDEV or not copy:
+                    raise
+                shutil.copy2(source, target)
+
+
+def take_alternate_objects(runcmd, gitdir):
+    '''Give a repository its own copy of the objects it borrows.
+
+    The files of the object directories it borrows from are hard linked
+    into the repository, which costs the same however many objects they
+    hold. If they are on another filesystem, copying them all would be
+    too much, as they may be an object pool shared by every cached repo,
+    so only the objects reachable from the repository's refs, HEAD and
+    index are packed into it instead. Its alternates are then dropped.
+
+    '''
+    alternates = get_alternates(gitdir)
+    if not alternates:
+        return
+    try:
+        for object_dir in alternates:
+            link_objects(object_dir, gitdir, copy=False)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        gitcmd(runcmd, 'repack', '-a', '-d', '-q', cwd=gitdir)
+    os.remove(os.path.join(gitdir, 'objects', 'info', 'alternates'))
+
+
 def reset_workdir(runcmd, gitdir):
     '''Removes any differences between the current commit '''
     '''and the status of the working directory'''
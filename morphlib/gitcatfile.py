@@ -0,0 +1,212 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import binascii
+import logging
+import os
+import subprocess
+import threading
+
+import cliapp
+
+
+# Any well-formed object name will do to check that a cat-file process
+# answers queries as expected. This is the empty tree.
+_PROBE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+
+class CatFileUnavailableError(cliapp.AppException):
+
+    def __init__(self, dirname, reason):
+        cliapp.AppException.__init__(
+            self, 'Cannot read objects from %s with git cat-file: %s' %
+            (dirname, reason))
+
+
+class _BatchProcess(object):
+
+    '''One running ``git cat-file --batch`` or ``--batch-check``.'''
+
+    def __init__(self, dirname, option):
+        self.dirname = dirname
+        self.option = option
+        env = dict(os.environ)
+        # As in morphlib.git.gitcmd, git replace must not change what a
+        # SHA1 refers to.
+        env['GIT_NO_REPLACE_OBJECTS'] = '1'
+        with open(os.devnull, 'w') as devnull:
+            try:
+                self.process = subprocess.Popen(
+                    ['git', 'cat-file', option], cwd=dirname, env=env,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=devnull, close_fds=True)
+            except OSError as e:
+                raise CatFileUnavailableError(dirname, e)
+
+    def query(self, name):
+        '''Ask about an object, returning the header line of the answer.
+
+        Raises IOError if the process has gone away or answers with
+        something that isn't a header line.
+
+        '''
+
+        self.process.stdin.write(name + '\n')
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line.endswith('\n'):
+            raise IOError('git cat-file %s exited unexpectedly' % self.option)
+        fields = line[:-1].split(' ')
+        if fields[-1] in ('missing', 'ambiguous'):
+            return None
+        if len(fields) != 3 or len(fields[0]) != 40 or \
+                not fields[2].isdigit():
+            raise IOError('Unexpected output from git cat-file %s: %r' %
+                          (self.option, line))
+        return fields[0], fields[1], int(fields[2])
+
+    def read_contents(self, size):
+        data = self.process.stdout.read(size + 1)
+        if len(data) != size + 1:
+            raise IOError('git cat-file %s exited unexpectedly' % self.option)
+        return data[:-1]
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except IOError:  # pragma: no cover
+            pass
+        self.process.wait()
+        self.process.stdout.close()
+
+
+class CatFile(object):
+
+    '''Look up objects in a repository with long-lived git processes.
+
+    Running a new git command for every object that is looked up costs
+    far more than looking the object up, so this keeps one
+    ``git cat-file --batch-check`` and one ``git cat-file --batch``
+    process running for the repository, started when they are first
+    needed, and sends them each query in turn.
+
+    Objects are named as they would be for ``git rev-parse``, so names
+    like ``master^{tree}`` and ``<tree>:path/to/file`` work.
+
+    CatFileUnavailableError is raised when a process is started if it
+    does not answer queries as expected, for example because git is too
+    old to support it. Errors talking to a process once it is running
+    are raised as IOError. Either way, the CatFile can no longer be
+    used, and the caller should fall back to running git commands.
+
+    A CatFile may be used from several threads. It must be closed once
+    it is no longer needed, so that the git processes exit.
+
+    '''
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self._lock = threading.Lock()
+        self._processes = {}
+        self._closed = False
+
+    @staticmethod
+    def can_look_up(name):
+        '''Whether an object name can be sent to git cat-file.'''
+        return name and '\n' not in name and not name.startswith('-')
+
+    def _process(self, option):
+        if self._closed:
+            raise IOError('CatFile for %s is closed' % self.dirname)
+        process = self._processes.get(option)
+        if process is None:
+            process = _BatchProcess(self.dirname, option)
+            try:
+                header = process.query(_PROBE)
+                if header is not None and option == '--batch':
+                    process.read_contents(header[2])
+            except IOError as e:
+                process.close()
+                raise CatFileUnavailableError(self.dirname, e)
+            logging.debug('Started git cat-file %s in %s' %
+                          (option, self.dirname))
+            self._processes[option] = process
+        return process
+
+    def _query(self, option, name, read_contents):
+        with self._lock:
+            process = self._process(option)
+            try:
+                header = process.query(name)
+                if header is None or not read_contents:
+                    return header
+                sha1, kind, size = header
+                return sha1, kind, process.read_contents(size)
+            except IOError:
+                self._close()
+                raise
+
+    def info(self, name):
+        '''Return the SHA1, type and size of an object.
+
+        Returns None if there is no such object.
+
+        '''
+
+        return self._query('--batch-check', name, False)
+
+    def read(self, name):
+        '''Return the SHA1, type and contents of an object.
+
+        Returns None if there is no such object.
+
+        '''
+
+        return self._query('--batch', name, True)
+
+    def read_tree(self, name):
+        '''Return the entries of a tree as (mode, name, SHA1) tuples.
+
+        Returns None if there is no such object, and raises ValueError if
+        the object isn't a tree.
+
+        '''
+
+        obj = self.read(name)
+        if obj is None:
+            return None
+        sha1, kind, data = obj
+        if kind != 'tree':
+            raise ValueError('%s is a %s, not a tree' % (name, kind))
+        entries = []
+        pos = 0
+        while pos < len(data):
+            space = data.index(' ', pos)
+            nul = data.index('\0', space)
+            entries.append((data[pos:space], data[space + 1:nul],
+                            binascii.hexlify(data[nul + 1:nul + 21])))
+            pos = nul + 21
+        return entries
+
+    def _close(self):
+        for process in self._processes.itervalues():
+            process.close()
+        self._processes = {}
+        self._closed = True
+
+    def close(self):
+        '''Make the git processes exit.'''
+        with self._lock:
+            self._close()
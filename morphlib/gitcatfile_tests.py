@@ -0,0 +1,128 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+import morphlib.gitdir_tests
+
+
+class CatFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tempdir, 'repo')
+        os.mkdir(self.dirname)
+        gd = morphlib.gitdir.init(self.dirname)
+        os.mkdir(os.path.join(self.dirname, 'dir'))
+        for filename in ('foo', 'dir/bar'):
+            with open(os.path.join(self.dirname, filename), 'w') as f:
+                f.write('contents of %s\n' % filename)
+        morphlib.git.gitcmd(gd._runcmd, 'add', '.')
+        morphlib.git.gitcmd(gd._runcmd, 'commit', '-m', 'Initial commit')
+        self.tree = gd.resolve_ref_to_tree('HEAD')
+        self.cat_file = morphlib.gitcatfile.CatFile(self.dirname)
+
+    def tearDown(self):
+        self.cat_file.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_resolves_ref(self):
+        sha1, kind, size = self.cat_file.info('master^{tree}')
+        self.assertEqual(sha1, self.tree)
+        self.assertEqual(kind, 'tree')
+
+    def test_returns_none_for_missing_object(self):
+        self.assertEqual(self.cat_file.info('no-such-ref'), None)
+        self.assertEqual(self.cat_file.read('master:no-such-file'), None)
+
+    def test_reads_blobs(self):
+        sha1, kind, data = self.cat_file.read('master:dir/bar')
+        self.assertEqual(kind, 'blob')
+        self.assertEqual(data, 'contents of dir/bar\n')
+        sha1, kind, data = self.cat_file.read('master:foo')
+        self.assertEqual(data, 'contents of foo\n')
+
+    def test_reads_trees(self):
+        entries = self.cat_file.read_tree(self.tree)
+        self.assertEqual([(mode, name) for mode, name, sha1 in entries],
+                         [('40000', 'dir'), ('100644', 'foo')])
+        self.assertEqual(entries[0][2], self.cat_file.info('master:dir')[0])
+
+    def test_refuses_to_read_blob_as_tree(self):
+        self.assertRaises(ValueError, self.cat_file.read_tree, 'master:foo')
+
+    def test_can_only_look_up_names_git_would_not_misread(self):
+        CatFile = morphlib.gitcatfile.CatFile
+        self.assertTrue(CatFile.can_look_up('master:foo'))
+        self.assertFalse(CatFile.can_look_up(''))
+        self.assertFalse(CatFile.can_look_up('foo\nbar'))
+        self.assertFalse(CatFile.can_look_up('--batch'))
+
+    def test_cannot_be_used_once_closed(self):
+        self.cat_file.info('master')
+        self.cat_file.close()
+        self.assertRaises(IOError, self.cat_file.info, 'master')
+
+    def fake_git(self, script):
+        bindir = os.path.join(self.tempdir, 'bin')
+        os.mkdir(bindir)
+        if script is not None:
+            git = os.path.join(bindir, 'git')
+            with open(git, 'w') as f:
+                f.write('#!/bin/sh\n' + script)
+            os.chmod(git, 0o755)
+        return morphlib.gitdir_tests.monkeypatch(os, 'environ',
+                                                 dict(os.environ,
+                                                      PATH=bindir))
+
+    def test_is_unavailable_if_git_does_not_support_it(self):
+        with self.fake_git('echo "usage: git cat-file" >&2\nexit 129\n'):
+            self.assertRaises(morphlib.gitcatfile.CatFileUnavailableError,
+                              self.cat_file.info, 'master')
+
+    def test_is_unavailable_if_git_is_not_installed(self):
+        with self.fake_git(None):
+            self.assertRaises(morphlib.gitcatfile.CatFileUnavailableError,
+                              self.cat_file.info, 'master')
+
+    def test_is_unavailable_if_git_answers_with_garbage(self):
+        with self.fake_git('read name\necho garbage\n'):
+            self.assertRaises(morphlib.gitcatfile.CatFileUnavailableError,
+                              self.cat_file.info, 'master')
+
+    def test_is_unavailable_if_git_exits_while_writing_contents(self):
+        with self.fake_git('read name\necho "$name tree 10"\n'):
+            self.assertRaises(morphlib.gitcatfile.CatFileUnavailableError,
+                              self.cat_file.read, 'master')
+
+    def test_reads_contents_of_probe_before_queries(self):
+        with self.fake_git('while read name; do\n'
+                           '    echo "$name blob 0"\n'
+                           '    echo\n'
+                           'done\n'):
+            self.assertEqual(self.cat_file.read(self.tree),
+                             (self.tree, 'blob', ''))
+
+    def test_cannot_be_used_once_git_exits(self):
+        with self.fake_git('read name\necho "$name missing"\n'):
+            self.assertRaises(IOError, self.cat_file.info, 'master')
+        self.assertRaises(IOError, self.cat_file.info, 'master')
+
+    def test_returns_none_for_missing_tree(self):
+        self.assertEqual(self.cat_file.read_tree('no-such-ref'), None)
@@ -17,8 +17,11 @@
 
 import cliapp
 import itertools
+import logging
 import os
 import re
+import stat
+import threading
 
 import morphlib
 
@@ -366,13 +369,18 @@ class GitDirectory(object):
 
     '''
 
-    def __init__(self, dirname, search_for_root=False):
+    def __init__(self, dirname, search_for_root=False, cat_file=False):
         '''Set up a GitDirectory instance for the repository at 'dirname'.
 
         If 'search_for_root' is set to True, 'dirname' may point to a
         subdirectory inside the working tree of repository. Otherwise 'dirname'
         must be the top directory.
 
+        If 'cat_file' is set to True, objects are read, and refs resolved,
+        by long-lived `git cat-file` processes rather than by running a
+        git command each time, as long as git supports it. The close()
+        method must be called once the GitDirectory is no longer needed.
+
         '''
 
         if search_for_root:
@@ -380,9 +388,66 @@ class GitDirectory(object):
 
         self.dirname = dirname
         self._config = {}
+        self._use_cat_file = cat_file
+        self._cat_file = None
+        self._cat_file_lock = threading.Lock()
+        self._trees = {}
 
         self._ensure_is_git_repo()
 
+    def _cat_file_for(self, name):
+        '''Return the CatFile to look up an object with, or None.
+
+        None is returned if the object should be looked up by running a
+        git command instead.
+
+        '''
+
+        if not self._use_cat_file or \
+                not morphlib.gitcatfile.CatFile.can_look_up(name):
+            return None
+        with self._cat_file_lock:
+            if self._cat_file is None:
+                self._cat_file = morphlib.gitcatfile.CatFile(self.dirname)
+            return self._cat_file
+
+    def _cat_file_failed(self, e):
+        logging.warning('Not using git cat-file for %s any more: %s' %
+                        (self.dirname, e))
+        self._use_cat_file = False
+        self.close()
+
+    def _cat_file_query(self, name, method):
+        '''Look up an object with git cat-file, if possible.
+
+        Returns a tuple of whether the object could be looked up and the
+        result of calling the CatFile method on it.
+
+        '''
+
+        cat_file = self._cat_file_for(name)
+        if cat_file is None:
+            return False, None
+        try:
+            return True, method(cat_file, name)
+        except (IOError, morphlib.gitcatfile.CatFileUnavailableError) as e:
+            self._cat_file_failed(e)
+            return False, None
+
+    def close(self):
+        '''Stop any git processes kept running for this repository.
+
+        They are started again if they are needed later. Trees that have
+        been read are forgotten.
+
+        '''
+
+        with self._cat_file_lock:
+            if self._cat_file is not None:
+                self._cat_file.close()
+                self._cat_file = None
+            self._trees = {}
+
     def _runcmd(self, argv, **kwargs):
         '''Run a command at the root of the git directory.
 
@@ -459,6 +524,13 @@ class GitDirectory(object):
 
     def get_blob_contents(self, blob_id): # pragma: no cover
         '''Get file contents from git by ID'''
+        looked_up, obj = self._cat_file_query(
+            blob_id, morphlib.gitcatfile.CatFile.read)
+        if looked_up:
+            if obj is None or obj[1] != 'blob':
+                raise cliapp.AppException(
+                    'Blob %s does not exist in %s' % (blob_id, self.dirname))
+            return obj[2]
         return morphlib.git.gitcmd(self._runcmd, 'cat-file', 'blob', blob_id)
 
     def get_commit_contents(self, commit_id): # pragma: no cover
@@ -530,6 +602,12 @@ class GitDirectory(object):
             return self._list_files_in_ref(ref, recurse)
 
     def _rev_parse(self, ref):
+        looked_up, info = self._cat_file_query(
+            ref, morphlib.gitcatfile.CatFile.info)
+        if looked_up:
+            if info is None:
+                raise InvalidRefError(self, ref)
+            return info[0]
         try:
             return morphlib.git.gitcmd(self._runcmd, 'rev-parse',
                                        '--verify', ref).strip()
@@ -591,6 +669,12 @@ class GitDirectory(object):
     def _list_files_in_ref(self, ref, recurse=True):
         tree = self.resolve_ref_to_tree(ref)
 
+        looked_up, paths = self._cat_file_query(
+            tree, lambda cat_file, tree: list(
+                self._walk_tree(cat_file, tree, '', recurse)))
+        if looked_up:
+            return paths
+
         command = ['ls-tree', '--name-only', '-z']
         if recurse:
             command.append('-r')
@@ -602,9 +686,100 @@ class GitDirectory(object):
         paths = output.strip('\0').split('\0')
         return paths
 
-    def read_file(self, filename, ref=None):
+    def _walk_tree(self, cat_file, tree, prefix, recurse):
+        '''List a tree read by git cat-file as `git ls-tree` would.'''
+        for mode, name, sha1 in cat_file.read_tree(tree):
+            if recurse and mode == '40000':
+                for path in self._walk_tree(cat_file, sha1,
+                                            prefix + name + '/', recurse):
+                    yield path
+            else:
+                yield prefix + name
+
+    def _read_tree(self, tree):
+        '''Return a dict of the entries of a tree, by name.
+
+        The values are (mode, SHA1) tuples, with modes as integers. Trees
+        are remembered until the GitDirectory is closed, because reading
+        many files from one directory would otherwise read its tree for
+        every file.
+
+        '''
+
+        with self._cat_file_lock:
+            if tree in self._trees:
+                return self._trees[tree]
+        looked_up, entries = self._cat_file_query(
+            tree, morphlib.gitcatfile.CatFile.read_tree)
+        if not looked_up:
+            output = morphlib.git.gitcmd(self._runcmd, 'ls-tree', '-z', tree)
+            entries = []
+            for line in output.strip('\0').split('\0'):
+                if line:
+                    info, name = line.split('\t', 1)
+                    mode, kind, sha1 = info.split(' ')
+                    entries.append((mode, name, sha1))
+        result = dict((name, (int(mode, 8), sha1))
+                      for mode, name, sha1 in entries)
+        with self._cat_file_lock:
+            self._trees[tree] = result
+        return result
+
+    def _read_file_following_symlinks(self, tree, filename):
+        '''Read a file from a tree as it would be read from a checkout.
+
+        Symbolic links are followed, and must stay within the tree:
+        absolute ones are taken to be relative to the top of the tree.
+
+        '''
+
+        def error(reason):
+            return IOError('Cannot read %s in tree %s of repo %s: %s' %
+                           (filename, tree, self, reason))
+
+        def split(path):
+            return [part for part in path.split('/') if part not in ('', '.')]
+
+        remaining = split(filename)
+        # The trees of the directories leading to the current one.
+        parents = []
+        current = tree
+        links_followed = 0
+        while remaining:
+            name = remaining.pop(0)
+            if name == '..':
+                current = parents.pop() if parents else tree
+                continue
+            entries = self._read_tree(current)
+            if name not in entries:
+                raise error('%s does not exist' % name)
+            mode, sha1 = entries[name]
+            if stat.S_ISLNK(mode):
+                links_followed += 1
+                if links_followed > 40:
+                    raise error('too many levels of symbolic links')
+                target = self.get_blob_contents(sha1)
+                if target.startswith('/'):
+                    parents = []
+                    current = tree
+                remaining[:0] = split(target)
+            elif stat.S_ISDIR(mode):
+                parents.append(current)
+                current = sha1
+            elif not stat.S_ISREG(mode):
+                raise error('%s is not a file' % name)
+            elif remaining:
+                raise error('%s is not a directory' % name)
+            else:
+                return self.get_blob_contents(sha1)
+        raise error('not a file')
+
+    def read_file(self, filename, ref=None, follow_symlinks=False):
         '''Attempts to read a file, from the working tree or a given ref.
 
+        If `follow_symlinks` is True, symbolic links in a ref are followed
+        as they would be in a checkout of it.
+
         Raises an InvalidRefError if the ref is not found in the repository.
         Raises an IOError if the requested file is not found in the ref.
 
@@ -616,6 +791,8 @@ class GitDirectory(object):
             with open(os.path.join(self.dirname, filename)) as f:
                 return f.read()
         tree = self.resolve_ref_to_tree(ref)
+        if follow_symlinks:
+            return self._read_file_following_symlinks(tree, filename)
         try:
             return self.get_file_from_ref(tree, filename)
         except cliapp.AppException:
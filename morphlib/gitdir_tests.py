@@ -265,6 +265,111 @@ class GitDirectoryContentsTests(unittest.TestCase):
         self.assertEqual(gd.describe(), 'example')
 
 
+class GitDirectoryCatFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tempdir, 'foo')
+        os.mkdir(self.dirname)
+        gd = morphlib.gitdir.init(self.dirname)
+        os.mkdir(os.path.join(self.dirname, 'strata'))
+        for fn in ('foo', 'bar.morph', 'strata/baz.morph'):
+            with open(os.path.join(self.dirname, fn), "w") as f:
+                f.write('dummy morphology text')
+        morphlib.git.gitcmd(gd._runcmd, 'add', '.')
+        morphlib.git.gitcmd(gd._runcmd, 'commit', '-m', 'Initial commit')
+        self.plain = morphlib.gitdir.GitDirectory(self.dirname)
+        self.gd = morphlib.gitdir.GitDirectory(self.dirname, cat_file=True)
+
+    def tearDown(self):
+        self.gd.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_lists_files_like_git_ls_tree(self):
+        for recurse in (True, False):
+            self.assertEqual(list(self.gd.list_files('HEAD', recurse)),
+                             list(self.plain.list_files('HEAD', recurse)))
+
+    def test_reads_file(self):
+        self.assertEqual(self.gd.read_file('strata/baz.morph', 'master'),
+                         'dummy morphology text')
+
+    def test_resolves_refs(self):
+        self.assertEqual(self.gd.resolve_ref_to_commit('master'),
+                         self.plain.resolve_ref_to_commit('master'))
+        self.assertEqual(self.gd.resolve_ref_to_tree('master'),
+                         self.plain.resolve_ref_to_tree('master'))
+
+    def test_read_raises_invalid_ref(self):
+        self.assertRaises(morphlib.gitdir.InvalidRefError,
+                          self.gd.read_file, 'foo', 'no-such-ref')
+
+    def test_read_raises_io_error(self):
+        self.assertRaises(IOError, self.gd.read_file, 'no-such-file', 'HEAD')
+        self.assertRaises(IOError, self.gd.read_file, 'strata', 'HEAD')
+
+    def test_falls_back_when_cat_file_is_unavailable(self):
+        def unavailable(cat_file, name):
+            raise morphlib.gitcatfile.CatFileUnavailableError(
+                cat_file.dirname, 'git is too old')
+        with monkeypatch(morphlib.gitcatfile.CatFile, 'info', unavailable):
+            self.assertEqual(self.gd.read_file('foo', 'master'),
+                             'dummy morphology text')
+
+
+class GitDirectoryFollowSymlinksTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tempdir, 'definitions')
+        os.mkdir(self.dirname)
+        gd = morphlib.gitdir.init(self.dirname)
+        os.mkdir(os.path.join(self.dirname, 'strata'))
+        with open(os.path.join(self.dirname, 'strata', 'core.morph'),
+                  'w') as f:
+            f.write('core')
+        for link, target in [('core.morph', 'strata/core.morph'),
+                             ('absolute.morph', '/strata/core.morph'),
+                             ('parent.morph', 'strata/../strata/core.morph'),
+                             ('old-strata', 'strata'),
+                             ('dangling.morph', 'missing.morph'),
+                             ('loop.morph', 'loop.morph')]:
+            os.symlink(target, os.path.join(self.dirname, link))
+        morphlib.git.gitcmd(gd._runcmd, 'add', '.')
+        morphlib.git.gitcmd(gd._runcmd, 'update-index', '--add',
+                            '--cacheinfo', '160000', '1' * 40, 'submodule')
+        morphlib.git.gitcmd(gd._runcmd, 'commit', '-m', 'Initial commit')
+        self.gds = [morphlib.gitdir.GitDirectory(self.dirname),
+                    morphlib.gitdir.GitDirectory(self.dirname, cat_file=True)]
+
+    def tearDown(self):
+        for gd in self.gds:
+            gd.close()
+        shutil.rmtree(self.tempdir)
+
+    def read(self, filename):
+        results = [gd.read_file(filename, 'master', follow_symlinks=True)
+                   for gd in self.gds]
+        self.assertEqual(results[0], results[1])
+        return results[0]
+
+    def test_reads_files_like_a_checkout(self):
+        for filename in ('strata/core.morph', 'core.morph', 'parent.morph',
+                         'old-strata/core.morph'):
+            self.assertEqual(self.read(filename), 'core')
+
+    def test_follows_absolute_symlinks_within_the_tree(self):
+        self.assertEqual(self.read('absolute.morph'), 'core')
+
+    def test_raises_io_error_for_unreadable_files(self):
+        for filename in ('missing.morph', 'dangling.morph', 'loop.morph',
+                         'strata', 'old-strata', 'strata/..',
+                         'core.morph/foo', 'submodule', 'submodule/foo'):
+            for gd in self.gds:
+                self.assertRaises(IOError, gd.read_file, filename, 'master',
+                                  follow_symlinks=True)
+
+
 class GitDirectoryFileTypeTests(unittest.TestCase):
 
     def setUp(self):
@@ -14,10 +14,51 @@
 
 
 import collections
+import errno
 import os
+import re
+import sqlite3
+import threading
 import time
 
 import morphlib
+import morphlib.contentstore
+import morphlib.savefile
+
+
+class _IndexedSaveFile(morphlib.savefile.SaveFile):
+
+    '''A SaveFile that adds itself to a cache's index once it is saved.'''
+
+    def __init__(self, cache, filename, *args, **kwargs):
+        self._cache = cache
+        morphlib.savefile.SaveFile.__init__(self, filename, *args, **kwargs)
+
+    def close(self):
+        ret = morphlib.savefile.SaveFile.close(self)
+        self._cache.add_file(self.real_filename)
+        return ret
+
+
+class _DeduplicatedSaveFile(_IndexedSaveFile):
+
+    '''A SaveFile that is saved as a manifest of a cache's content store.'''
+
+    def close(self):
+        ret = file.close(self)
+        try:
+            manifest = morphlib.savefile.SaveFile(self.real_filename, 'wb')
+            try:
+                with open(self._savefile_tempname, 'rb') as f:
+                    self._cache.content_store.create_manifest(f, manifest)
+            except BaseException:
+                manifest.abort()
+                raise
+            manifest.close()
+        finally:
+            os.remove(self._savefile_tempname)
+        self._cache.add_file(self.real_filename)
+        return ret
 
 
 class LocalArtifactCache(object):
@@ -26,11 +67,39 @@ class LocalArtifactCache(object):
        It provides methods for getting a file handle to cached artifacts
        so that the layout of the cache need not be known.
 
-       It also updates modification times of artifacts so that it can track
-       when they were last used, so it can be requested to clean up if
-       disk space is low.
-
-       Modification time is updated in both the get and has methods.
+       It also keeps an index of the files in the cache, recording the
+       cache key, size and time of last use of each, so it can be
+       requested to clean up if disk space is low, without looking at
+       every file in the cache. The index is an SQLite database in the
+       cache directory. Files are added to it when they are saved by the
+       put methods, and the last use time is updated in both the get and
+       has methods. Files written to the cache directory in any other way
+       must be recorded with add_file. A cache directory with no index
+       is indexed when it is first used.
+
+       The first use of each file is written to the index straight away,
+       so that another process cleaning up the cache sees that it is in
+       use, but later uses are only remembered, and written all at once
+       when flush is called, when the cache is listed or cleaned up, or
+       when a file is used after flush_interval seconds have passed since
+       the last write.
+
+       Files can be kept in one of two layouts. In the flat layout they
+       are all in the cache directory itself. In the sharded layout each
+       is in a subdirectory named after the first two pairs of characters
+       of its cache key, such as ab/cd/abcd..., which keeps directories
+       small enough to list quickly when the cache holds many files. New
+       files are saved in the cache's own layout, but files in the other
+       layout are still found, and migrate moves them across while the
+       cache is in use.
+
+       If deduplicate is set, chunk artifacts are saved as manifests of a
+       content store kept in the .blobs subdirectory, so files which are
+       the same in several chunk artifacts are only stored once. The get
+       method returns the tar file a manifest was made from, which is
+       only written out if it is read rather than unpacked. Blobs that no
+       artifact uses any more are removed by remove_unused_blobs. Chunk
+       artifacts in either form are read whatever deduplicate is set to.
 
        NOTE: Parts of the build assume that every artifact of a source is
        available, so all the artifacts of a source need to be removed together.
@@ -44,24 +113,174 @@ class LocalArtifactCache(object):
        sense to put the complication there.
        '''
 
-    def __init__(self, cachefs):
+    index_filename = '.index.sqlite'
+
+    # How long to wait for another process to finish writing the index.
+    index_timeout = 60
+
+    # How long later uses of files may go unwritten, in seconds.
+    flush_interval = 60
+
+    layouts = ('flat', 'sharded')
+
+    blob_dirname = '.blobs'
+
+    # Names of files kept in the cache, as opposed to temporary files.
+    _cache_file_pattern = re.compile(r'^[0-9a-f]{64}\.')
+
+    # Names of chunk artifacts, which may be manifests.
+    _chunk_file_pattern = re.compile(r'^[0-9a-f]{64}\.chunk\.')
+
+    def __init__(self, cachefs, layout='flat', deduplicate=False):
+        if layout not in self.layouts:
+            raise morphlib.Error('Unknown artifact cache layout %s' % layout)
         self.cachefs = cachefs
+        self.layout = layout
+        self.deduplicate = deduplicate
+        self.content_store = morphlib.contentstore.ContentStore(
+            self._syspath(self.blob_dirname))
+        self._index = None
+        self._index_lock = threading.Lock()
+        self._last_used = {}
+        self._unflushed = set()
+        self._flushed_at = time.time()
+
+    def _is_index_file(self, basename):
+        return basename.lstrip('/').startswith(self.index_filename)
+
+    def _get_index(self):
+        # Called with the index lock held.
+        if self._index is None:
+            db = sqlite3.connect(self._syspath(self.index_filename),
+                                 timeout=self.index_timeout,
+                                 isolation_level=None,
+                                 check_same_thread=False)
+            # The index is written to often. Losing the last changes to
+            # it in a crash does little harm, as files missing from it are
+            # added again when they are used, so it needn't be synced to
+            # disk every time.
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = NORMAL')
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                if db.execute("SELECT name FROM sqlite_master WHERE "
+                              "type = 'table' AND name = 'files'").fetchone() \
+                        is None:
+                    db.execute('CREATE TABLE files ('
+                               'basename TEXT PRIMARY KEY, '
+                               'cachekey TEXT NOT NULL, '
+                               'size INTEGER NOT NULL, '
+                               'last_used REAL NOT NULL)')
+                    db.execute('CREATE INDEX files_cachekey '
+                               'ON files (cachekey)')
+                    for filename in self._walk():
+                        st = os.stat(filename)
+                        self._insert(db, os.path.basename(filename),
+                                     st.st_size, st.st_mtime)
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                db.close()
+                raise
+            self._index = db
+        return self._index
+
+    def _walk(self):
+        # Yield the name of every file in the cache, in either layout.
+        for dirname, subdirs, basenames in os.walk(self._syspath('/')):
+            subdirs[:] = [d for d in subdirs if d != self.blob_dirname]
+            for basename in basenames:
+                if not self._is_index_file(basename):
+                    yield os.path.join(dirname, basename)
+
+    @staticmethod
+    def _insert(db, basename, size, last_used):
+        db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                   (basename, basename[:64], size, last_used))
+
+    def add_file(self, filename):
+        '''Record a file that has been saved in the cache directory.'''
+        basename = os.path.basename(filename)
+        size = os.stat(filename).st_size
+        now = time.time()
+        with self._index_lock:
+            self._insert(self._get_index(), basename, size, now)
+            self._last_used[basename] = now
+            self._unflushed.discard(basename)
+
+    def _mark_used(self, filename):
+        basename = os.path.basename(filename)
+        now = time.time()
+        with self._index_lock:
+            first_use = basename not in self._last_used
+            self._last_used[basename] = now
+            self._unflushed.add(basename)
+            if first_use or now - self._flushed_at >= self.flush_interval:
+                self._flush()
+
+    def _flush(self):
+        # Called with the index lock held.
+        if not self._unflushed:
+            return
+        db = self._get_index()
+        db.execute('BEGIN')
+        try:
+            for basename in self._unflushed:
+                cursor = db.execute(
+                    'UPDATE files SET last_used = ? WHERE basename = ?',
+                    (self._last_used[basename], basename))
+                if cursor.rowcount > 0:
+                    continue
+                # The file was written without being indexed.
+                try:
+                    size = os.stat(self._join(basename)).st_size
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise  # pragma: no cover
+                else:
+                    self._insert(db, basename, size,
+                                 self._last_used[basename])
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        self._unflushed.clear()
+        self._flushed_at = time.time()
+
+    def flush(self):
+        '''Write the times files were last used to the index.'''
+        with self._index_lock:
+            self._flush()
+
+    @staticmethod
+    def _make_parent(filename):
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise  # pragma: no cover
+        return filename
 
     def put(self, artifact):
-        filename = self.artifact_filename(artifact)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        filename = self._make_parent(self.artifact_filename(artifact))
+        if (self.deduplicate and
+                artifact.source.morphology['kind'] == 'chunk'):
+            return _DeduplicatedSaveFile(self, filename, mode='w')
+        return _IndexedSaveFile(self, filename, mode='w')
 
     def put_artifact_metadata(self, artifact, name):
-        filename = self._artifact_metadata_filename(artifact, name)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        filename = self._make_parent(
+            self._artifact_metadata_filename(artifact, name))
+        return _IndexedSaveFile(self, filename, mode='w')
 
     def put_source_metadata(self, source, cachekey, name):
-        filename = self._source_metadata_filename(source, cachekey, name)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        filename = self._make_parent(
+            self._source_metadata_filename(source, cachekey, name))
+        return _IndexedSaveFile(self, filename, mode='w')
 
     def _has_file(self, filename):
         if os.path.exists(filename):
-            os.utime(filename, None)
+            self._mark_used(filename)
             return True
         return False
 
@@ -77,31 +296,72 @@ class LocalArtifactCache(object):
         filename = self._source_metadata_filename(source, cachekey, name)
         return self._has_file(filename)
 
+    def _open(self, filename):
+        try:
+            f = open(filename)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise  # pragma: no cover
+            # The file may have been moved to the other layout by
+            # migrate since its name was looked up.
+            filename = self._join(os.path.basename(filename))
+            f = open(filename)
+        self._mark_used(filename)
+        return f
+
     def get(self, artifact):
         filename = self.artifact_filename(artifact)
-        os.utime(filename, None)
-        return open(filename)
+        f = self._open(filename)
+        if morphlib.contentstore.is_manifest(f):
+            return morphlib.contentstore.RehydratedFile(self.content_store, f)
+        return f
 
     def get_artifact_metadata(self, artifact, name):
         filename = self._artifact_metadata_filename(artifact, name)
-        os.utime(filename, None)
-        return open(filename)
+        return self._open(filename)
 
     def get_source_metadata_filename(self, source, cachekey, name):
-        return self._source_metadata_filename(source, cachekey, name)
+        '''Return the name to save source metadata under.
+
+        The directory it is in exists, so a temporary file can be
+        created alongside it and renamed to it.
+
+        '''
+        return self._make_parent(
+            self._source_metadata_filename(source, cachekey, name))
 
     def get_source_metadata(self, source, cachekey, name):
         filename = self._source_metadata_filename(source, cachekey, name)
-        os.utime(filename, None)
-        return open(filename)
+        return self._open(filename)
 
-    def _join(self, basename):
+    def _syspath(self, path):
         '''Wrapper for pyfilesystem's getsyspath.
 
         This is required because its API throws us a garbage unicode
         string, when file paths are binary data.
         '''
-        return str(self.cachefs.getsyspath(basename))
+        return str(self.cachefs.getsyspath(path))
+
+    @staticmethod
+    def _layout_path(basename, layout):
+        if layout == 'sharded':
+            return os.path.join(basename[:2], basename[2:4], basename)
+        return basename
+
+    def _join(self, basename):
+        '''Return the name of a file in the cache.
+
+        This is where the file is in the cache's layout, unless it is
+        only in the other layout, in which case it is found there.
+
+        '''
+        filename = self._syspath(self._layout_path(basename, self.layout))
+        if not os.path.exists(filename):
+            for layout in self.layouts:
+                other = self._syspath(self._layout_path(basename, layout))
+                if os.path.exists(other):
+                    return other
+        return filename
 
     def artifact_filename(self, artifact):
         basename = artifact.basename()
@@ -120,31 +380,153 @@ class LocalArtifactCache(object):
         Caveat caller.
 
          '''
-        for filename in self.cachefs.walkfiles():
-            self.cachefs.remove(filename)
+        with self._index_lock:
+            db = self._get_index()
+            for filename in self.cachefs.walkfiles():
+                if not self._is_index_file(filename):
+                    self.cachefs.remove(filename)
+            db.execute('DELETE FROM files')
+            self._last_used.clear()
+            self._unflushed.clear()
+
+    def migrate(self):
+        '''Move files in the other layout into the cache's layout.
+
+        Each file is renamed in one step, and is found in either layout,
+        so the cache can be used while this runs. Returns the number of
+        files moved.
+
+        '''
+        moved = 0
+        for filename in list(self._walk()):
+            basename = os.path.basename(filename)
+            if not self._cache_file_pattern.match(basename):
+                continue
+            target = self._syspath(self._layout_path(basename, self.layout))
+            if filename == target:
+                continue
+            os.rename(filename, self._make_parent(target))
+            moved += 1
+            if self.layout == 'flat':
+                # Remove the shard directories once they are empty.
+                shard = os.path.dirname(filename)
+                for dirname in (shard, os.path.dirname(shard)):
+                    try:
+                        os.rmdir(dirname)
+                    except OSError:
+                        break
+        return moved
+
+    def remove_unused_blobs(self):
+        '''Remove blobs of the content store that no artifact uses.
+
+        This looks through every chunk artifact, so it is best called
+        once after removing many artifacts, rather than after each one.
+        Returns the number of bytes freed.
+
+        '''
+        return self.content_store.remove_unused(
+            filename for filename in self._walk()
+            if self._chunk_file_pattern.match(os.path.basename(filename)))
+
+    def remove_until(self, cachekeys, done):
+        '''Remove the artifacts of each cache key in turn until done.
+
+        ``done`` is called before each removal, and nothing more is
+        removed once it returns True. Returns the cache keys removed.
+
+        Removing a deduplicated chunk artifact only frees the space of
+        its files once remove_unused_blobs finds that no other artifact
+        uses them, so that is done between removals, after batches that
+        double in size each time. This keeps the number of times every
+        chunk artifact is looked through small, while not removing many
+        more artifacts than are needed.
+
+        '''
+        removed = []
+        batch = 1
+        pending = 0
+        for cachekey in cachekeys:
+            if pending >= batch:
+                self.remove_unused_blobs()
+                pending = 0
+                batch *= 2
+            if done():
+                break
+            self.remove(cachekey)
+            removed.append(cachekey)
+            pending += 1
+        if pending > 0:
+            self.remove_unused_blobs()
+        return removed
+
+    def _reconcile(self):
+        # Called with the index lock held. Files are only indexed all at
+        # once when the index is made, and afterwards when they are saved
+        # or used, so files saved without being indexed, by a process
+        # that crashed or an older version, are added here with their
+        # mtimes. Files that are gone are dropped from the index.
+        on_disk = {}
+        for filename in self._walk():
+            basename = os.path.basename(filename)
+            if self._cache_file_pattern.match(basename):
+                on_disk[basename] = filename
+        db = self._get_index()
+        indexed = set(str(basename) for basename,
+                      in db.execute('SELECT basename FROM files'))
+        db.execute('BEGIN')
+        try:
+            for basename in indexed.difference(on_disk):
+                db.execute('DELETE FROM files WHERE basename = ?',
+                           (basename,))
+            for basename in set(on_disk).difference(indexed):
+                try:
+                    st = os.stat(on_disk[basename])
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise  # pragma: no cover
+                else:
+                    self._insert(db, basename, st.st_size, st.st_mtime)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
 
     def list_contents(self):
         '''Return the set of sources cached and related information.
 
            returns a [(cache_key, set(artifacts), last_used)]
 
+           Files in the cache that were never indexed are included.
+
         '''
         CacheInfo = collections.namedtuple('CacheInfo', ('artifacts', 'mtime'))
         contents = collections.defaultdict(lambda: CacheInfo(set(), 0))
-        for filename in self.cachefs.walkfiles():
-            cachekey = filename[:63]
-            artifact = filename[65:]
+        with self._index_lock:
+            self._flush()
+            self._reconcile()
+            rows = self._get_index().execute(
+                'SELECT cachekey, basename, last_used FROM files').fetchall()
+        for cachekey, basename, last_used in rows:
             artifacts, max_mtime = contents[cachekey]
-            artifacts.add(artifact)
-            art_info = self.cachefs.getinfo(filename)
-            time_t = art_info['modified_time'].timetuple()
+            artifacts.add(str(basename[65:]))
             contents[cachekey] = CacheInfo(artifacts,
-                                           max(max_mtime, time.mktime(time_t)))
-        return ((cache_key, info.artifacts, info.mtime)
+                                           max(max_mtime, last_used))
+        return ((str(cache_key), info.artifacts, info.mtime)
                 for cache_key, info in contents.iteritems())
 
     def remove(self, cachekey):
         '''Remove all artifacts associated with the given cachekey.'''
-        for filename in (x for x in self.cachefs.walkfiles()
-                         if x.startswith(cachekey)):
-            self.cachefs.remove(filename)
+        with self._index_lock:
+            self._flush()
+            db = self._get_index()
+            rows = db.execute('SELECT basename FROM files WHERE cachekey = ?',
+                              (cachekey,)).fetchall()
+            for basename, in rows:
+                self._last_used.pop(basename, None)
+                try:
+                    os.remove(self._join(str(basename)))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise  # pragma: no cover
+            db.execute('DELETE FROM files WHERE cachekey = ?', (cachekey,))
@@ -15,10 +15,14 @@
 
 import unittest
 import os
+import StringIO
+import tarfile
+import time
 
 import fs.tempfs
 
 import morphlib
+import morphlib.gitdir_tests
 
 
 class LocalArtifactCacheTests(unittest.TestCase):
@@ -189,3 +193,359 @@ class LocalArtifactCacheTests(unittest.TestCase):
         cache.remove(key)
 
         self.assertEqual(len(list(cache.list_contents())), 0)
+
+    def test_remove_leaves_artifacts_of_other_sources(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+
+        with cache.put(self.runtime_artifact) as f:
+            f.write('runtime')
+        with cache.put_source_metadata(self.source, '1' * 64, 'meta') as f:
+            f.write('meta')
+
+        cache.remove('0' * 64)
+
+        self.assertFalse(cache.has(self.runtime_artifact))
+        self.assertTrue(cache.has_source_metadata(self.source, '1' * 64,
+                                                  'meta'))
+        self.assertEqual([(key, artifacts) for key, artifacts, last_used
+                          in cache.list_contents()],
+                         [('1' * 64, set(['meta']))])
+
+    def test_indexes_files_already_in_the_cache_when_first_used(self):
+        artifact = self.tempfs.getsyspath(self.runtime_artifact.basename())
+        with open(artifact, 'w') as f:
+            f.write('runtime')
+        build_log = self.tempfs.getsyspath('%s.build-log' % ('1' * 64))
+        with open(build_log, 'w') as f:
+            f.write('log')
+
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+
+        self.assertEqual(sorted((key, artifacts) for key, artifacts, last_used
+                                in cache.list_contents()),
+                         [('0' * 64, set(['chunk.chunk-runtime'])),
+                          ('1' * 64, set(['build-log']))])
+
+    def test_makes_index_again_if_indexing_fails(self):
+        with open(self.tempfs.getsyspath(self.runtime_artifact.basename()),
+                  'w') as f:
+            f.write('runtime')
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+
+        def fail():
+            raise OSError('walk failed')
+            yield
+
+        with morphlib.gitdir_tests.monkeypatch(cache, '_walk', fail):
+            self.assertRaises(OSError, cache.has, self.runtime_artifact)
+        self.assertEqual(len(list(cache.list_contents())), 1)
+
+    def write_unindexed(self, basename, contents):
+        with open(self.tempfs.getsyspath(basename), 'w') as f:
+            f.write(contents)
+
+    def indexed(self, cache):
+        return sorted(str(basename) for basename, in cache._get_index()
+                      .execute('SELECT basename FROM files'))
+
+    def test_lists_and_removes_files_saved_without_being_indexed(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        with cache.put(self.runtime_artifact) as f:
+            f.write('runtime')
+        self.assertEqual(len(list(cache.list_contents())), 1)
+
+        build_log = '%s.build-log' % ('1' * 64)
+        self.write_unindexed(build_log, 'log')
+        self.write_unindexed('tmpXYZ', 'being written')
+        self.assertEqual(sorted((key, artifacts) for key, artifacts, last_used
+                                in cache.list_contents()),
+                         [('0' * 64, set(['chunk.chunk-runtime'])),
+                          ('1' * 64, set(['build-log']))])
+
+        cache.remove('1' * 64)
+        self.assertFalse(self.tempfs.exists(build_log))
+        self.assertTrue(self.tempfs.exists('tmpXYZ'))
+
+    def test_does_not_list_files_removed_behind_its_back(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        with cache.put(self.runtime_artifact) as f:
+            f.write('runtime')
+        self.tempfs.remove(self.runtime_artifact.basename())
+        self.assertEqual(list(cache.list_contents()), [])
+
+    def test_does_not_index_files_removed_while_listing(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        self.assertEqual(list(cache.list_contents()), [])
+        walk = cache._walk
+
+        def walk_with_removed_file():
+            for filename in walk():
+                yield filename
+            yield self.tempfs.getsyspath('%s.build-log' % ('1' * 64))
+
+        with morphlib.gitdir_tests.monkeypatch(cache, '_walk',
+                                               walk_with_removed_file):
+            self.assertEqual(list(cache.list_contents()), [])
+
+    def test_leaves_index_alone_if_it_cannot_be_brought_up_to_date(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        with cache.put(self.runtime_artifact) as f:
+            f.write('runtime')
+        self.tempfs.remove(self.runtime_artifact.basename())
+        self.write_unindexed('%s.build-log' % ('1' * 64), 'log')
+
+        def fail(db, basename, size, last_used):
+            raise OSError('insert failed')
+
+        with morphlib.gitdir_tests.monkeypatch(cache, '_insert', fail):
+            self.assertRaises(OSError, cache.list_contents)
+        self.assertEqual(self.indexed(cache),
+                         [self.runtime_artifact.basename()])
+
+    def test_removes_artifacts_whose_files_are_already_gone(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        with cache.put(self.runtime_artifact) as f:
+            f.write('runtime')
+        self.tempfs.remove(self.runtime_artifact.basename())
+        cache.remove('0' * 64)
+        self.assertEqual(self.indexed(cache), [])
+
+    def test_index_is_kept_in_the_cache_directory(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        with cache.put(self.runtime_artifact) as f:
+            f.write('runtime')
+
+        other_cache = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs)
+        self.assertEqual(len(list(other_cache.list_contents())), 1)
+        other_cache.remove('0' * 64)
+        self.assertEqual(len(list(cache.list_contents())), 0)
+
+    def last_used_in_index(self):
+        other_cache = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs)
+        (cachekey, artifacts, last_used), = other_cache.list_contents()
+        return last_used
+
+    def test_writes_later_uses_when_flushed(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        with morphlib.gitdir_tests.monkeypatch(time, 'time', lambda: 1000):
+            with cache.put(self.runtime_artifact) as f:
+                f.write('runtime')
+            cache.has(self.runtime_artifact)
+        self.assertEqual(self.last_used_in_index(), 1000)
+
+        with morphlib.gitdir_tests.monkeypatch(time, 'time', lambda: 1010):
+            cache.get(self.runtime_artifact).close()
+            cache.has(self.runtime_artifact)
+        self.assertEqual(self.last_used_in_index(), 1000)
+
+        cache.flush()
+        self.assertEqual(self.last_used_in_index(), 1010)
+
+    def test_writes_first_use_and_uses_after_flush_interval(self):
+        with open(self.tempfs.getsyspath(self.runtime_artifact.basename()),
+                  'w') as f:
+            f.write('runtime')
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        with morphlib.gitdir_tests.monkeypatch(time, 'time', lambda: 1000):
+            cache.has(self.runtime_artifact)
+        self.assertEqual(self.last_used_in_index(), 1000)
+
+        later = 1000 + cache.flush_interval + 1
+        with morphlib.gitdir_tests.monkeypatch(time, 'time', lambda: later):
+            cache.has(self.runtime_artifact)
+        self.assertEqual(self.last_used_in_index(), later)
+
+    def test_saves_files_in_shards_in_sharded_layout(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs, 'sharded')
+        with cache.put(self.runtime_artifact) as f:
+            f.write('runtime')
+
+        basename = self.runtime_artifact.basename()
+        self.assertEqual(cache.artifact_filename(self.runtime_artifact),
+                         self.tempfs.getsyspath('00/00/' + basename))
+        self.assertTrue(self.tempfs.exists('00/00/' + basename))
+        self.assertFalse(self.tempfs.exists(basename))
+        self.assertEqual(cache.get(self.runtime_artifact).read(), 'runtime')
+
+    def test_finds_files_in_the_other_layout(self):
+        flat = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        with flat.put(self.runtime_artifact) as f:
+            f.write('runtime')
+
+        sharded = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs, 'sharded')
+        self.assertTrue(sharded.has(self.runtime_artifact))
+        self.assertEqual(sharded.get(self.runtime_artifact).read(),
+                         'runtime')
+        sharded.remove('0' * 64)
+        self.assertFalse(flat.has(self.runtime_artifact))
+
+    def test_refuses_unknown_layout(self):
+        self.assertRaises(morphlib.Error,
+                          morphlib.localartifactcache.LocalArtifactCache,
+                          self.tempfs, 'nested')
+
+    def test_migrates_files_between_layouts(self):
+        flat = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        with flat.put(self.runtime_artifact) as f:
+            f.write('runtime')
+        with flat.put(self.devel_artifact) as f:
+            f.write('devel')
+        with flat.put_source_metadata(self.source, '1' * 64, 'meta') as f:
+            f.write('meta')
+        self.write_unindexed('tmpXYZ', 'being written')
+
+        sharded = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs, 'sharded')
+        self.assertEqual(sharded.migrate(), 3)
+        self.assertEqual(sharded.migrate(), 0)
+        self.assertTrue(self.tempfs.exists(
+            '11/11/%s.meta' % ('1' * 64)))
+        self.assertTrue(self.tempfs.exists('tmpXYZ'))
+        self.assertEqual(len(list(sharded.list_contents())), 2)
+
+        self.assertEqual(flat.migrate(), 3)
+        self.assertEqual(self.tempfs.listdir(dirs_only=True), [])
+        self.assertTrue(self.tempfs.exists('%s.meta' % ('1' * 64)))
+        self.assertEqual(flat.get(self.runtime_artifact).read(), 'runtime')
+
+    def test_opens_file_moved_by_migrate_after_it_was_looked_up(self):
+        flat = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        with flat.put(self.runtime_artifact) as f:
+            f.write('runtime')
+
+        sharded = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs, 'sharded')
+        artifact_filename = sharded.artifact_filename
+
+        def look_up_then_migrate(artifact):
+            filename = artifact_filename(artifact)
+            sharded.migrate()
+            return filename
+
+        with morphlib.gitdir_tests.monkeypatch(sharded, 'artifact_filename',
+                                               look_up_then_migrate):
+            f = sharded.get(self.runtime_artifact)
+        self.assertEqual(f.read(), 'runtime')
+        f.close()
+        self.assertTrue(self.tempfs.exists(
+            '00/00/%s' % self.runtime_artifact.basename()))
+
+    def test_deduplicates_files_of_chunk_artifacts(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs, deduplicate=True)
+        for artifact in (self.runtime_artifact, self.devel_artifact):
+            with cache.put(artifact) as f:
+                tf = tarfile.open(fileobj=f, mode='w')
+                info = tarfile.TarInfo('usr/bin/tool')
+                info.size = len('same')
+                tf.addfile(info, StringIO.StringIO('same'))
+                tf.close()
+
+        with open(cache.artifact_filename(self.runtime_artifact)) as f:
+            self.assertTrue(morphlib.contentstore.is_manifest(f))
+        self.assertEqual(len(list(self.tempfs.walkfiles(
+            cache.blob_dirname))), 1)
+        self.assertEqual(len(list(cache.list_contents())), 1)
+
+        with cache.get(self.devel_artifact) as f:
+            self.assertEqual(f.name,
+                             cache.artifact_filename(self.devel_artifact))
+            tf = tarfile.open(fileobj=f)
+            self.assertEqual(tf.extractfile('usr/bin/tool').read(), 'same')
+            tf.close()
+
+        cache.remove('0' * 64)
+        cache.content_store.grace_period = -1
+        self.assertEqual(cache.remove_unused_blobs(), len('same'))
+
+    def test_does_not_save_chunk_artifact_that_is_not_a_tar_file(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs, deduplicate=True)
+        f = cache.put(self.runtime_artifact)
+        f.write('not a tar file')
+        self.assertRaises(tarfile.ReadError, f.close)
+
+        self.assertFalse(cache.has(self.runtime_artifact))
+        self.assertEqual([name for name in self.tempfs.listdir()
+                          if not name.startswith(cache.index_filename)],
+                         [])
+
+    def test_indexes_files_saved_without_being_indexed_when_used(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        self.assertEqual(list(cache.list_contents()), [])
+        self.write_unindexed(self.runtime_artifact.basename(), 'runtime')
+        with morphlib.gitdir_tests.monkeypatch(time, 'time', lambda: 1000):
+            cache.has(self.runtime_artifact)
+        self.assertEqual(self.indexed(cache),
+                         [self.runtime_artifact.basename()])
+        self.assertEqual(self.last_used_in_index(), 1000)
+
+    def test_does_not_index_used_files_that_are_gone_when_flushed(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        with cache.put(self.runtime_artifact) as f:
+            f.write('runtime')
+        cache.has(self.runtime_artifact)
+        cache.has(self.runtime_artifact)
+
+        other_cache = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs)
+        other_cache.remove('0' * 64)
+        cache.flush()
+        self.assertEqual(self.indexed(cache), [])
+
+    def test_writes_uses_again_if_flushing_fails(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        self.assertEqual(list(cache.list_contents()), [])
+        self.write_unindexed(self.runtime_artifact.basename(), 'runtime')
+
+        def fail(db, basename, size, last_used):
+            raise OSError('insert failed')
+
+        with morphlib.gitdir_tests.monkeypatch(cache, '_insert', fail):
+            self.assertRaises(OSError, cache.has, self.runtime_artifact)
+        self.assertEqual(self.indexed(cache), [])
+        cache.flush()
+        self.assertEqual(self.indexed(cache),
+                         [self.runtime_artifact.basename()])
+
+    def put_chunk(self, cache, cachekey, contents):
+        source, = morphlib.source.make_sources('repo', 'ref', 'chunk.morph',
+                                               'sha1', 'tree',
+                                               self.source.morphology)
+        source.cache_key = cachekey
+        with cache.put(morphlib.artifact.Artifact(source, 'chunk-runtime')) \
+                as f:
+            tf = tarfile.open(fileobj=f, mode='w')
+            info = tarfile.TarInfo('usr/bin/tool')
+            info.size = len(contents)
+            tf.addfile(info, StringIO.StringIO(contents))
+            tf.close()
+
+    def test_removes_deduplicated_artifacts_until_done(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs, deduplicate=True)
+        cache.content_store.grace_period = -1
+        cachekeys = [str(i) * 64 for i in xrange(1, 6)]
+        for cachekey in cachekeys:
+            self.put_chunk(cache, cachekey, cachekey * 100)
+
+        def blob_count():
+            return len(list(self.tempfs.walkfiles(cache.blob_dirname)))
+
+        # Unused blobs are removed after the first removal, and then
+        # after the next two, so three artifacts are removed, not two.
+        removed = cache.remove_until(cachekeys, lambda: blob_count() <= 2)
+        self.assertEqual(removed, cachekeys[:3])
+        self.assertEqual(blob_count(), 2)
+        self.assertEqual(sorted(key for key, artifacts, last_used
+                                in cache.list_contents()),
+                         cachekeys[3:])
+
+        # Blobs of the last batch are removed even if it is never done.
+        removed = cache.remove_until(cachekeys[3:], lambda: False)
+        self.assertEqual(removed, cachekeys[3:])
+        self.assertEqual(blob_count(), 0)
@@ -13,11 +13,13 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
 import os
 import urlparse
 import string
 import sys
 import tempfile
+import time
 
 import cliapp
 import fs.osfs
@@ -87,9 +89,14 @@ class LocalRepoCache(object):
     git server, we first try to download a tarball from a url, and
     if that works, we unpack the tarball.
 
+    If 'object_pool' is given, it is the path of a bare repository that
+    the cached repositories keep their objects in, as described for
+    CachedRepo, rather than each having its own.
+
     '''
 
-    def __init__(self, app, cachedir, resolver, tarball_base_url=None):
+    def __init__(self, app, cachedir, resolver, tarball_base_url=None,
+                 object_pool=None):
         self._app = app
         self.fs = fs.osfs.OSFS('/')
         self._cachedir = cachedir
@@ -98,6 +105,7 @@ class LocalRepoCache(object):
             tarball_base_url += '/'  # pragma: no cover
         self._tarball_base_url = tarball_base_url
         self._cached_repo_objects = {}
+        self._object_pool = object_pool
 
     def _git(self, args, **kwargs):  # pragma: no cover
         '''Execute git command.
@@ -211,8 +219,11 @@ class LocalRepoCache(object):
         target = self._mkdtemp(self._cachedir)
 
         try:
-            self._git(['clone', '--mirror', '-n', repourl, target],
-                      echo_stderr=self._app.settings['verbose'])
+            if self._object_pool:
+                self._clone_into_object_pool(reponame, repourl, target)
+            else:
+                self._git(['clone', '--mirror', '-n', repourl, target],
+                          echo_stderr=self._app.settings['verbose'])
         except cliapp.AppException as e:
             errors.append('Unable to clone from %s to %s: %s' %
                           (repourl, target, e))
@@ -223,10 +234,28 @@ class LocalRepoCache(object):
         self.fs.rename(target, path)
         return self.get_repo(reponame)
 
+    def _clone_into_object_pool(self, reponame, repourl,
+                                target):  # pragma: no cover
+        '''Make a mirror of a repo in 'target' that uses the object pool.'''
+
+        self._git(['init', '--quiet', '--bare'], cwd=target)
+        self._git(['config', 'remote.origin.url', repourl], cwd=target)
+        self._git(['config', 'remote.origin.mirror', 'true'], cwd=target)
+        self._git(['config', 'remote.origin.fetch', '+refs/*:refs/*'],
+                  cwd=target)
+        morphlib.git.init_object_pool(self._app.runcmd, self._object_pool)
+        morphlib.git.set_alternates(
+            target, [os.path.join(self._object_pool, 'objects')])
+        repo = self._new_cached_repo_instance(reponame, repourl, target)
+        try:
+            repo.update()
+        finally:
+            repo.close()
+
     def _new_cached_repo_instance(self, reponame, repourl,
                                   path):  # pragma: no cover
         return morphlib.cachedrepo.CachedRepo(
-            self._app, reponame, repourl, path)
+            self._app, reponame, repourl, path, self._object_pool)
 
     def get_repo(self, reponame):
         '''Return an object representing a cached repository.'''
@@ -242,6 +271,11 @@ class LocalRepoCache(object):
                 return repo
         raise NotCached(reponame)
 
+    def close(self):
+        '''Stop any git processes kept running for the cached repos.'''
+        for repo in self._cached_repo_objects.itervalues():
+            repo.close()
+
     def get_updated_repo(self, repo_name, ref=None):  # pragma: no cover
         '''Return object representing cached repository.
 
@@ -284,26 +318,100 @@ class LocalRepoCache(object):
                              repo_name=repo_name)
             return self.cache_repo(repo_name)
 
+    def _submodules(self, repo, ref):  # pragma: no cover
+        '''Return (url, commit) pairs for the submodules of a commit.'''
+
+        try:
+            submodules = morphlib.git.Submodules(self._app, repo.path, ref)
+            submodules.load()
+            return [(submod.url, submod.commit) for submod in submodules]
+        except morphlib.git.NoModulesFileError:
+            return []
+
     def ensure_submodules(self, toplevel_repo,
                           toplevel_ref):  # pragma: no cover
         '''Ensure any submodules of a given repo are cached and up to date.'''
 
-        def submodules_for_repo(repo_path, ref):
-            try:
-                submodules = morphlib.git.Submodules(self._app, repo_path, ref)
-                submodules.load()
-                return [(submod.url, submod.commit) for submod in submodules]
-            except morphlib.git.NoModulesFileError:
-                return []
-
         done = set()
-        subs_to_process = submodules_for_repo(toplevel_repo.path, toplevel_ref)
+        subs_to_process = set(self._submodules(toplevel_repo, toplevel_ref))
         while subs_to_process:
             url, ref = subs_to_process.pop()
             done.add((url, ref))
 
             cached_repo = self.get_updated_repo(url, ref=ref)
 
-            for submod in submodules_for_repo(cached_repo.path, ref):
-                if (submod.url, submod.commit) not in done:
-                    subs_to_process.add((submod.url, submod.commit))
+            for submod in self._submodules(cached_repo, ref):
+                if submod not in done:
+                    subs_to_process.add(submod)
+
+    def _update_repo(self, repo_name, refs):  # pragma: no cover
+        '''Clone or update a repo unless it has everything 'refs' need.
+
+        Returns the cached repo and what was done to it: 'cloned',
+        'updated' or 'skipped'.
+
+        '''
+
+        if self._app.settings['no-git-update']:
+            return self.get_repo(repo_name), 'skipped'
+        if not self.has_repo(repo_name):
+            return self.cache_repo(repo_name), 'cloned'
+        repo = self.get_repo(repo_name)
+        if any(repo.requires_update_for_ref(ref) for ref in refs):
+            repo.update()
+            return repo, 'updated'
+        return repo, 'skipped'
+
+    def update_repos(self, repos, jobs=1):
+        '''Make sure the cached repos have the commits a build needs.
+
+        'repos' is an iterable of (repo name, ref) pairs, such as the
+        repo_name and sha1 of each source in a source pool. Each repo is
+        cloned if it isn't cached, or updated unless it already has all
+        the commits it is wanted for, as get_updated_repo would, and then
+        the same is done for the submodules of those commits, and so on.
+        Up to 'jobs' repos are cloned or updated at once.
+
+        Returns a list of (repo name, action, seconds) tuples, where the
+        action is 'cloned', 'updated' or 'skipped', in the order the
+        repos were dealt with. A repo that is also wanted as a submodule
+        at another commit is dealt with, and listed, again.
+
+        '''
+
+        if not self.fs.exists(self._cachedir):
+            self.fs.makedir(self._cachedir, recursive=True)
+
+        def update(item):
+            repo_name, refs = item
+            start = time.time()
+            repo, action = self._update_repo(repo_name, refs)
+            seconds = time.time() - start
+            self._app.status(
+                msg='%(repo_name)s: %(action)s in %(seconds).1f seconds',
+                repo_name=repo_name, action=action, seconds=seconds,
+                chatty=(action == 'skipped'))
+            submodules = set()
+            for ref in refs:
+                submodules.update(self._submodules(repo, ref))
+            return (repo_name, action, seconds), submodules
+
+        results = []
+        done = set()
+        todo = repos
+        while todo:
+            # Refs wanted from the same repo by different names are dealt
+            # with together, so no two threads work on one repo.
+            wanted = collections.OrderedDict()
+            for repo_name, ref in sorted(set(todo)):
+                path = self._cache_name(self._resolver.pull_url(repo_name))
+                if (path, ref) in done:
+                    continue
+                done.add((path, ref))
+                wanted.setdefault(path, (repo_name, []))[1].append(ref)
+            todo = set()
+            for result, submodules in morphlib.util.map_concurrently(
+                    update, wanted.itervalues(), jobs):
+                results.append(result)
+                todo.update(submodules)
+        return results
@@ -31,7 +31,7 @@ class FakeApplication(object):
             'verbose': True
         }
 
-    def status(self, msg):
+    def status(self, **kwargs):
         pass
 
 
@@ -130,6 +130,20 @@ class LocalRepoCacheTests(unittest.TestCase):
         self.assertRaises(morphlib.localrepocache.NoRemote,
                           self.lrc.cache_repo, self.repourl)
 
+    def test_clones_into_object_pool_if_it_has_one(self):
+        clones = []
+
+        def clone_into_object_pool(reponame, repourl, target):
+            clones.append((reponame, repourl))
+            self.lrc.fs.makedir(target, recursive=True, allow_recreate=True)
+
+        self.lrc._object_pool = '/cache/object-pool.git'
+        self.lrc._clone_into_object_pool = clone_into_object_pool
+        self.lrc.cache_repo(self.reponame)
+        self.assertEqual(clones, [(self.reponame, self.repourl)])
+        self.assertTrue(self.lrc.has_repo(self.reponame))
+        self.assertEqual(self.remotes, {})
+
     def test_does_not_mind_a_missing_tarball(self):
         self.lrc.cache_repo(self.repourl)
         self.assertEqual(self.fetched, [])
@@ -157,6 +171,14 @@ class LocalRepoCacheTests(unittest.TestCase):
         cached = self.lrc.get_repo(self.repourl)
         self.assertTrue(cached is not None)
 
+    def test_close_closes_cached_repos(self):
+        self.lrc.cache_repo(self.reponame)
+        repo = self.lrc.get_repo(self.reponame)
+        closed = []
+        repo.close = lambda: closed.append(repo)
+        self.lrc.close()
+        self.assertEqual(closed, [repo])
+
     def test_get_repo_raises_exception_if_repo_is_not_cached(self):
         self.assertRaises(Exception, self.lrc.get_repo, self.repourl)
 
@@ -173,3 +195,34 @@ class LocalRepoCacheTests(unittest.TestCase):
         self.lrc.cache_repo('file:///local/repo')
         cached = self.lrc.get_repo('file:///local/repo')
         assert cached.path == '/local/repo'
+
+    def test_updates_each_repo_once_with_all_its_refs(self):
+        updated = []
+        self.lrc._update_repo = \
+            lambda name, refs: (updated.append((name, refs)) or name,
+                                'updated')
+        self.lrc._submodules = lambda repo, ref: []
+        results = self.lrc.update_repos([(self.reponame, 'b' * 40),
+                                         (self.repourl, 'a' * 40),
+                                         (self.reponame, 'b' * 40)],
+                                        jobs=2)
+        self.assertEqual(updated, [(self.repourl, ['a' * 40, 'b' * 40])])
+        self.assertEqual([(name, action) for name, action, seconds
+                          in results], [(self.repourl, 'updated')])
+
+    def test_updates_submodules_of_updated_repos(self):
+        submodules = {
+            ('upstream:top', 'a' * 40): [('upstream:sub', 'b' * 40)],
+            ('upstream:sub', 'b' * 40): [('upstream:subsub', 'c' * 40),
+                                         ('upstream:top', 'a' * 40)],
+        }
+        updated = []
+        self.lrc._update_repo = \
+            lambda name, refs: (updated.append((name, refs)) or name,
+                                'skipped')
+        self.lrc._submodules = \
+            lambda repo, ref: submodules.get((repo, ref), [])
+        self.lrc.update_repos([('upstream:top', 'a' * 40)], jobs=4)
+        self.assertEqual(updated, [('upstream:top', ['a' * 40]),
+                                   ('upstream:sub', ['b' * 40]),
+                                   ('upstream:subsub', ['c' * 40])])
@@ -18,7 +18,6 @@ import logging
 import os
 import shutil
 import sys
-import tarfile
 import tempfile
 import uuid
 
@@ -441,9 +440,7 @@ class DeployPlugin(cliapp.Plugin):
         try:
             # Find the artifact to build
             morph = morphlib.util.sanitise_morphology_path(system['morph'])
-            srcpool = build_command.create_source_pool(build_repo, ref, morph)
-
-            artifact = build_command.resolve_artifacts(srcpool)
+            artifact = build_command.get_root_artifact(build_repo, ref, morph)
 
             deploy_defaults = system.get('deploy-defaults', {})
             for system_id, deploy_params in system['deploy'].iteritems():
@@ -556,8 +553,8 @@ class DeployPlugin(cliapp.Plugin):
                                           ' not yet built.\nPlease ensure'
                                           ' the system is built before'
                                           ' deployment.')
-            tf = tarfile.open(fileobj=f)
-            tf.extractall(path=system_tree)
+            with morphlib.bins.open_tar(f) as tf:
+                tf.extractall(path=system_tree)
 
             self.app.status(
                 msg='System unpacked at %(system_tree)s',
@@ -68,9 +68,8 @@ class SerialiseArtifactPlugin(cliapp.Plugin):
 
         filename = morphlib.util.sanitise_morphology_path(morph_name)
         build_command = morphlib.buildcommand.BuildCommand(self.app)
-        srcpool = build_command.create_source_pool(
+        artifact = build_command.get_root_artifact(
             repo_name, ref, filename, original_ref=original_ref)
-        artifact = build_command.resolve_artifacts(srcpool)
         self.app.output.write(distbuild.serialise_artifact(artifact))
         self.app.output.write('\n')
 
@@ -111,7 +110,10 @@ class WorkerBuild(cliapp.Plugin):
         self.app.subcommands['gc']([])
 
         arch = artifact.arch
-        bc.build_source(artifact.source, bc.new_build_env(arch))
+        try:
+            bc.build_source(artifact.source, bc.new_build_env(arch))
+        finally:
+            bc.lac.flush()
 
     def is_system_artifact(self, filename):
         return re.match(r'^[0-9a-fA-F]{64}\.system\.', filename)
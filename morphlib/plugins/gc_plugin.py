@@ -29,6 +29,9 @@ class GCPlugin(cliapp.Plugin):
     def enable(self):
         self.app.add_subcommand('gc', self.gc,
                                 arg_synopsis='')
+        self.app.add_subcommand('migrate-artifact-cache',
+                                self.migrate_artifact_cache,
+                                arg_synopsis='[DIR]')
         self.app.settings.integer(['cachedir-artifact-delete-older-than'],
                                   'always delete artifacts older than this '
                                   'period in seconds, (default: 1 week)',
@@ -76,13 +79,43 @@ class GCPlugin(cliapp.Plugin):
 
         self.cleanup_tempdir(tempdir, tempdir_min_space)
         self.cleanup_cachedir(cachedir, cachedir_min_space)
-        
+
+    def migrate_artifact_cache(self, args):
+        '''Move artifacts into the layout set by --artifact-cache-layout.
+
+           This moves the files of the artifact cache in DIR, by default
+           the one in the cache directory, into the layout set by
+           --artifact-cache-layout. Each file is moved in one step and
+           artifacts are found in either layout, so this can be run while
+           the cache is in use, including by morph-cache-server.
+
+        '''
+
+        if len(args) > 1:
+            raise cliapp.AppException(
+                'migrate-artifact-cache takes at most one argument')
+        if args:
+            artifact_dir = args[0]
+        else:
+            artifact_dir = os.path.join(self.app.settings['cachedir'],
+                                        'artifacts')
+        layout = self.app.settings['artifact-cache-layout']
+        lac = morphlib.localartifactcache.LocalArtifactCache(
+            fs.osfs.OSFS(artifact_dir), layout)
+        moved = lac.migrate()
+        self.app.status(msg='Moved %(moved)d files in %(dir)s into the '
+                            '%(layout)s layout',
+                        moved=moved, dir=artifact_dir, layout=layout)
+
     def cleanup_tempdir(self, temp_path, min_space):
         # The subdirectories in tempdir are created at Morph startup time. Code
         # assumes that they exist in various places.
         self.app.status(msg='Cleaning up temp dir %(temp_path)s',
                         temp_path=temp_path, chatty=True)
-        for subdir in ('deployments', 'failed', 'chunks'):
+        # Snapshots hardlink files from the unpacked chunks, so removing
+        # the chunks frees no space until the snapshots are removed too.
+        for subdir in ('deployments', 'failed', 'staging-snapshots',
+                       'chunks'):
             if morphlib.util.get_bytes_free_in_path(temp_path) >= min_space:
                 self.app.status(msg='Not Removing subdirectory '
                                     '%(subdir)s, enough space already cleared',
@@ -92,6 +125,13 @@ class GCPlugin(cliapp.Plugin):
             self.app.status(msg='Removing temp subdirectory: %(subdir)s',
                             subdir=subdir)
             path = os.path.join(temp_path, subdir)
+            if (subdir in ('chunks', 'staging-snapshots') and
+                    os.path.exists(path)):
+                # Other builds may be using unpacked chunks and snapshots
+                # right now, so only remove the ones that are not in use.
+                store = morphlib.unpackedchunkcache.UnpackedChunkCache(path)
+                store.clear()
+                continue
             if os.path.exists(path):
                 shutil.rmtree(path)
             os.mkdir(path)
@@ -126,7 +166,8 @@ class GCPlugin(cliapp.Plugin):
                             chatty=True)
             return
         lac = morphlib.localartifactcache.LocalArtifactCache(
-            fs.osfs.OSFS(os.path.join(cache_path, 'artifacts')))
+            fs.osfs.OSFS(os.path.join(cache_path, 'artifacts')),
+            self.app.settings['artifact-cache-layout'])
         max_age, min_age = self.calculate_delete_range()
         logging.debug('Must remove artifacts older than timestamp %d'
                       % max_age)
@@ -143,21 +184,25 @@ class GCPlugin(cliapp.Plugin):
                             cachekey=cachekey, chatty=True)
             lac.remove(cachekey)
             removed += 1
+        # Files shared by deduplicated chunk artifacts are only freed
+        # once no artifact uses them. Finding those means looking through
+        # every chunk artifact, so it is only done after each batch of
+        # removals.
+        if removed > 0:
+            lac.remove_unused_blobs()
 
         # Maybe remove remaining middle-aged artifacts
-        for cachekey in may_delete:
-            if sufficient_free():
-                self.app.status(msg='Finished cleaning up cachedir with '
-                                    '%(remaining)d old sources remaining',
-                                remaining=(source_count - removed),
-                                chatty=True)
-                break
-            self.app.status(msg='Removing source %(cachekey)s',
+        for cachekey in lac.remove_until(may_delete, sufficient_free):
+            self.app.status(msg='Removed source %(cachekey)s',
                             cachekey=cachekey, chatty=True)
-            lac.remove(cachekey)
             removed += 1
 
         if sufficient_free():
+            if removed < source_count:
+                self.app.status(msg='Finished cleaning up cachedir with '
+                                    '%(remaining)d old sources remaining',
+                                remaining=(source_count - removed),
+                                chatty=True)
             self.app.status(msg='Made sufficient space in %(cache_path)s '
                                 'after removing %(removed)d sources',
                             removed=removed, cache_path=cache_path)
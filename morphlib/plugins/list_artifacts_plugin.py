@@ -58,8 +58,7 @@ class ListArtifactsPlugin(cliapp.Plugin):
         system_filenames = map(morphlib.util.sanitise_morphology_path,
                                args[2:])
 
-        self.lrc, self.rrc = morphlib.util.new_repo_caches(self.app)
-        self.resolver = morphlib.artifactresolver.ArtifactResolver()
+        self.build_command = morphlib.buildcommand.BuildCommand(self.app)
 
         artifact_files = set()
         for system_filename in system_filenames:
@@ -73,45 +72,20 @@ class ListArtifactsPlugin(cliapp.Plugin):
     def list_artifacts_for_system(self, repo, ref, system_filename):
         '''List all artifact files in the build graph of a single system.'''
 
-        # Sadly, we must use a fresh source pool and a fresh list of artifacts
-        # for each system. Creating a source pool is slow (queries every Git
-        # repo involved in the build) and resolving artifacts isn't so quick
-        # either. Unfortunately, each Source object can only have one set of
-        # Artifact objects associated, which means the source pool cannot mix
-        # sources that are being built for multiple architectures: the build
-        # graph representation does not distinguish chunks or strata of
-        # different architectures right now.
+        # Sadly, we must resolve a fresh build graph for each system,
+        # unless it is in the build graph cache. Creating a source pool is
+        # slow (queries every Git repo involved in the build) and resolving
+        # artifacts isn't so quick either. Unfortunately, each Source
+        # object can only have one set of Artifact objects associated,
+        # which means the source pool cannot mix sources that are being
+        # built for multiple architectures: the build graph representation
+        # does not distinguish chunks or strata of different architectures
+        # right now.
 
         self.app.status(
-            msg='Creating source pool for %s' % system_filename, chatty=True)
-        source_pool = morphlib.sourceresolver.create_source_pool(
-            self.lrc, self.rrc, repo, ref, system_filename,
-            cachedir=self.app.settings['cachedir'],
-            update_repos = not self.app.settings['no-git-update'],
-            status_cb=self.app.status)
-
-        self.app.status(
-            msg='Resolving artifacts for %s' % system_filename, chatty=True)
-        root_artifacts = self.resolver.resolve_root_artifacts(source_pool)
-
-        def find_artifact_by_name(artifacts_list, filename):
-            for a in artifacts_list:
-                if a.source.filename == filename:
-                    return a
-            raise ValueError
-
-        system_artifact = find_artifact_by_name(root_artifacts,
-                                                system_filename)
-
-        self.app.status(
-            msg='Computing cache keys for %s' % system_filename, chatty=True)
-        build_env = morphlib.buildenvironment.BuildEnvironment(
-            self.app.settings, system_artifact.source.morphology['arch'])
-        ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
-
-        for source in set(a.source for a in system_artifact.walk()):
-            source.cache_key = ckc.compute_key(source)
-            source.cache_id = ckc.get_cache_id(source)
+            msg='Resolving build graph for %s' % system_filename, chatty=True)
+        system_artifact = self.build_command.get_root_artifact(
+            repo, ref, system_filename, validate=False)
 
         artifact_files = set()
         for artifact in system_artifact.walk():
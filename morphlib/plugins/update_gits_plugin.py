@@ -0,0 +1,82 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import print_function
+
+import time
+
+import cliapp
+import morphlib
+
+
+class UpdateGitsPlugin(cliapp.Plugin):
+
+    def enable(self):
+        self.app.add_subcommand(
+            'update-gits', self.update_gits,
+            arg_synopsis='REPO REF MORPH [MORPH]...')
+
+    def disable(self):
+        pass
+
+    def update_gits(self, args):
+        '''Update the cached git repositories needed to build systems.
+
+        Command line arguments:
+
+        * `REPO` is a git repository URL.
+        * `REF` is a branch or other commit reference in that repository.
+        * `MORPH` is a system morphology name at that ref.
+
+        Every repository in the build graphs of the systems, and the
+        repositories of their submodules, are cloned into the local git
+        cache or updated, so that a build that follows need not fetch
+        anything. Repositories which already contain the commits that
+        are needed are left alone. Up to `--git-update-jobs` repositories
+        are fetched at once.
+
+        The output lists what was done to each repository and how long it
+        took, slowest first.
+
+        '''
+
+        if len(args) < 3:
+            raise cliapp.AppException(
+                'Wrong number of arguments to update-gits command '
+                '(see help)')
+
+        repo, ref = args[0], args[1]
+        system_filenames = map(morphlib.util.sanitise_morphology_path,
+                               args[2:])
+
+        build_command = morphlib.buildcommand.BuildCommand(self.app)
+
+        sources = set()
+        for system_filename in system_filenames:
+            root_artifact = build_command.get_root_artifact(
+                repo, ref, system_filename, validate=False)
+            sources.update(a.source for a in root_artifact.walk())
+
+        start = time.time()
+        try:
+            results = build_command.update_repos(sources)
+        finally:
+            build_command.lrc.close()
+
+        for repo_name, action, seconds in sorted(
+                results, key=lambda result: -result[2]):
+            print('%8.1fs %-8s %s' % (seconds, action, repo_name))
+        self.app.status(msg='Updated git repositories in %(seconds).1f '
+                            'seconds', seconds=time.time() - start)
@@ -14,18 +14,16 @@
 
 
 import cliapp
+import httplib
+import json
 import logging
+import socket
+import threading
 import urllib
 import urllib2
 import urlparse
 
 
-class HeadRequest(urllib2.Request):  # pragma: no cover
-
-    def get_method(self):
-        return 'HEAD'
-
-
 class GetError(cliapp.AppException):
 
     def __init__(self, cache, artifact):
@@ -53,14 +51,127 @@ class GetSourceMetadataError(GetError):
                   (name, source, cache_key, cache))
 
 
+class _PooledResponse(object):  # pragma: no cover
+
+    '''A response from a connection of a _ConnectionPool.
+
+    The connection goes back to the pool when the response is closed, if
+    all of it was read and the server did not ask to close it.
+
+    '''
+
+    def __init__(self, pool, connection, response):
+        self._pool = pool
+        self._connection = connection
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+
+    def read(self, size=None):
+        return self._response.read(size)
+
+    def close(self):
+        if self._connection is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.put(self._connection)
+        else:
+            self._connection.close()
+        self._response.close()
+        self._connection = None
+
+
+class _ConnectionPool(object):  # pragma: no cover
+
+    '''Persistent HTTP/1.1 connections to a server, kept for reuse.
+
+    Proxies are used as urllib2 would use them.
+
+    '''
+
+    def __init__(self, url):
+        parts = urlparse.urlsplit(url)
+        self._scheme = parts.scheme
+        self._netloc = parts.netloc
+        self._proxy = None
+        proxy = urllib.getproxies().get(self._scheme)
+        if proxy and not urllib.proxy_bypass(parts.hostname):
+            self._proxy = urlparse.urlsplit(proxy).netloc
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _connect(self):
+        if self._scheme == 'https':
+            connection = httplib.HTTPSConnection(self._proxy or self._netloc)
+            if self._proxy:
+                connection.set_tunnel(self._netloc)
+        else:
+            connection = httplib.HTTPConnection(self._proxy or self._netloc)
+        return connection
+
+    def get(self):
+        '''Return an idle connection, or a new one, and whether it's new.'''
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), False
+        return self._connect(), True
+
+    def put(self, connection):
+        with self._lock:
+            self._idle.append(connection)
+
+    def request(self, method, path, body=None, headers={}):
+        '''Make a request and return the response, or raise URLError.
+
+        The connection the request is made with is only reused once the
+        response has been read to the end and closed. Responses with
+        any status but 200 are raised as HTTPErrors.
+
+        '''
+
+        url = '%s://%s%s' % (self._scheme, self._netloc, path)
+        if self._proxy and self._scheme == 'http':
+            path = url
+        while True:
+            connection, new = self.get()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                # The server may have closed an idle connection.
+                if new:
+                    raise urllib2.URLError(e)
+        response = _PooledResponse(self, connection, response)
+        if response.status != httplib.OK:
+            response.read()
+            response.close()
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    None, None)
+        return response
+
+
 class RemoteArtifactCache(object):
 
     def __init__(self, server_url):
         self.server_url = server_url
+        self._pool = _ConnectionPool(server_url)
 
     def has(self, artifact):
         return self._has_file(artifact.basename())
 
+    def has_many(self, artifacts):
+        '''Return whether the cache has each of a list of artifacts.
+
+        This takes a single request, however many artifacts there are.
+        A list of booleans is returned, in the same order.
+
+        '''
+
+        present = self._has_files([a.basename() for a in artifacts])
+        return [a.basename() in present for a in artifacts]
+
     def has_artifact_metadata(self, artifact, name):
         return self._has_file(artifact.metadata_basename(name))
 
@@ -90,27 +201,55 @@ class RemoteArtifactCache(object):
             raise GetSourceMetadataError(self, source, cachekey, name)
 
     def _has_file(self, filename):  # pragma: no cover
-        url = self._request_url(filename)
-        logging.debug('RemoteArtifactCache._has_file: url=%s' % url)
-        request = HeadRequest(url)
+        logging.debug('RemoteArtifactCache._has_file: url=%s' %
+                      self._request_url(filename))
         try:
-            urllib2.urlopen(request)
+            response = self._pool.request('HEAD', self._request_path(filename))
+            # A HEAD response has no body, but httplib only sees that it
+            # is finished, so the connection can be reused, once read.
+            response.read()
+            response.close()
             return True
-        except (urllib2.HTTPError, urllib2.URLError):
+        except urllib2.URLError:
             return False
 
+    def _has_files(self, filenames):  # pragma: no cover
+        '''Return the set of the given files that are in the cache.
+
+        If the server cannot answer for all of them at once, each file is
+        checked on its own instead.
+
+        '''
+        logging.debug('RemoteArtifactCache._has_files: %d files' %
+                      len(filenames))
+        if not filenames:
+            return set()
+        try:
+            response = self._pool.request(
+                'POST', '/1.0/artifacts', json.dumps(filenames),
+                {'Content-Type': 'application/json'})
+            try:
+                results = json.loads(response.read())
+            finally:
+                response.close()
+        except (urllib2.URLError, ValueError) as e:
+            logging.debug('Checking for files in %s failed: %s' % (self, e))
+            return set(f for f in filenames if self._has_file(f))
+        return set(f for f in filenames if results.get(f))
+
     def _get_file(self, filename):  # pragma: no cover
-        url = self._request_url(filename)
-        logging.debug('RemoteArtifactCache._get_file: url=%s' % url)
-        return urllib2.urlopen(url)
+        logging.debug('RemoteArtifactCache._get_file: url=%s' %
+                      self._request_url(filename))
+        return self._pool.request('GET', self._request_path(filename))
+
+    def _request_path(self, filename):
+        return '/1.0/artifacts?filename=%s' % urllib.quote(filename)
 
     def _request_url(self, filename):  # pragma: no cover
         server_url = self.server_url
         if not server_url.endswith('/'):
             server_url += '/'
-        return urlparse.urljoin(
-            server_url, '/1.0/artifacts?filename=%s' % 
-            urllib.quote(filename))
+        return urlparse.urljoin(server_url, self._request_path(filename))
 
     def __str__(self):  # pragma: no cover
         return self.server_url
@@ -13,9 +13,13 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import BaseHTTPServer
+import SocketServer
 import StringIO
+import threading
 import unittest
 import urllib2
+import urlparse
 
 import morphlib
 
@@ -67,11 +71,15 @@ class RemoteArtifactCacheTests(unittest.TestCase):
         self.cache = morphlib.remoteartifactcache.RemoteArtifactCache(
             self.server_url)
         self.cache._has_file = self._has_file
+        self.cache._has_files = self._has_files
         self.cache._get_file = self._get_file
 
     def _has_file(self, filename):
         return filename in self.existing_files
 
+    def _has_files(self, filenames):
+        return set(filenames) & self.existing_files
+
     def _get_file(self, filename):
         if filename in self.existing_files:
             return StringIO.StringIO('%s' % filename)
@@ -90,6 +98,12 @@ class RemoteArtifactCacheTests(unittest.TestCase):
     def test_does_not_have_a_non_existent_artifact(self):
         self.assertFalse(self.cache.has(self.doc_artifact))
 
+    def test_has_many_artifacts(self):
+        self.assertEqual(self.cache.has_many([self.runtime_artifact,
+                                              self.doc_artifact,
+                                              self.devel_artifact]),
+                         [True, False, True])
+
     def test_has_existing_artifact_metadata(self):
         self.assertTrue(self.cache.has_artifact_metadata(
             self.runtime_artifact, 'meta'))
@@ -161,3 +175,77 @@ class RemoteArtifactCacheTests(unittest.TestCase):
         returned_url = self.cache._request_url('gtk+')
         correct_url = '%s/1.0/artifacts?filename=gtk%%2B' % self.server_url
         self.assertEqual(returned_url, correct_url)
+
+
+class FileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    # Handlers wait for more requests on kept-alive connections.
+    daemon_threads = True
+
+    connections = 0
+
+
+class FileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    files = {'a': 'a' * 100000, 'b': 'b'}
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self, send_body=False):
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+        data = self.files.get(query['filename'][0])
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def do_GET(self):
+        self.do_HEAD(send_body=True)
+
+
+class ConnectionReuseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FileServer(('127.0.0.1', 0), FileHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.cache = morphlib.remoteartifactcache.RemoteArtifactCache(
+            'http://127.0.0.1:%d' % self.server.server_port)
+
+    def tearDown(self):
+        for connection in self.cache._pool._idle:
+            connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_reuses_connection_after_head_requests(self):
+        self.assertTrue(self.cache._has_file('a'))
+        self.assertFalse(self.cache._has_file('c'))
+        self.assertTrue(self.cache._has_file('b'))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_reuses_connection_after_files_are_read(self):
+        for filename in ('a', 'b', 'a'):
+            response = self.cache._get_file(filename)
+            self.assertEqual(response.read(), FileHandler.files[filename])
+            response.close()
+        self.assertTrue(self.cache._has_file('a'))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_checks_files_one_at_a_time_if_bulk_check_fails(self):
+        self.assertEqual(self.cache._has_files(['a', 'c', 'b']),
+                         set(['a', 'b']))
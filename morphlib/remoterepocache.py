@@ -13,6 +13,7 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import base64
 import cliapp
 import json
 import logging
@@ -20,6 +21,8 @@ import urllib2
 import urlparse
 import urllib
 
+import morphlib
+
 
 class ResolveRefError(cliapp.AppException):
 
@@ -46,6 +49,9 @@ class LsTreeError(cliapp.AppException):
 
 class RemoteRepoCache(object):
 
+    # How many refs or files to ask about in one batch request.
+    batch_size = 200
+
     def __init__(self, server_url, resolver):
         self.server_url = server_url
         self._resolver = resolver
@@ -68,6 +74,59 @@ class RemoteRepoCache(object):
                 raise CatFileError(repo_name, ref, filename)
             raise # pragma: no cover
 
+    def resolve_refs(self, pairs):
+        '''Resolve many (repo_name, ref) pairs with a few requests.
+
+        Returns a dict mapping each pair to a (commit SHA1, tree SHA1)
+        tuple, or to None if the cache server could not resolve it.
+        Errors making the requests themselves are raised.
+
+        '''
+
+        result = {}
+        for batch in morphlib.util.iter_trickle(pairs, self.batch_size):
+            answers = self._resolve_refs_for_repo_urls(
+                [(self._resolver.pull_url(repo_name), ref)
+                 for repo_name, ref in batch])
+            self._check_answers(batch, answers)
+            for pair, info in zip(batch, answers):
+                if 'error' in info:
+                    logging.debug('Cannot resolve %s %s remotely: %s' %
+                                  (pair + (info['error'],)))
+                    result[pair] = None
+                else:
+                    result[pair] = info['sha1'], info['tree']
+        return result
+
+    def cat_files(self, triples):
+        '''Read many (repo_name, ref, filename) files with a few requests.
+
+        Returns a dict mapping each triple to the contents of the file,
+        or to None if the cache server could not read it. Errors making
+        the requests themselves are raised.
+
+        '''
+
+        result = {}
+        for batch in morphlib.util.iter_trickle(triples, self.batch_size):
+            answers = self._cat_files_for_repo_urls(
+                [(self._resolver.pull_url(repo_name), ref, filename)
+                 for repo_name, ref, filename in batch])
+            self._check_answers(batch, answers)
+            for triple, info in zip(batch, answers):
+                if 'error' in info:
+                    result[triple] = None
+                else:
+                    result[triple] = base64.b64decode(info['data'])
+        return result
+
+    def _check_answers(self, batch, answers):
+        # The cache server answers in the order it was asked.
+        if not isinstance(answers, list) or len(answers) != len(batch):
+            raise cliapp.AppException(
+                'Unexpected answer from cache server %s to a batch of %d '
+                'requests' % (self.server_url, len(batch)))
+
     def ls_tree(self, repo_name, ref):
         repo_url = self._resolver.pull_url(repo_name)
         try:
@@ -83,6 +142,16 @@ class RemoteRepoCache(object):
         info = json.loads(data)
         return info['sha1'], info['tree']
 
+    def _resolve_refs_for_repo_urls(self, pairs):  # pragma: no cover
+        return json.loads(self._make_request(
+            'sha1s', [{'repo': repo_url, 'ref': ref}
+                      for repo_url, ref in pairs]))
+
+    def _cat_files_for_repo_urls(self, triples):  # pragma: no cover
+        return json.loads(self._make_request(
+            'files', [{'repo': repo_url, 'ref': ref, 'filename': filename}
+                      for repo_url, ref, filename in triples]))
+
     def _cat_file_for_repo_url(self, repo_url, ref,
                                filename):  # pragma: no cover
         return self._make_request(
@@ -96,10 +165,15 @@ class RemoteRepoCache(object):
     def _quote_strings(self, *args):  # pragma: no cover
         return tuple(urllib.quote(string) for string in args)
 
-    def _make_request(self, path):  # pragma: no cover
+    def _make_request(self, path, json_data=None):  # pragma: no cover
         server_url = self.server_url
         if not server_url.endswith('/'):
             server_url += '/'
         url = urlparse.urljoin(server_url, '/1.0/%s' % path)
-        handle = urllib2.urlopen(url)
+        if json_data is None:
+            handle = urllib2.urlopen(url)
+        else:
+            handle = urllib2.urlopen(urllib2.Request(
+                url, data=json.dumps(json_data),
+                headers={'Content-Type': 'application/json'}))
         return handle.read()
@@ -13,10 +13,13 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import base64
 import json
 import unittest
 import urllib2
 
+import cliapp
+
 import morphlib
 
 
@@ -32,6 +35,33 @@ class RemoteRepoCacheTests(unittest.TestCase):
             raise urllib2.HTTPError(url='', code=404, msg='Not found',
                                     hdrs={}, fp=None)
 
+    def _resolve_refs_for_repo_urls(self, pairs):
+        self.batches.append(len(pairs))
+        result = []
+        for repo_url, ref in pairs:
+            try:
+                sha1 = self.sha1s[repo_url][ref]
+                result.append({'repo': repo_url, 'ref': ref,
+                               'sha1': sha1, 'tree': 'tree of ' + sha1})
+            except KeyError:
+                result.append({'repo': repo_url, 'ref': ref,
+                               'error': 'not found'})
+        return result
+
+    def _cat_files_for_repo_urls(self, triples):
+        self.batches.append(len(triples))
+        result = []
+        for repo_url, sha1, filename in triples:
+            try:
+                data = self.files[repo_url][sha1][filename]
+                result.append({'repo': repo_url, 'ref': sha1,
+                               'filename': filename,
+                               'data': base64.b64encode(data)})
+            except KeyError:
+                result.append({'repo': repo_url, 'ref': sha1,
+                               'filename': filename, 'error': 'not found'})
+        return result
+
     def _ls_tree_for_repo_url(self, repo_url, sha1):
         return json.dumps({
             'repo': repo_url,
@@ -63,6 +93,10 @@ class RemoteRepoCacheTests(unittest.TestCase):
         self.cache._resolve_ref_for_repo_url = self._resolve_ref_for_repo_url
         self.cache._cat_file_for_repo_url = self._cat_file_for_repo_url
         self.cache._ls_tree_for_repo_url = self._ls_tree_for_repo_url
+        self.cache._resolve_refs_for_repo_urls = \
+            self._resolve_refs_for_repo_urls
+        self.cache._cat_files_for_repo_urls = self._cat_files_for_repo_urls
+        self.batches = []
 
     def test_sets_server_url(self):
         self.assertEqual(self.cache.server_url, self.server_url)
@@ -135,3 +169,33 @@ class RemoteRepoCacheTests(unittest.TestCase):
         self.assertRaises(morphlib.remoterepocache.LsTreeError,
                           self.cache.ls_tree, 'non-existent-repo',
                           'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9')
+
+    def test_resolves_many_refs(self):
+        pairs = [('baserock:morph', 'master'), ('baserock:morph', 'foo'),
+                 ('non-existent-repo', 'master')]
+        sha1 = self.sha1s['git://gitorious.org/baserock/morph']['master']
+        self.assertEqual(self.cache.resolve_refs(pairs), {
+            ('baserock:morph', 'master'): (sha1, 'tree of ' + sha1),
+            ('baserock:morph', 'foo'): None,
+            ('non-existent-repo', 'master'): None,
+        })
+
+    def test_cats_many_files(self):
+        sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        triples = [('upstream:linux', sha1, 'linux.morph'),
+                   ('upstream:linux', sha1, 'non-existent-file')]
+        self.assertEqual(self.cache.cat_files(triples), {
+            ('upstream:linux', sha1, 'linux.morph'): 'linux morphology',
+            ('upstream:linux', sha1, 'non-existent-file'): None,
+        })
+
+    def test_splits_many_requests_into_batches(self):
+        self.cache.batch_size = 2
+        pairs = [('baserock:morph', 'ref%d' % i) for i in xrange(5)]
+        self.assertEqual(len(self.cache.resolve_refs(pairs)), 5)
+        self.assertEqual(self.batches, [2, 2, 1])
+
+    def test_rejects_answer_of_wrong_length(self):
+        self.cache._resolve_refs_for_repo_urls = lambda pairs: []
+        self.assertRaises(cliapp.AppException, self.cache.resolve_refs,
+                          [('baserock:morph', 'master')])
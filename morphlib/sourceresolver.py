@@ -15,11 +15,10 @@
 
 import collections
 import cPickle
+import hashlib
 import logging
 import os
-import pylru
-import shutil
-import tempfile
+import threading
 import yaml
 
 import cliapp
@@ -27,19 +26,21 @@ import cliapp
 import morphlib
 
 tree_cache_size = 10000
-tree_cache_filename = 'trees.cache.pickle'
+tree_cache_filename = 'trees.cache.sqlite'
 buildsystem_cache_size = 10000
-buildsystem_cache_filename = 'detected-chunk-buildsystems.cache.pickle'
+buildsystem_cache_filename = 'detected-chunk-buildsystems.cache.sqlite'
+morphology_cache_size = 10000
+morphology_cache_filename = 'morphologies.cache.sqlite'
 
 supported_versions = [0, 1]
 
-class PickleCacheManager(object): # pragma: no cover
-    '''Cache manager for PyLRU that reads and writes to Pickle files.
+class SqliteCacheManager(object):
+    '''Cache manager for the SourceResolver's caches of resolved refs.
 
-    The 'pickle' format is less than ideal in many ways and is actually
-    slower than JSON in Python. However, the data we need to cache is keyed
-    by tuples and in JSON a dict can only be keyed with strings. For now,
-    using 'pickle' seems to be the least worst option.
+    Each cache is a morphlib.sqlitecache.SqliteCache, so only the entries
+    that are used are read from disk, and saving it only writes the
+    entries that were added, without losing those saved by other morph
+    processes in the meantime.
 
     '''
 
@@ -47,38 +48,14 @@ class PickleCacheManager(object): # pragma: no cover
         self.filename = filename
         self.size = size
 
-    def _populate_cache_from_file(self, filename, cache):
-        try:
-            with open(filename, 'r') as f:
-                data = cPickle.load(f)
-            for key, value in data.iteritems():
-                cache[key] = value
-        except (EOFError, IOError, cPickle.PickleError) as e:
-            logging.warning('Failed to load cache %s: %s', self.filename, e)
-
     def load_cache(self):
-        '''Create a pylru.lrucache object prepopulated with saved data.'''
-        cache = pylru.lrucache(self.size)
-        # There should be a more efficient way to do this, by hooking into
-        # the json module directly.
-        self._populate_cache_from_file(self.filename, cache)
-        return cache
+        '''Open the cache.'''
+        return morphlib.sqlitecache.SqliteCache(self.filename, self.size)
 
     def save_cache(self, cache):
-        '''Save the data from a pylru.lrucache object to disk.
-
-        Any changes that have been made by other instances or processes since
-        load_cache() was called will be overwritten.
-
-        '''
-        data = {}
-        for key, value in cache.items():
-            data[key] = value
-        try:
-            with morphlib.savefile.SaveFile(self.filename, 'w') as f:
-                cPickle.dump(data, f)
-        except (IOError, cPickle.PickleError) as e:
-            logging.warning('Failed to save cache to %s: %s', self.filename, e)
+        '''Save what has been added to the cache to disk, and close it.'''
+        cache.save()
+        cache.close()
 
 
 class SourceResolverError(cliapp.AppException):
@@ -139,20 +116,29 @@ class SourceResolver(object):
 
     def __init__(self, local_repo_cache, remote_repo_cache,
                  tree_cache_manager, buildsystem_cache_manager, update_repos,
-                 status_cb=None):
+                 status_cb=None, jobs=1, morphology_cache_manager=None):
         self.lrc = local_repo_cache
         self.rrc = remote_repo_cache
         self.tree_cache_manager = tree_cache_manager
         self.buildsystem_cache_manager = buildsystem_cache_manager
+        self.morphology_cache_manager = morphology_cache_manager
 
         self.update = update_repos
         self.status = status_cb
+        self.jobs = jobs
 
         self._resolved_trees = {}
         self._resolved_morphologies = {}
         self._resolved_buildsystems = {}
+        self._parsed_morphologies = {}
+        # Answers from the remote repo cache, asked for in batches.
+        self._remote_refs = {}
+        self._remote_files = {}
+        # The tree and build system caches are shared by the chunk
+        # processing threads, which check for an entry and then read it.
+        self._cache_lock = threading.Lock()
 
-        self._definitions_checkout_dir = None
+        self._definitions_cached_repo = None
 
     def cache_repo_locally(self, reponame):
         if self.update:
@@ -166,6 +152,10 @@ class SourceResolver(object):
             repo = self.lrc.get_repo(reponame)
         return repo
 
+    def resolve_ref(self, reponame, ref): # pragma: no cover
+        '''Return the commit SHA1 that a ref of a repo points to.'''
+        return self._resolve_ref(reponame, ref)[0]
+
     def _resolve_ref(self, reponame, ref): # pragma: no cover
         '''Resolves commit and tree sha1s of the ref in a repo and returns it.
 
@@ -179,10 +169,14 @@ class SourceResolver(object):
 
         # The Baserock reference definitions use absolute refs so, and, if the
         # absref is cached, we can short-circuit all this code.
-        if (reponame, ref) in self._resolved_trees:
+        tree = None
+        with self._cache_lock:
+            if (reponame, ref) in self._resolved_trees:
+                tree = self._resolved_trees[(reponame, ref)]
+        if tree is not None:
             logging.debug('Returning tree (%s, %s) from tree cache',
                           reponame, ref)
-            return ref, self._resolved_trees[(reponame, ref)]
+            return ref, tree
 
         logging.debug('tree (%s, %s) not in cache', reponame, ref)
 
@@ -197,6 +191,9 @@ class SourceResolver(object):
             # available locally, this call will raise an exception.
             absref = repo.resolve_ref_to_commit(ref)
             tree = repo.resolve_ref_to_tree(absref)
+        elif (reponame, ref) in self._remote_refs:
+            if self._remote_refs[(reponame, ref)] is not None:
+                absref, tree = self._remote_refs[(reponame, ref)]
         elif self.rrc is not None:
             try:
                 absref, tree = self.rrc.resolve_ref(reponame, ref)
@@ -216,16 +213,17 @@ class SourceResolver(object):
 
         logging.debug('Writing tree to cache with ref (%s, %s)',
                       reponame, absref)
-        self._resolved_trees[(reponame, absref)] = tree
+        with self._cache_lock:
+            self._resolved_trees[(reponame, absref)] = tree
 
         return absref, tree
 
     def _get_file_contents_from_definitions(self,
                                             filename):  # pragma: no cover
-        if os.path.exists(filename):
-            with open(filename) as f:
-                return f.read()
-        else:
+        try:
+            return self._definitions_cached_repo.read_file(
+                filename, self._definitions_absref, follow_symlinks=True)
+        except IOError:
             return None
 
     def _get_file_contents_from_repo(self, reponame,
@@ -239,6 +237,8 @@ class SourceResolver(object):
                 text = repo.read_file(filename, sha1)
             except IOError:
                 text = None
+        elif (reponame, sha1, filename) in self._remote_files:
+            text = self._remote_files[(reponame, sha1, filename)]
         elif self.rrc is not None:
             self.status(msg="Looking for %(reponame)s:%(filename)s in the "
                             "remote repo cache.",
@@ -263,11 +263,9 @@ class SourceResolver(object):
 
         if reponame == self._definitions_repo and \
                 sha1 == self._definitions_absref: # pragma: no cover
-            # There is a temporary local checkout of the definitions repo which
-            # we can quickly read definitions files from.
-            defs_filename = os.path.join(self._definitions_checkout_dir,
-                                         filename)
-            text = self._get_file_contents_from_definitions(defs_filename)
+            # The definitions repo is always cached locally, and files are
+            # read from it as they would be from a checkout.
+            text = self._get_file_contents_from_definitions(filename)
         else:
             text = self._get_file_contents_from_repo(reponame, sha1, filename)
 
@@ -283,16 +281,44 @@ class SourceResolver(object):
         if key in self._resolved_morphologies:
             return self._resolved_morphologies[key]
 
-        loader = morphlib.morphloader.MorphologyLoader()
-
         text = self._get_file_contents(reponame, sha1, filename)
-        morph = loader.load_from_string(text)
+        morph = self._load_morphology(text)
 
         if morph is not None:
             self._resolved_morphologies[key] = morph
 
         return morph
 
+    def _load_morphology(self, text):
+        '''Parse, validate and set the defaults of a morphology.
+
+        The result is kept in the morphology cache, keyed by the git blob
+        SHA1 of the text and the version of Morph, so loading the same
+        text again, in this or any later run, needs no YAML parsing or
+        validation. Morph versions with uncommitted changes don't use
+        the cache.
+
+        '''
+
+        if text is None:
+            return None
+
+        loader = morphlib.morphloader.MorphologyLoader()
+        version = morphlib.__version__
+        if version.endswith('-unreproducible'):
+            return loader.load_from_string(text)
+
+        blob = hashlib.sha1('blob %d\0%s' % (len(text), text)).hexdigest()
+        key = (blob, version)
+        pickled = self._parsed_morphologies.get(key)
+        if pickled is None:
+            morph = loader.load_from_string(text)
+            self._parsed_morphologies[key] = cPickle.dumps(
+                morph, cPickle.HIGHEST_PROTOCOL)
+            return morph
+        # Each caller gets its own copy, which it may change.
+        return cPickle.loads(pickled)
+
     def _detect_build_system(self, reponame, sha1, expected_filename):
         '''Attempt to detect buildsystem of the given commit.
 
@@ -442,7 +468,8 @@ class SourceResolver(object):
                                               morph_name): # pragma: no cover
         logging.debug('Caching build system for chunk with key %s', chunk_key)
 
-        self._resolved_buildsystems[chunk_key] = buildsystem
+        with self._cache_lock:
+            self._resolved_buildsystems[chunk_key] = buildsystem
 
         morphology = self._create_morphology_for_build_system(buildsystem,
                                                               morph_name)
@@ -470,12 +497,14 @@ class SourceResolver(object):
         absref, tree = self._resolve_ref(chunk_repo, chunk_ref)
         chunk_key = (chunk_repo, absref, filename)
 
-        if chunk_key in self._resolved_buildsystems:
+        with self._cache_lock:
+            if chunk_key in self._resolved_buildsystems:
+                buildsystem = self._resolved_buildsystems[chunk_key]
+        if buildsystem is not None:
             logging.debug('Build system for %s is cached', str(chunk_key))
             self.status(msg='Build system for %(chunk)s is cached',
                         chunk=str(chunk_key),
                         chatty=True)
-            buildsystem = self._resolved_buildsystems[chunk_key]
 
             # If the build system for this chunk is cached then:
             #   * the chunk does not have a chunk morph
@@ -510,6 +539,93 @@ class SourceResolver(object):
 
         visit(chunk_repo, chunk_ref, filename, absref, tree, morphology)
 
+    def ask_remote_repo_cache(self, definition_repo, definition_ref,
+                              chunk_queue):
+        '''Ask the remote repo cache about all the chunks at once.
+
+        The refs of chunks from repos that aren't cached locally are
+        resolved, and their chunk morphologies read, with a few batch
+        requests instead of one request per chunk. The answers are kept
+        for process_chunk to use. Anything left unanswered is looked up
+        one at a time as before.
+
+        '''
+
+        if self.rrc is None:
+            return
+
+        remote_chunks = sorted((repo, ref, filename)
+                               for repo, ref, filename in chunk_queue
+                               if not self.lrc.has_repo(repo))
+        pairs = sorted(set((repo, ref) for repo, ref, filename
+                           in remote_chunks
+                           if (repo, ref) not in self._resolved_trees))
+        if pairs:
+            self.status(msg='Resolving %(count)s refs via remote repo cache',
+                        count=len(pairs), chatty=True)
+            try:
+                self._remote_refs.update(self.rrc.resolve_refs(pairs))
+            except BaseException as e:
+                logging.warning('Caught (and ignored) exception: %s' % str(e))
+                return
+
+        # Chunks with a morphology in the definitions repo, or with a
+        # known build system, don't need their own morphology looked up.
+        triples = []
+        for repo, ref, filename in remote_chunks:
+            if (repo, ref) in self._resolved_trees:
+                absref = ref
+            elif self._remote_refs.get((repo, ref)) is not None:
+                absref = self._remote_refs[(repo, ref)][0]
+            else:
+                # The repo will be cloned to resolve the ref.
+                absref = None
+            if (absref is not None and
+                    (repo, absref, filename) not in
+                    self._resolved_buildsystems and
+                    self._get_morphology(definition_repo, definition_ref,
+                                         filename) is None):
+                triples.append((repo, absref, filename))
+        if triples:
+            self.status(msg='Looking for %(count)s chunk morphologies in the '
+                            'remote repo cache',
+                        count=len(triples), chatty=True)
+            try:
+                self._remote_files.update(self.rrc.cat_files(triples))
+            except BaseException as e:
+                logging.warning('Caught (and ignored) exception: %s' % str(e))
+
+    def process_chunks(self, definition_repo, definition_ref, chunk_queue,
+                       visit):
+        '''Process the chunks in the queue, using up to self.jobs threads.
+
+        Chunks from the same repo are processed one at a time, so that a
+        cached repo is never updated or cloned by two threads at once.
+
+        The chunks are visited once they have all been processed, in the
+        order of the sorted queue, so the result does not depend on the
+        order the threads happened to finish in.
+
+        '''
+
+        chunk_queue = sorted(chunk_queue)
+        repo_locks = dict((repo, threading.Lock())
+                          for repo, ref, filename in chunk_queue)
+
+        def process(chunk):
+            repo, ref, filename = chunk
+            visits = []
+            with repo_locks[repo]:
+                self.process_chunk(definition_repo, definition_ref, repo,
+                                   ref, filename,
+                                   lambda *args: visits.append(args))
+            return visits
+
+        for visits in morphlib.util.map_concurrently(process, chunk_queue,
+                                                     self.jobs):
+            for args in visits:
+                visit(*args)
+
     def traverse_morphs(self, definitions_repo, definitions_ref,
                         system_filenames,
                         visit=lambda rn, rf, fn, arf, m: None,
@@ -517,6 +633,9 @@ class SourceResolver(object):
         self._resolved_trees = self.tree_cache_manager.load_cache()
         self._resolved_buildsystems = \
             self.buildsystem_cache_manager.load_cache()
+        if self.morphology_cache_manager is not None:
+            self._parsed_morphologies = \
+                self.morphology_cache_manager.load_cache()
 
         # Resolve the (repo, ref) pair for the definitions repo, cache result.
         definitions_absref, definitions_tree = self._resolve_ref(
@@ -525,19 +644,16 @@ class SourceResolver(object):
         if definitions_original_ref:
             definitions_ref = definitions_original_ref
 
-        self._definitions_checkout_dir = tempfile.mkdtemp()
-
         try:
             # FIXME: not an ideal way of passing this info across
             self._definitions_repo = definitions_repo
             self._definitions_absref = definitions_absref
             try:
-                definitions_cached_repo = self.lrc.get_repo(definitions_repo)
+                self._definitions_cached_repo = self.lrc.get_repo(
+                    definitions_repo)
             except morphlib.localrepocache.NotCached:
-                definitions_cached_repo = self.cache_repo_locally(
+                self._definitions_cached_repo = self.cache_repo_locally(
                     definitions_repo)
-            definitions_cached_repo.extract_commit(
-                definitions_absref, self._definitions_checkout_dir)
 
             # First, process the system and its stratum morphologies. These
             # will all live in the same Git repository, and will point to
@@ -547,12 +663,13 @@ class SourceResolver(object):
                     definitions_absref, definitions_tree, visit)
 
             # Now process all the chunks involved in the build.
-            for repo, ref, filename in chunk_queue:
-                self.process_chunk(definitions_repo, definitions_absref, repo,
-                                   ref, filename, visit)
+            self.ask_remote_repo_cache(definitions_repo, definitions_absref,
+                                       chunk_queue)
+            self.process_chunks(definitions_repo, definitions_absref,
+                                chunk_queue, visit)
         finally:
-            shutil.rmtree(self._definitions_checkout_dir)
-            self._definitions_checkout_dir = None
+            self._definitions_cached_repo = None
+            self.lrc.close()
 
             logging.debug('Saving contents of resolved tree cache')
             self.tree_cache_manager.save_cache(self._resolved_trees)
@@ -561,10 +678,15 @@ class SourceResolver(object):
             self.buildsystem_cache_manager.save_cache(
                 self._resolved_buildsystems)
 
+            if self.morphology_cache_manager is not None:
+                logging.debug('Saving contents of morphology cache')
+                self.morphology_cache_manager.save_cache(
+                    self._parsed_morphologies)
+
 
 def create_source_pool(lrc, rrc, repo, ref, filename, cachedir,
                        original_ref=None, update_repos=True,
-                       status_cb=None): # pragma: no cover
+                       status_cb=None, jobs=1): # pragma: no cover
     '''Find all the sources involved in building a given system.
 
     Given a system morphology, this function will traverse the tree of stratum
@@ -576,7 +698,8 @@ def create_source_pool(lrc, rrc, repo, ref, filename, cachedir,
     implementation, and so they must be handled separately.
 
     The 'lrc' and 'rrc' parameters specify the local and remote Git repository
-    caches used for resolving the sources.
+    caches used for resolving the sources. Up to 'jobs' chunks are resolved
+    at once.
 
     '''
     pool = morphlib.sourcepool.SourcePool()
@@ -588,16 +711,20 @@ def create_source_pool(lrc, rrc, repo, ref, filename, cachedir,
         for source in sources:
             pool.add(source)
 
-    tree_cache_manager = PickleCacheManager(
+    tree_cache_manager = SqliteCacheManager(
         os.path.join(cachedir, tree_cache_filename), tree_cache_size)
 
-    buildsystem_cache_manager = PickleCacheManager(
+    buildsystem_cache_manager = SqliteCacheManager(
         os.path.join(cachedir, buildsystem_cache_filename),
         buildsystem_cache_size)
 
+    morphology_cache_manager = SqliteCacheManager(
+        os.path.join(cachedir, morphology_cache_filename),
+        morphology_cache_size)
+
     resolver = SourceResolver(lrc, rrc, tree_cache_manager,
                               buildsystem_cache_manager, update_repos,
-                              status_cb)
+                              status_cb, jobs, morphology_cache_manager)
     resolver.traverse_morphs(repo, ref, [filename],
                              visit=add_to_pool,
                              definitions_original_ref=original_ref)
@@ -16,11 +16,13 @@
 import os
 import shutil
 import tempfile
+import time
 import unittest
 
 import morphlib
+import morphlib.gitdir_tests
 from morphlib.sourceresolver import (SourceResolver,
-                                     PickleCacheManager,
+                                     SqliteCacheManager,
                                      MorphologyNotFoundError)
 from morphlib.remoterepocache import CatFileError, LsTreeError
 
@@ -156,12 +158,12 @@ class SourceResolverTests(unittest.TestCase):
 
         self.cachedir = tempfile.mkdtemp()
         buildsystem_cache_file = os.path.join(self.cachedir,
-            'detected-chunk-buildsystems.cache.pickle')
-        buildsystem_cache_manager = PickleCacheManager(
+            'detected-chunk-buildsystems.cache.sqlite')
+        buildsystem_cache_manager = SqliteCacheManager(
             buildsystem_cache_file, 1000)
 
-        tree_cache_file = os.path.join(self.cachedir, 'trees.cache.pickle')
-        tree_cache_manager = PickleCacheManager(tree_cache_file, 1000)
+        tree_cache_file = os.path.join(self.cachedir, 'trees.cache.sqlite')
+        tree_cache_manager = SqliteCacheManager(tree_cache_file, 1000)
 
         def status(msg='', **kwargs):
             pass
@@ -334,3 +336,173 @@ class SourceResolverTests(unittest.TestCase):
             morphlib.morphloader.EmptyStratumError,
             self.sr._get_morphology, 'reponame', 'sha1', 'stratum-empty.morph')
 
+
+    def test_visits_chunks_in_sorted_order(self):
+        def process_chunk(definition_repo, definition_ref, repo, ref,
+                          filename, visit):
+            time.sleep(0.01 * len(filename))
+            visit(repo, ref, filename)
+        self.sr.process_chunk = process_chunk
+        self.sr.jobs = 4
+        chunks = set([('b', 'master', 'b.morph'), ('a', 'master', 'a.morph'),
+                      ('a', 'other', 'a-other-branch.morph'),
+                      ('c', 'master', 'c.morph')])
+        visited = []
+        self.sr.process_chunks('definitions', 'sha1', chunks,
+                               lambda *args: visited.append(args))
+        self.assertEqual(visited, sorted(chunks))
+
+    def test_processes_one_chunk_from_each_repo_at_once(self):
+        running = set()
+        overlaps = []
+        def process_chunk(definition_repo, definition_ref, repo, ref,
+                          filename, visit):
+            if repo in running:
+                overlaps.append(repo)
+            running.add(repo)
+            time.sleep(0.01)
+            running.remove(repo)
+        self.sr.process_chunk = process_chunk
+        self.sr.jobs = 4
+        chunks = [('repo', 'ref%d' % i, 'chunk.morph') for i in xrange(4)]
+        self.sr.process_chunks('definitions', 'sha1', chunks,
+                               lambda *args: None)
+        self.assertEqual(overlaps, [])
+
+    def test_asks_remote_repo_cache_about_all_chunks_at_once(self):
+        requests = []
+        def resolve_refs(pairs):
+            requests.append(('resolve_refs', pairs))
+            return dict((pair, ('%s-sha1' % pair[0], '%s-tree' % pair[0]))
+                        for pair in pairs)
+        def cat_files(triples):
+            requests.append(('cat_files', triples))
+            return dict((triple, 'name: %s\nkind: chunk\n' % triple[0])
+                        for triple in triples)
+        self.lrc.has_repo = self.doesnothaverepo
+        self.rrc.cat_file = self.noremotemorph
+        self.rrc.resolve_refs = resolve_refs
+        self.rrc.cat_files = cat_files
+        chunks = set([('a', 'master', 'a.morph'), ('b', 'master', 'b.morph')])
+        self.sr.ask_remote_repo_cache('definitions', 'sha1', chunks)
+        self.assertEqual(requests, [
+            ('resolve_refs', [('a', 'master'), ('b', 'master')]),
+            ('cat_files', [('a', 'a-sha1', 'a.morph'),
+                           ('b', 'b-sha1', 'b.morph')]),
+        ])
+        self.rrc.cat_file = self.noremotefile
+        self.assertEqual(self.sr._resolve_ref('a', 'master'),
+                         ('a-sha1', 'a-tree'))
+        morph = self.sr._get_morphology('b', 'b-sha1', 'b.morph')
+        self.assertEqual(morph['name'], 'b')
+
+    def test_uses_what_remote_repo_cache_answers_and_looks_up_the_rest(self):
+        requests = []
+        cloned = []
+        def resolve_refs(pairs):
+            requests.append(('resolve_refs', pairs))
+            return {('a', 'master'): ('a-sha1', 'a-tree'),
+                    ('b', 'master'): ('b-sha1', 'b-tree'),
+                    ('d', 'master'): None}
+        def cat_files(triples):
+            requests.append(('cat_files', triples))
+            return {('a', 'a-sha1', 'a.morph'): 'name: a\nkind: chunk\n',
+                    ('b', 'b-sha1', 'b.morph'): None}
+        def cat_file(reponame, sha1, filename):
+            if reponame == 'definitions' and filename == 'c.morph':
+                return 'name: c\nkind: chunk\n'
+            raise CatFileError(reponame, sha1, filename)
+        def cache_repo(reponame):
+            cloned.append(reponame)
+            return self.lr
+        self.lrc.has_repo = self.doesnothaverepo
+        self.lrc.cache_repo = cache_repo
+        self.lr.resolve_ref_to_commit = lambda ref: 'd-sha1'
+        self.lr.resolve_ref_to_tree = lambda sha1: 'd-tree'
+        self.rrc.cat_file = cat_file
+        self.rrc.resolve_refs = resolve_refs
+        self.rrc.cat_files = cat_files
+        self.sr._resolved_trees[('e', 'e-sha1')] = 'e-tree'
+        chunks = set([('a', 'master', 'a.morph'), ('b', 'master', 'b.morph'),
+                      ('c', 'master', 'c.morph'), ('d', 'master', 'd.morph'),
+                      ('e', 'e-sha1', 'e.morph')])
+        self.sr.ask_remote_repo_cache('definitions', 'sha1', chunks)
+        self.assertEqual(requests, [
+            ('resolve_refs', [('a', 'master'), ('b', 'master'),
+                              ('c', 'master'), ('d', 'master')]),
+            ('cat_files', [('a', 'a-sha1', 'a.morph'),
+                           ('b', 'b-sha1', 'b.morph'),
+                           ('e', 'e-sha1', 'e.morph')]),
+        ])
+
+        self.rrc.resolve_ref = lambda reponame, ref: (None, None)
+        self.assertEqual(self.sr._resolve_ref('a', 'master'),
+                         ('a-sha1', 'a-tree'))
+        self.assertEqual(self.sr._resolve_ref('d', 'master'),
+                         ('d-sha1', 'd-tree'))
+        self.assertEqual(cloned, ['d'])
+        self.assertEqual(
+            self.sr._get_morphology('a', 'a-sha1', 'a.morph')['name'], 'a')
+        self.assertEqual(self.sr._get_morphology('b', 'b-sha1', 'b.morph'),
+                         None)
+
+    def test_looks_up_chunks_one_at_a_time_if_batch_requests_fail(self):
+        def fail(*args):
+            raise morphlib.remoterepocache.ResolveRefError('a', 'master')
+        self.lrc.has_repo = self.doesnothaverepo
+        self.rrc.resolve_refs = fail
+        self.rrc.cat_files = fail
+        self.rrc.cat_file = self.noremotemorph
+        chunks = set([('a', 'master', 'a.morph')])
+        self.sr.ask_remote_repo_cache('definitions', 'sha1', chunks)
+        self.assertEqual(self.sr._remote_refs, {})
+
+        self.sr._resolved_trees[('a', 'a-sha1')] = 'a-tree'
+        chunks = set([('a', 'a-sha1', 'a.morph')])
+        self.sr.ask_remote_repo_cache('definitions', 'sha1', chunks)
+        self.assertEqual(self.sr._remote_files, {})
+
+        self.rrc.resolve_ref = lambda reponame, ref: ('a-sha1', 'a-tree')
+        self.assertEqual(self.sr._resolve_ref('a', 'master'),
+                         ('a-sha1', 'a-tree'))
+
+    def test_does_not_ask_remote_repo_cache_when_there_is_none(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        self.lsr.ask_remote_repo_cache(
+            'definitions', 'sha1', set([('a', 'master', 'a.morph')]))
+        self.assertEqual(self.lsr._remote_refs, {})
+
+    def test_cache_manager_saves_what_was_added(self):
+        manager = SqliteCacheManager(
+            os.path.join(self.cachedir, 'cache.sqlite'), 10)
+        cache = manager.load_cache()
+        cache[('repo', 'ref')] = 'tree'
+        manager.save_cache(cache)
+        cache = manager.load_cache()
+        self.assertEqual(cache[('repo', 'ref')], 'tree')
+        manager.save_cache(cache)
+
+    def load_twice(self, version):
+        loaded = []
+        def load_from_string(loader, text):
+            loaded.append(text)
+            return original(loader, text)
+        loader_class = morphlib.morphloader.MorphologyLoader
+        original = loader_class.load_from_string.im_func
+        with morphlib.gitdir_tests.monkeypatch(morphlib, '__version__',
+                                               version):
+            with morphlib.gitdir_tests.monkeypatch(
+                    loader_class, 'load_from_string', load_from_string):
+                first = self.sr._get_morphology('repo', 'sha1', 'chunk.morph')
+                second = self.sr._get_morphology('repo', 'sha2',
+                                                 'chunk.morph')
+        self.assertEqual(first, second)
+        self.assertFalse(first is second)
+        return loaded
+
+    def test_reuses_parsed_morphologies_with_the_same_text(self):
+        self.assertEqual(len(self.load_twice('cafef00d')), 1)
+
+    def test_parses_morphologies_again_with_unreproducible_version(self):
+        self.assertEqual(len(self.load_twice('cafef00d-unreproducible')), 2)
+        self.assertEqual(len(self.sr._parsed_morphologies), 0)
@@ -0,0 +1,161 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import cPickle
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+class SqliteCache(object):
+
+    '''A size-limited cache kept in an SQLite database.
+
+    This acts like a dict, but looks entries up in the database one at
+    a time as they are needed, rather than loading the whole cache.
+    Entries that are set are kept in memory until ``save`` is called,
+    which writes them to the database, together with when each entry
+    that was used was last used, in a single transaction. If there are
+    then more than ``size`` entries, the least recently used ones are
+    removed.
+
+    Several processes can use the same database at once: each only
+    writes the entries it set, so nothing another process saved is
+    lost. A cache can also be used from several threads.
+
+    Keys must be tuples (or lists) of strings and numbers, and values
+    anything that can be pickled. If the database can't be used, a
+    warning is logged and the cache behaves like an empty dict that is
+    not saved.
+
+    '''
+
+    # How long to wait for another process to finish writing.
+    timeout = 60
+
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._unsaved = set()
+        self._used = set()
+        self._db = None
+        try:
+            self._db = sqlite3.connect(filename, timeout=self.timeout,
+                                       check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS cache ('
+                    'key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                    'last_used REAL NOT NULL)')
+                self._db.execute(
+                    'CREATE INDEX IF NOT EXISTS cache_last_used '
+                    'ON cache (last_used)')
+        except sqlite3.Error as e:
+            self._failed('open', e)
+
+    def _failed(self, action, e):
+        logging.warning('Failed to %s cache %s: %s', action, self.filename, e)
+        if self._db is not None:
+            try:
+                self._db.close()
+            except sqlite3.Error:  # pragma: no cover
+                pass
+            self._db = None
+
+    @staticmethod
+    def _encode_key(key):
+        return json.dumps(list(key), separators=(',', ':'))
+
+    def _lookup(self, key):
+        # The result of looking in the database, missing or not, is
+        # remembered so each key is only looked up once.
+        if key not in self._entries:
+            value = None
+            if self._db is not None:
+                try:
+                    row = self._db.execute(
+                        'SELECT value FROM cache WHERE key = ?',
+                        (self._encode_key(key),)).fetchone()
+                    if row is not None:
+                        value = (cPickle.loads(str(row[0])),)
+                except (sqlite3.Error, cPickle.UnpicklingError) as e:
+                    self._failed('read', e)
+            self._entries[key] = value
+        entry = self._entries[key]
+        if entry is not None:
+            self._used.add(key)
+        return entry
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry = self._lookup(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[0]
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key)
+        return default if entry is None else entry[0]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = (value,)
+            self._unsaved.add(key)
+            self._used.add(key)
+
+    def save(self):
+        '''Write the changes made since the last save to the database.'''
+
+        with self._lock:
+            if self._db is None:
+                return
+            now = time.time()
+            try:
+                with self._db:
+                    self._db.executemany(
+                        'INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                        ((self._encode_key(key),
+                          sqlite3.Binary(cPickle.dumps(
+                              self._entries[key][0],
+                              cPickle.HIGHEST_PROTOCOL)),
+                          now)
+                         for key in self._unsaved))
+                    self._db.executemany(
+                        'UPDATE cache SET last_used = ? WHERE key = ?',
+                        ((now, self._encode_key(key))
+                         for key in self._used - self._unsaved))
+                    self._db.execute(
+                        'DELETE FROM cache WHERE key IN ('
+                        'SELECT key FROM cache ORDER BY last_used DESC '
+                        'LIMIT -1 OFFSET ?)', (self.size,))
+            except sqlite3.Error as e:
+                self._failed('save', e)
+            self._unsaved.clear()
+            self._used.clear()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,132 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import morphlib
+import morphlib.gitdir_tests
+
+
+class SqliteCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'cache.sqlite')
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        shutil.rmtree(self.tempdir)
+
+    def open(self, size=10):
+        cache = morphlib.sqlitecache.SqliteCache(self.filename, size)
+        self.caches.append(cache)
+        return cache
+
+    def test_is_empty_initially(self):
+        cache = self.open()
+        self.assertFalse(('repo', 'ref') in cache)
+        self.assertRaises(KeyError, cache.__getitem__, ('repo', 'ref'))
+        self.assertEqual(cache.get(('repo', 'ref')), None)
+
+    def test_remembers_what_is_set(self):
+        cache = self.open()
+        cache[('repo', 'ref')] = 'tree'
+        self.assertTrue(('repo', 'ref') in cache)
+        self.assertEqual(cache[('repo', 'ref')], 'tree')
+
+    def test_saves_entries(self):
+        cache = self.open()
+        cache[('repo', 'ref')] = {'tree': 'sha1'}
+        cache.save()
+        self.assertEqual(self.open()[('repo', 'ref')], {'tree': 'sha1'})
+
+    def test_does_not_save_until_asked(self):
+        cache = self.open()
+        cache[('repo', 'ref')] = 'tree'
+        self.assertFalse(('repo', 'ref') in self.open())
+
+    def test_keeps_entries_saved_by_others(self):
+        first = self.open()
+        second = self.open()
+        first[('repo', 'a')] = 'a'
+        second[('repo', 'b')] = 'b'
+        first.save()
+        second.save()
+        third = self.open()
+        self.assertEqual(third[('repo', 'a')], 'a')
+        self.assertEqual(third[('repo', 'b')], 'b')
+
+    def test_removes_least_recently_used_entries(self):
+        cache = self.open(size=2)
+        cache[('a',)] = 'a'
+        cache[('b',)] = 'b'
+        cache.save()
+        cache = self.open(size=2)
+        cache[('a',)]
+        cache[('c',)] = 'c'
+        cache.save()
+        cache = self.open(size=2)
+        self.assertTrue(('a',) in cache)
+        self.assertFalse(('b',) in cache)
+        self.assertTrue(('c',) in cache)
+
+    def test_works_in_memory_if_database_cannot_be_opened(self):
+        self.filename = os.path.join(self.tempdir, 'missing', 'cache.sqlite')
+        cache = self.open()
+        cache[('repo', 'ref')] = 'tree'
+        cache.save()
+        self.assertEqual(cache[('repo', 'ref')], 'tree')
+
+    def test_acts_as_empty_if_an_entry_cannot_be_read(self):
+        cache = self.open()
+        cache[('repo', 'a')] = 'a'
+        cache[('repo', 'b')] = 'b'
+        cache.save()
+        db = sqlite3.connect(self.filename)
+        with db:
+            db.execute("UPDATE cache SET value = 'not a pickle'")
+        db.close()
+
+        warnings = []
+        cache = self.open()
+        with morphlib.gitdir_tests.monkeypatch(
+                logging, 'warning', lambda *args: warnings.append(args)):
+            self.assertFalse(('repo', 'a') in cache)
+            self.assertFalse(('repo', 'b') in cache)
+        self.assertEqual(len(warnings), 1)
+        cache[('repo', 'c')] = 'c'
+        cache.save()
+        self.assertEqual(cache[('repo', 'c')], 'c')
+
+    def test_keeps_entries_in_memory_if_they_cannot_be_saved(self):
+        cache = self.open()
+        self.assertFalse(('repo', 'ref') in cache)
+        db = sqlite3.connect(self.filename)
+        with db:
+            db.execute('DROP TABLE cache')
+        db.close()
+        cache[('repo', 'ref')] = 'tree'
+        cache.save()
+        self.assertEqual(cache[('repo', 'ref')], 'tree')
+        cache[('repo', 'other')] = 'other'
+        cache.save()
+        self.assertEqual(cache[('repo', 'other')], 'other')
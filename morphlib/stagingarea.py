@@ -13,13 +13,14 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import copy
 import logging
 import os
+import resource
 import shutil
 import stat
 import cliapp
 from urlparse import urlparse
-import tempfile
 
 import morphlib
 
@@ -34,10 +35,21 @@ class StagingArea(object):
     system. Chunks built in 'test' or 'build-essential' mode have an empty
     staging area and are allowed to use the tools of the host.
 
+    Dependencies are installed by hardlinking every file of each unpacked
+    chunk into the staging area, unless the 'staging-area-backend' setting
+    is 'overlayfs'. In that case the unpacked chunks are stacked as the
+    lower layers of an overlay filesystem mounted on the staging area, so
+    the time taken does not depend on how many files the chunks contain.
+    Anything written to the staging area goes to an upper layer kept in
+    DIRNAME.overlay.
+
     '''
 
     _base_path = ['/sbin', '/usr/sbin', '/bin', '/usr/bin']
 
+    # overlayfs refuses to mount more lower layers than this.
+    max_overlay_layers = 500
+
     def __init__(self, app, dirname, build_env, use_chroot=True, extra_env={},
                  extra_path=[]):
         self._app = app
@@ -45,6 +57,10 @@ class StagingArea(object):
         self.builddirname = None
         self.destdirname = None
         self._bind_readonly_mount = None
+        self._readonly_paths = None
+        self._readonly_paths_key = None
+        self._layers = []
+        self._overlay_mounted = False
 
         self.use_chroot = use_chroot
         self.env = build_env.env
@@ -154,29 +170,150 @@ class StagingArea(object):
 
         '''
 
-        chunk_cache_dir = os.path.join(self._app.settings['tempdir'], 'chunks')
-        unpacked_artifact = os.path.join(
-            chunk_cache_dir, os.path.basename(handle.name) + '.d')
-        if not os.path.exists(unpacked_artifact):
-            self._app.status(
-                msg='Unpacking chunk from cache %(filename)s',
-                filename=os.path.basename(handle.name))
-            savedir = tempfile.mkdtemp(dir=chunk_cache_dir)
-            try:
-                morphlib.bins.unpack_binary_from_file(
-                    handle, savedir + '/')
-            except BaseException as e: # pragma: no cover
-                shutil.rmtree(savedir)
-                raise
-            # TODO: This rename is not concurrency safe if two builds are
-            #       extracting the same chunk, one build will fail because
-            #       the other renamed its tempdir here first.
-            os.rename(savedir, unpacked_artifact)
+        chunk_cache = morphlib.unpackedchunkcache.UnpackedChunkCache(
+            os.path.join(self._app.settings['tempdir'], 'chunks'),
+            self._app.settings['chunk-cache-max-size'])
 
         if not os.path.exists(self.dirname):
             self._mkdir(self.dirname)
 
-        self.hardlink_all_files(unpacked_artifact, self.dirname)
+        use = chunk_cache.get(handle, status=self._app.status)
+        if self._use_overlay():
+            self._install_layer(use)
+        else:
+            with use as unpacked:
+                self.hardlink_all_files(unpacked, self.dirname)
+        self._layout_changed()
+
+    def install_snapshot(self, name, install):
+        '''Install the contents of a reusable staging area snapshot.
+
+        ``install`` is a function which installs things into the staging
+        area it is given, and ``name`` must identify everything it
+        installs. The first time a name is used, ``install`` is run on an
+        empty staging area in the snapshot store in the tempdir. That
+        snapshot, and those of later staging areas with the same name,
+        are hardlinked into place by a single ``cp`` command, instead of
+        one file at a time.
+
+        Staging areas assembled with overlayfs do no work per file in the
+        first place, so ``install`` is just run on this staging area.
+
+        '''
+
+        if self._use_overlay():
+            install(self)
+            return
+
+        store = morphlib.unpackedchunkcache.UnpackedChunkCache(
+            os.path.join(self._app.settings['tempdir'], 'staging-snapshots'),
+            self._app.settings['chunk-cache-max-size'])
+
+        def populate(dirname):
+            self._app.status(msg='Preparing staging area snapshot %(name)s',
+                             name=name, chatty=True)
+            snapshot = copy.copy(self)
+            snapshot.dirname = dirname
+            snapshot._layers = []
+            install(snapshot)
+
+        with store.get_directory(name, populate) as dirname:
+            self._app.status(msg='Installing staging area snapshot %(name)s',
+                             name=name, chatty=True)
+            self._app.runcmd(['cp', '-al', dirname + '/.', self.dirname])
+        self._layout_changed()
+
+    def _overlay_dir(self, *parts):
+        return os.path.join(self.dirname + '.overlay', *parts)
+
+    def _use_overlay(self):
+        if self._layers:
+            return True
+        if self._app.settings['staging-area-backend'] != 'overlayfs':
+            return False
+        # Layers cannot be mounted over files already installed by
+        # hardlinking, so the backend is only chosen for an empty
+        # staging area.
+        return not os.listdir(self.dirname)
+
+    def _install_layer(self, use):
+        '''Add an unpacked chunk as the new top lower layer of the overlay.
+
+        The overlay is mounted again with the new set of layers, so the
+        upper layer keeps anything already written to the staging area.
+        The unpacked chunk is kept in use until the overlay is unmounted.
+
+        If the first layer cannot be mounted, overlayfs is not usable on
+        this host and the staging area falls back to hardlinking.
+
+        Once no more lower layers can be stacked, the files of each later
+        chunk are hardlinked into the upper layer instead, while the
+        overlay is unmounted. The upper layer is above every lower layer,
+        so the chunk still overrides those installed before it.
+
+        '''
+
+        unpacked = use.__enter__()
+        if self._layers and not self._can_stack_layer():
+            self._unmount_overlay()
+            try:
+                self.hardlink_all_files(unpacked, self._overlay_dir('upper'))
+            finally:
+                use.__exit__(None, None, None)
+            self._mount_overlay()
+            return
+        if not self._layers:
+            for subdir in ('layers', 'upper', 'work'):
+                os.makedirs(self._overlay_dir(subdir))
+        # The mount options must fit in a page, so layers are given by
+        # short relative names of symlinks to the unpacked chunks.
+        os.symlink(unpacked, self._overlay_dir('layers',
+                                               str(len(self._layers))))
+        self._layers.append(use)
+
+        try:
+            self._mount_overlay()
+        except cliapp.AppException as e:
+            if len(self._layers) > 1:
+                raise
+            logging.warning('Cannot mount overlayfs, falling back to '
+                            'hardlinking: %s' % e)
+            self._layers = []
+            shutil.rmtree(self._overlay_dir())
+            try:
+                self.hardlink_all_files(unpacked, self.dirname)
+            finally:
+                use.__exit__(None, None, None)
+
+    def _overlay_options(self, layer_count):
+        lowerdir = ':'.join(str(i) for i in reversed(range(layer_count)))
+        return 'lowerdir=%s,upperdir=%s,workdir=%s' % (
+            lowerdir, self._overlay_dir('upper'), self._overlay_dir('work'))
+
+    def _can_stack_layer(self):
+        count = len(self._layers) + 1
+        return (count <= self.max_overlay_layers and
+                len(self._overlay_options(count)) < resource.getpagesize())
+
+    def _mount_overlay(self):
+        self._unmount_overlay()
+        options = self._overlay_options(len(self._layers))
+        self._app.runcmd(['mount', '-t', 'overlay', 'overlay',
+                          '-o', options, self.dirname],
+                         cwd=self._overlay_dir('layers'))
+        self._overlay_mounted = True
+
+    def _unmount_overlay(self):
+        if self._overlay_mounted:
+            self._app.runcmd(['umount', self.dirname])
+            self._overlay_mounted = False
+
+    def _release_layers(self):
+        '''Unmount the overlay and stop using the unpacked chunks.'''
+        self._unmount_overlay()
+        for use in self._layers:
+            use.__exit__(None, None, None)
+        self._layers = []
 
     def remove(self):
         '''Remove the entire staging area.
@@ -187,6 +324,9 @@ class StagingArea(object):
 
         '''
 
+        if self._layers:
+            self._release_layers()
+            shutil.rmtree(self._overlay_dir())
         shutil.rmtree(self.dirname)
 
     to_mount_in_staging = (
@@ -232,6 +372,7 @@ class StagingArea(object):
         destdir = self.destdir(source)
         self.builddirname = builddir
         self.destdirname = destdir
+        self._layout_changed()
 
         return builddir, destdir
 
@@ -244,6 +385,29 @@ class StagingArea(object):
         # No cleanup is currently required
         pass
 
+    def _layout_changed(self):
+        '''Forget the read-only paths computed for the staging area.'''
+        self._readonly_paths = None
+        self._readonly_paths_key = None
+
+    def _container_readonly_paths(self, writable_paths):
+        '''Return the paths to make read-only when running a command.
+
+        Finding these means scanning the staging area, so the result is
+        reused for every command until the staging area changes. As well
+        as the changes we make ourselves, commands may create new entries
+        at the top of the staging area, so the top-level listing is part
+        of what is compared.
+
+        '''
+
+        key = (tuple(writable_paths), frozenset(os.listdir(self.dirname)))
+        if key != self._readonly_paths_key:
+            self._readonly_paths = morphlib.util.container_readonly_paths(
+                self.dirname, writable_paths)
+            self._readonly_paths_key = key
+        return self._readonly_paths
+
     def runcmd(self, argv, **kwargs):  # pragma: no cover
         '''Run a command in a chroot in the staging area.'''
         assert 'env' not in kwargs
@@ -288,8 +452,16 @@ class StagingArea(object):
             binds=binds,
             writable_paths=do_not_mount_dirs)
 
+        # Outside of a chroot the root is the host's file system, which can
+        # change under us at any time, so the read-only paths are found
+        # afresh for every command.
+        if self.use_chroot:
+            readonly_paths = self._container_readonly_paths(do_not_mount_dirs)
+        else:
+            readonly_paths = None
+
         cmdline = morphlib.util.containerised_cmdline(
-            argv, **container_config)
+            argv, readonly_paths=readonly_paths, **container_config)
 
         if kwargs.get('logfile') != None:
             logfile = kwargs.pop('logfile')
@@ -308,12 +480,12 @@ class StagingArea(object):
             raise cliapp.AppException(
                 'In staging area %s: %s' % (self._failed_location(), msg))
 
-    def _failed_location(self):  # pragma: no cover
+    def _failed_location(self):
         '''Path this staging area will be moved to if an error occurs.'''
         return os.path.join(self._app.settings['tempdir'], 'failed',
                             os.path.basename(self.dirname))
 
-    def abort(self): # pragma: no cover
+    def abort(self):
         '''Handle what to do with a staging area in the case of failure.
            This may either remove it or save it for later inspection.
         '''
@@ -321,6 +493,15 @@ class StagingArea(object):
         #       hook it up here
 
         dest_dir = self._failed_location()
-        os.rename(self.dirname, dest_dir)
+        if self._layers:
+            # The staging area cannot be moved while the overlay is mounted,
+            # so only what was written to it is kept, which includes the
+            # build and install directories.
+            self._release_layers()
+            os.rename(self._overlay_dir('upper'), dest_dir)
+            shutil.rmtree(self._overlay_dir())
+            os.rmdir(self.dirname)
+        else:
+            os.rename(self.dirname, dest_dir)
         self.dirname = dest_dir
 
@@ -45,14 +45,28 @@ class FakeApplication(object):
         self.settings = {
             'cachedir': cachedir,
             'tempdir': tempdir,
+            'chunk-cache-max-size': 0,
+            'staging-area-backend': 'hardlink',
         }
-        for leaf in ('chunks',):
+        for leaf in ('chunks', 'staging-snapshots', 'failed'):
             d = os.path.join(tempdir, leaf)
             if not os.path.exists(d):
                 os.makedirs(d)
+        self.mounts = []
+        self.mount_fails = False
 
-    def runcmd(self, *args, **kwargs):
-        return cliapp.runcmd(*args, **kwargs)
+    def runcmd(self, argv, **kwargs):
+        # Mounting needs root, so overlays are only pretended to be
+        # mounted.
+        if argv[0] == 'mount':
+            if self.mount_fails:
+                raise cliapp.AppException('mount failed')
+            self.mounts.append(argv[-2].split(',')[0])
+            return ''
+        if argv[0] == 'umount':
+            self.mounts.append('umount')
+            return ''
+        return cliapp.runcmd(argv, **kwargs)
 
     def runcmd_unchecked(self, *args, **kwargs):
         return cliapp.runcmd_unchecked(*args, **kwargs)
@@ -78,12 +92,12 @@ class StagingAreaTests(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.tempdir)
 
-    def create_chunk(self):
-        chunkdir = os.path.join(self.tempdir, 'chunk')
+    def create_chunk(self, name='chunk', filename='file.txt'):
+        chunkdir = os.path.join(self.tempdir, name)
         os.mkdir(chunkdir)
-        with open(os.path.join(chunkdir, 'file.txt'), 'w'):
+        with open(os.path.join(chunkdir, filename), 'w'):
             pass
-        chunk_tar = os.path.join(self.tempdir, 'chunk.tar')
+        chunk_tar = os.path.join(self.tempdir, name + '.tar')
         tf = tarfile.TarFile(name=chunk_tar, mode='w')
         tf.add(chunkdir, arcname='.')
         tf.close()
@@ -128,6 +142,50 @@ class StagingAreaTests(unittest.TestCase):
             self.sa.install_artifact(f)
         self.assertEqual(self.list_tree(self.staging), ['/', '/file.txt'])
 
+    def test_reuses_readonly_paths_until_layout_changes(self):
+        chunk_tar = self.create_chunk()
+        with open(chunk_tar, 'rb') as f:
+            self.sa.install_artifact(f)
+        writable = [os.path.join(self.staging, 'tmp')]
+        self.assertEqual(self.sa._container_readonly_paths(writable),
+                         ['file.txt'])
+
+        computed = []
+        def fake_readonly_paths(root, writable_paths):
+            computed.append(root)
+            return []
+        real_readonly_paths = morphlib.util.container_readonly_paths
+        morphlib.util.container_readonly_paths = fake_readonly_paths
+        try:
+            self.sa._container_readonly_paths(writable)
+            self.assertEqual(computed, [])
+            os.mkdir(os.path.join(self.staging, 'newdir'))
+            self.sa._container_readonly_paths(writable)
+            self.assertEqual(computed, [self.staging])
+        finally:
+            morphlib.util.container_readonly_paths = real_readonly_paths
+
+    def test_reuses_staging_area_snapshot(self):
+        chunk_tar = self.create_chunk()
+        installed = []
+        def install(staging_area):
+            installed.append(staging_area.dirname)
+            with open(chunk_tar, 'rb') as f:
+                staging_area.install_artifact(f)
+
+        self.sa.install_snapshot('snapshot', install)
+        self.assertEqual(len(installed), 1)
+        self.assertNotEqual(installed[0], self.staging)
+        self.assertEqual(self.list_tree(self.staging), ['/', '/file.txt'])
+
+        other = os.path.join(self.tempdir, 'other')
+        os.mkdir(other)
+        sa = morphlib.stagingarea.StagingArea(
+            self.sa._app, other, self.build_env)
+        sa.install_snapshot('snapshot', install)
+        self.assertEqual(len(installed), 1)
+        self.assertEqual(self.list_tree(other), ['/', '/file.txt'])
+
     def test_removes_everything(self):
         chunk_tar = self.create_chunk()
         with open(chunk_tar, 'rb') as f:
@@ -140,3 +198,82 @@ class StagingAreaTests(unittest.TestCase):
             object(), self.staging, self.build_env, use_chroot=False)
         filename = os.path.join(self.staging, 'foobar')
         self.assertEqual(sa.relative(filename), filename)
+
+    def use_overlay(self):
+        self.sa._app.settings['staging-area-backend'] = 'overlayfs'
+        os.mkdir(self.staging)
+
+    def install_chunks(self, *names):
+        for name in names:
+            with open(self.create_chunk(name, name + '.txt'), 'rb') as f:
+                self.sa.install_artifact(f)
+
+    def test_stacks_chunks_as_overlay_layers(self):
+        self.use_overlay()
+        self.install_chunks('foo', 'bar')
+        self.assertEqual(self.sa._app.mounts, ['lowerdir=0', 'umount',
+                                               'lowerdir=1:0'])
+        layers = self.sa._overlay_dir('layers')
+        self.assertEqual(
+            [os.listdir(os.path.join(layers, str(i))) for i in (0, 1)],
+            [['foo.txt'], ['bar.txt']])
+        self.assertEqual(os.listdir(self.staging), [])
+
+        self.sa.remove()
+        self.assertEqual(self.sa._app.mounts[-1], 'umount')
+        self.assertFalse(os.path.exists(self.sa._overlay_dir()))
+        self.assertFalse(os.path.exists(self.staging))
+
+    def test_hardlinks_into_upper_layer_once_layers_cannot_be_stacked(self):
+        self.use_overlay()
+        self.sa.max_overlay_layers = 1
+        self.install_chunks('foo', 'bar')
+        self.assertEqual(self.sa._app.mounts, ['lowerdir=0', 'umount',
+                                               'lowerdir=0'])
+        self.assertEqual(os.listdir(self.sa._overlay_dir('upper')),
+                         ['bar.txt'])
+
+    def test_falls_back_to_hardlinks_if_overlay_cannot_be_mounted(self):
+        self.use_overlay()
+        self.sa._app.mount_fails = True
+        self.install_chunks('foo', 'bar')
+        self.assertEqual(self.list_tree(self.staging),
+                         ['/', '/bar.txt', '/foo.txt'])
+        self.assertFalse(os.path.exists(self.sa._overlay_dir()))
+
+    def test_fails_if_overlay_cannot_be_mounted_again(self):
+        self.use_overlay()
+        self.install_chunks('foo')
+        self.sa._app.mount_fails = True
+        self.assertRaises(cliapp.AppException, self.install_chunks, 'bar')
+
+    def test_keeps_what_was_written_to_overlay_on_abort(self):
+        self.use_overlay()
+        self.install_chunks('foo')
+        with open(os.path.join(self.sa._overlay_dir('upper'), 'log'),
+                  'w') as f:
+            f.write('build log')
+        self.sa.abort()
+        self.assertEqual(self.sa._app.mounts[-1], 'umount')
+        self.assertEqual(self.list_tree(self.sa.dirname), ['/', '/log'])
+        self.assertFalse(os.path.exists(self.staging))
+        self.assertFalse(os.path.exists(self.staging + '.overlay'))
+
+    def test_keeps_staging_area_on_abort(self):
+        self.install_chunks('foo')
+        self.sa.abort()
+        self.assertEqual(self.list_tree(self.sa.dirname), ['/', '/foo.txt'])
+        self.assertFalse(os.path.exists(self.staging))
+
+    def test_installs_snapshot_straight_into_overlay(self):
+        self.use_overlay()
+        installed = []
+        def install(staging_area):
+            installed.append(staging_area)
+            with open(self.create_chunk(), 'rb') as f:
+                staging_area.install_artifact(f)
+        self.sa.install_snapshot('snapshot', install)
+        self.assertEqual(installed, [self.sa])
+        self.assertEqual(self.sa._app.mounts, ['lowerdir=0'])
+        self.assertEqual(
+            os.listdir(os.path.join(self.tempdir, 'staging-snapshots')), [])
@@ -0,0 +1,514 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import copy
+import logging
+import os
+import stat
+import StringIO
+import tarfile
+import time
+
+import morphlib
+
+
+def _split(name):
+    return [part for part in name.split('/') if part and part != '.']
+
+
+class _Entry(object):
+
+    '''What ends up at a path when the tar files are extracted.
+
+    ``info`` is the header of the tar member, ``source`` and ``seq`` say
+    which tar file it came from and where in it, and ``member_name`` is
+    its name in that tar file. Hardlinks have the entry of the file they
+    link to as ``link_source``, and generated files have their contents
+    as ``data``.
+
+    '''
+
+    __slots__ = ('info', 'source', 'seq', 'member_name', 'link_source',
+                 'data')
+
+    def __init__(self, info, source=None, seq=None, member_name=None):
+        self.info = info
+        self.source = source
+        self.seq = seq
+        self.member_name = member_name
+        self.link_source = None
+        self.data = None
+
+    def has_contents(self):
+        return self.info.isreg() or self.info.islnk()
+
+
+class TarMerger(object):
+
+    '''Work out the result of extracting tar files on top of each other.
+
+    Tar files are added in the order they would be extracted in. Only
+    their headers are read to begin with; the contents of files are
+    copied straight from the tar files they came from when the merged
+    tar file is written, so the merged file system never has to exist
+    on disk.
+
+    Members overwrite what is already there with the same rules that
+    bins.unpack_binary_from_file uses:
+
+    * a directory is merged with an existing directory, or with the
+      directory an existing symlink points to
+    * anything else replaces an existing file, or a symlink which points
+      to something other than a directory
+    * a regular file is written to where a dangling symlink points, if
+      the directory it would be in exists
+    * nothing else replaces a directory, or a symlink to one or to
+      nothing, so such members are left out
+
+    Symlinks in the paths of members are followed, as they would be when
+    extracting. Absolute symlinks are resolved inside the merged file
+    system rather than on the host.
+
+    Where extracting the tar files in turn would fail, such as for a
+    file in place of a directory, a member in a directory that is a
+    file, a hardlink to something missing, or a path with too many
+    levels of symlinks, the member is left out with a warning instead.
+
+
+    '''
+
+    max_symlinks = 40
+
+    def __init__(self):
+        root = tarfile.TarInfo('.')
+        root.type = tarfile.DIRTYPE
+        root.mode = 0o755
+        self._entries = {'.': _Entry(root)}
+        self._sources = []
+        self._seekable = []
+
+    def _resolve(self, name, follow=True):
+        '''Resolve the symlinks in a path within the merged file system.
+
+        The last component of the path is only resolved if ``follow`` is
+        set. Returns None if there are too many levels of symlinks.
+
+        '''
+
+        todo = _split(name)
+        resolved = []
+        symlinks = 0
+        while todo:
+            part = todo.pop(0)
+            if part == '..':
+                del resolved[-1:]
+                continue
+            path = '/'.join(resolved + [part])
+            entry = self._entries.get(path)
+            if (entry is not None and entry.info.issym() and
+                    (todo or follow)):
+                symlinks += 1
+                if symlinks > self.max_symlinks:
+                    return None
+                if entry.info.linkname.startswith('/'):
+                    resolved = []
+                todo = _split(entry.info.linkname) + todo
+            else:
+                resolved.append(part)
+        return '/'.join(resolved) or '.'
+
+    def _follow(self, path):
+        '''Return the entry a path refers to once symlinks are followed.'''
+        resolved = self._resolve(path)
+        return self._entries.get(resolved) if resolved else None
+
+    def _make_dirs(self, path):
+        '''Make sure a resolved path and its parents are directories.
+
+        Directories which don't exist yet are created, as extracting a
+        member does when its parent directories are missing from the
+        tar file.
+
+        '''
+
+        parts = _split(path)
+        for i in xrange(1, len(parts) + 1):
+            parent = '/'.join(parts[:i])
+            entry = self._entries.get(parent)
+            if entry is None:
+                info = tarfile.TarInfo(parent)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                self._entries[parent] = _Entry(info)
+            elif not entry.info.isdir():
+                return False
+        return True
+
+    def _path_for(self, name):
+        '''Return the resolved path a member called ``name`` goes to.'''
+        parts = _split(name)
+        if not parts:
+            return '.'
+        parent = self._resolve('/'.join(parts[:-1]))
+        if parent is None or not self._make_dirs(parent):
+            return None
+        if parent == '.':
+            return parts[-1]
+        return parent + '/' + parts[-1]
+
+    def _put(self, name, entry, replace=False):
+        path = self._path_for(name)
+        if path is None:
+            logging.warning('Cannot put %s in place of its parent' % name)
+            return
+        entry.info.name = path
+        existing = self._entries.get(path)
+        if existing is None:
+            self._entries[path] = entry
+        elif replace and not existing.info.isdir():
+            self._entries[path] = entry
+        elif entry.info.isdir():
+            if existing.info.issym():
+                existing = self._follow(path)
+            if existing is not None and existing.info.isdir():
+                # Extracting the directory sets the attributes of the one
+                # already there, even through a symlink.
+                entry.info.name = existing.info.name
+                self._entries[existing.info.name] = entry
+            else:
+                logging.debug('Not replacing %s with a directory' % path)
+        elif existing.info.isdir():
+            logging.debug('Not replacing directory %s' % path)
+        elif existing.info.issym():
+            target = self._follow(path)
+            if target is not None and not target.info.isdir():
+                self._entries[path] = entry
+            elif target is None and entry.info.isreg():
+                self._put_through_symlink(path, entry)
+            else:
+                logging.debug('Not replacing symlink %s' % path)
+        else:
+            self._entries[path] = entry
+
+    def _put_through_symlink(self, path, entry):
+        # Extracting a regular file writes it where a dangling symlink
+        # points, but does not make the directory it goes in.
+        resolved = self._resolve(path)
+        parent = None
+        if resolved is not None:
+            parent = self._entries.get(os.path.dirname(resolved) or '.')
+        if parent is None or not parent.info.isdir():
+            logging.warning('Cannot write %s through symlink' % path)
+            return
+        entry.info.name = resolved
+        self._entries[resolved] = entry
+
+    def _apply(self, source, seq, member):
+        entry = _Entry(copy.copy(member), source, seq,
+                       '/'.join(_split(member.name)) or '.')
+        if member.islnk():
+            linked = self._entries.get(
+                self._resolve(member.linkname, follow=False))
+            if linked is None or linked.info.isdir():
+                logging.warning('Cannot create hardlink %s to %s' %
+                                (member.name, member.linkname))
+                return
+            if linked.info.issym():
+                # A hardlink to a symlink is just another symlink.
+                entry.info = copy.copy(linked.info)
+            elif linked.data is not None:
+                entry.info = copy.copy(linked.info)
+                entry.data = linked.data
+            elif linked.has_contents():
+                entry.link_source = linked.link_source or linked
+            else:
+                entry.info = copy.copy(linked.info)
+        self._put(member.name, entry)
+
+    def _read_headers(self, open_source):
+        '''Return the members of a tar file, and whether it is seekable.
+
+        The contents of the members of an uncompressed tar file can be
+        read straight from their offsets in it, without going through
+        the rest of the tar file again.
+
+        '''
+
+        f = open_source()
+        try:
+            seekable = morphlib.bins.detect_compression(f) is None
+            with morphlib.bins.open_tar(f) as tf:
+                headers = []
+                for member in tf:
+                    headers.append(member)
+                    seekable = seekable and not member.issparse()
+                    tf.members = []
+                return headers, seekable
+        finally:
+            f.close()
+
+    def add_tar(self, open_source):
+        '''Add a tar file on top of the ones already added.
+
+        ``open_source`` is called to open the tar file whenever it needs
+        to be read, and it is read twice: once now, and again when the
+        merged tar file is written. The tar file may be compressed.
+
+        '''
+
+        self.add_tars([open_source])
+
+    def add_tars(self, open_sources, jobs=1):
+        '''Add several tar files, in order, on top of those already added.
+
+        The headers of up to ``jobs`` of the tar files are read at once.
+
+        '''
+
+        open_sources = list(open_sources)
+        all_headers = morphlib.util.map_concurrently(
+            self._read_headers, open_sources, jobs)
+        for open_source, (headers, seekable) in zip(open_sources,
+                                                    all_headers):
+            index = len(self._sources)
+            self._sources.append(open_source)
+            self._seekable.append(seekable)
+            for seq, member in enumerate(headers):
+                self._apply(index, seq, member)
+
+    def add_file(self, name, data, mode=0o644):
+        '''Add a file with the given contents on top of everything else.
+
+        Like a file saved with morphlib.savefile.SaveFile, it replaces
+        whatever is at its path, even a symlink, unless that is a
+        directory.
+
+        '''
+
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = mode
+        info.mtime = time.time()
+        entry = _Entry(info)
+        entry.data = data
+        self._put(name, entry, replace=True)
+
+    def lookup(self, name):
+        '''Return the header of a file in the merged file system, or None.
+
+        Symlinks are followed.
+
+        '''
+
+        entry = self._follow(name)
+        return entry.info if entry else None
+
+    def listdir(self, name):
+        '''Return the names of the files in a merged directory.'''
+
+        path = self._resolve(name)
+        if path is None or path not in self._entries:
+            return []
+        prefix = '' if path == '.' else path + '/'
+        return sorted(p[len(prefix):] for p in self._entries
+                      if p != '.' and p.startswith(prefix) and
+                         '/' not in p[len(prefix):])
+
+    def _data_members(self):
+        '''Map each member with contents to the paths it ends up at.'''
+        by_member = {}
+        for path in sorted(self._entries):
+            entry = self._entries[path]
+            if entry.has_contents() and entry.data is None:
+                data_entry = entry.link_source or entry
+                key = (data_entry.source, data_entry.seq)
+                by_member.setdefault(key, []).append(entry)
+        return by_member
+
+    def _contents(self, index, by_member):
+        '''Read the members of a tar file that have contents in the result.
+
+        Yields the entries for the paths each member ends up at, with a
+        file positioned at the start of its contents and their size.
+
+        '''
+
+        f = self._sources[index]()
+        try:
+            if self._seekable[index]:
+                members = list(
+                    ((entries[0].link_source or entries[0]).info, entries)
+                    for (source, seq), entries in by_member.iteritems()
+                    if source == index)
+                members.sort(key=lambda (info, entries): info.offset_data)
+                for info, entries in members:
+                    f.seek(info.offset_data)
+                    yield entries, f, info.size
+                return
+            with morphlib.bins.open_tar(f) as tf:
+                for seq, member in enumerate(tf):
+                    entries = by_member.get((index, seq))
+                    tf.members = []
+                    if entries:
+                        yield entries, tf.extractfile(member), member.size
+        finally:
+            f.close()
+
+    def write(self, tar):
+        '''Write the merged file system to an open TarFile.'''
+
+        # Everything without contents is written first, in order, so that
+        # directories come before anything in them.
+        for path in sorted(self._entries):
+            entry = self._entries[path]
+            if not entry.has_contents():
+                tar.addfile(entry.info)
+
+        by_member = self._data_members()
+        for index in xrange(len(self._sources)):
+            for entries, f, size in self._contents(index, by_member):
+                # The first path gets the contents, and any others are
+                # hardlinks to it.
+                info = copy.copy(entries[0].info)
+                info.type = tarfile.REGTYPE
+                info.linkname = ''
+                info.size = size
+                tar.addfile(info, f)
+                for entry in entries[1:]:
+                    info = copy.copy(entry.info)
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = entries[0].info.name
+                    info.size = 0
+                    tar.addfile(info)
+
+        for path in sorted(self._entries):
+            entry = self._entries[path]
+            if entry.data is not None:
+                tar.addfile(entry.info, StringIO.StringIO(entry.data))
+
+    def _make_node(self, info, target):
+        '''Create anything but a directory, regular file or hardlink.'''
+        if info.issym():
+            os.symlink(info.linkname, target)
+        # Only root can create device nodes, so tests can't.
+        elif info.ischr() or info.isblk():  # pragma: no cover
+            kind = stat.S_IFCHR if info.ischr() else stat.S_IFBLK
+            os.mknod(target, info.mode | kind,
+                     os.makedev(info.devmajor, info.devminor))
+        elif info.isfifo():
+            os.mkfifo(target)
+
+    def _set_attributes(self, info, target, mtime=True):
+        if os.geteuid() == 0:
+            os.lchown(target, info.uid, info.gid)
+        if not info.issym():
+            os.chmod(target, info.mode & 0o7777)
+            if mtime:
+                os.utime(target, (info.mtime, info.mtime))
+
+    def extract(self, dirname, jobs=1):
+        '''Extract the merged file system into an existing empty directory.
+
+        The result is the same as extracting each of the tar files in
+        turn, but as what ends up at each path is already known, the
+        contents of up to ``jobs`` of the tar files are written at once.
+
+        '''
+
+        dirs = []
+        for path in sorted(self._entries):
+            entry = self._entries[path]
+            if entry.has_contents():
+                continue
+            target = os.path.join(dirname, path)
+            if entry.info.isdir():
+                if path != '.':
+                    os.mkdir(target, 0o700)
+                # Directories are only given their attributes at the end,
+                # once everything in them has been written.
+                if entry.source is not None or path != '.':
+                    dirs.append((entry, target))
+            else:
+                self._make_node(entry.info, target)
+                self._set_attributes(entry.info, target)
+
+        by_member = self._data_members()
+
+        def extract_source(index):
+            for entries, f, size in self._contents(index, by_member):
+                # The first path gets the contents, and any others are
+                # hardlinks to it.
+                first = os.path.join(dirname, entries[0].info.name)
+                with open(first, 'wb') as out:
+                    tarfile.copyfileobj(f, out, size)
+                self._set_attributes(entries[0].info, first)
+                for entry in entries[1:]:
+                    os.link(first, os.path.join(dirname, entry.info.name))
+
+        morphlib.util.map_concurrently(
+            extract_source, sorted(set(index for index, seq in by_member)),
+            jobs)
+
+        for path in sorted(self._entries):
+            entry = self._entries[path]
+            if entry.data is not None:
+                target = os.path.join(dirname, path)
+                with open(target, 'wb') as f:
+                    f.write(entry.data)
+                self._set_attributes(entry.info, target)
+
+        for entry, target in reversed(dirs):
+            # Directories no tar file had a member for are left with the
+            # time they were created, as they would be when extracting.
+            self._set_attributes(entry.info, target,
+                                 mtime=entry.source is not None)
+
+    def materialise(self, dirname, source_dirs):
+        '''Create the merged file system in an existing empty directory.
+
+        ``source_dirs`` lists the directories the tar files have already
+        been extracted into, in the order they were added. Files are
+        hardlinked from them rather than copied, so nothing in
+        ``dirname`` may be modified in place: mount an overlay on top of
+        it to make changes.
+
+        '''
+
+        dirs = []
+        for path in sorted(self._entries):
+            entry = self._entries[path]
+            target = os.path.join(dirname, path)
+            if entry.data is not None:
+                with open(target, 'wb') as f:
+                    f.write(entry.data)
+                self._set_attributes(entry.info, target)
+            elif entry.has_contents():
+                data_entry = entry.link_source or entry
+                os.link(os.path.join(source_dirs[data_entry.source],
+                                     data_entry.member_name), target)
+            elif entry.info.isdir():
+                if path != '.':
+                    os.mkdir(target, 0o700)
+                if entry.source is not None or path != '.':
+                    dirs.append((entry, target))
+            else:
+                self._make_node(entry.info, target)
+                self._set_attributes(entry.info, target)
+
+        # As in extract, directories get their attributes once everything
+        # in them has been made.
+        for entry, target in reversed(dirs):
+            self._set_attributes(entry.info, target,
+                                 mtime=entry.source is not None)
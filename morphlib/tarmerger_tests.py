@@ -0,0 +1,399 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import stat
+import StringIO
+import tarfile
+import tempfile
+import unittest
+
+import morphlib
+
+
+class TarMergerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.merger = morphlib.tarmerger.TarMerger()
+        self.tars = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def add(self, *members, **kwargs):
+        '''Add a tar file with the given members to the merger.
+
+        Each member is a (name, kind, value) tuple: kind is 'dir', 'file'
+        with the file contents as value, 'symlink' or 'hardlink' with the
+        target as value, or 'fifo'.
+
+        '''
+
+        f = StringIO.StringIO()
+        tar, compressor = morphlib.bins.create_tar(
+            f, kwargs.get('compression'))
+        for name, kind, value in members:
+            info = tarfile.TarInfo(name)
+            if kind == 'dir':
+                info.type = tarfile.DIRTYPE
+                info.mode = kwargs.get('mode', 0o755)
+                tar.addfile(info)
+            elif kind == 'file':
+                info.size = len(value)
+                info.mode = 0o644
+                tar.addfile(info, StringIO.StringIO(value))
+            elif kind == 'symlink':
+                info.type = tarfile.SYMTYPE
+                info.linkname = value
+                tar.addfile(info)
+            elif kind == 'hardlink':
+                info.type = tarfile.LNKTYPE
+                info.linkname = value
+                tar.addfile(info)
+            elif kind == 'fifo':
+                info.type = tarfile.FIFOTYPE
+                info.mode = 0o644
+                tar.addfile(info)
+        tar.close()
+        if compressor is not None:
+            compressor.close()
+        data = f.getvalue()
+        self.tars.append(data)
+        self.merger.add_tar(lambda: StringIO.StringIO(data))
+
+    def merged(self):
+        f = StringIO.StringIO()
+        tar = tarfile.open(fileobj=f, mode='w')
+        self.merger.write(tar)
+        tar.close()
+        f.seek(0)
+        return tarfile.open(fileobj=f)
+
+    def contents(self):
+        '''Return a dict of what is in the merged tar file.'''
+        tf = self.merged()
+        result = {}
+        for member in tf:
+            if member.isreg():
+                result[member.name] = tf.extractfile(member).read()
+            elif member.issym():
+                result[member.name] = '-> ' + member.linkname
+            elif member.islnk():
+                result[member.name] = '=> ' + member.linkname
+            else:
+                result[member.name] = member.type
+        return result
+
+    def test_writes_files_from_all_tars(self):
+        self.add(('usr', 'dir', None), ('usr/foo', 'file', 'foo'))
+        self.add(('usr', 'dir', None), ('usr/bar', 'file', 'bar'))
+        self.assertEqual(self.contents(), {
+            '.': tarfile.DIRTYPE,
+            'usr': tarfile.DIRTYPE,
+            'usr/foo': 'foo',
+            'usr/bar': 'bar',
+        })
+
+    def test_later_file_replaces_earlier_one(self):
+        self.add(('foo', 'file', 'old'))
+        self.add(('foo', 'file', 'new'))
+        self.assertEqual(self.contents()['foo'], 'new')
+
+    def test_later_directory_sets_attributes(self):
+        self.add(('usr', 'dir', None), mode=0o700)
+        self.add(('usr', 'dir', None), mode=0o755)
+        self.assertEqual(self.merged().getmember('usr').mode, 0o755)
+
+    def test_file_does_not_replace_directory(self):
+        self.add(('foo', 'dir', None), ('foo/bar', 'file', 'bar'))
+        self.add(('foo', 'file', 'foo'))
+        self.assertEqual(self.contents(), {
+            '.': tarfile.DIRTYPE,
+            'foo': tarfile.DIRTYPE,
+            'foo/bar': 'bar',
+        })
+
+    def test_file_replaces_symlink_to_file(self):
+        self.add(('foo', 'file', 'foo'), ('bar', 'symlink', 'foo'))
+        self.add(('bar', 'file', 'bar'))
+        self.assertEqual(self.contents()['bar'], 'bar')
+
+    def test_symlink_to_directory_is_kept(self):
+        self.add(('usr', 'dir', None), ('lib', 'symlink', 'usr'))
+        self.add(('lib', 'dir', None), ('lib/libc.so', 'file', 'libc'))
+        contents = self.contents()
+        self.assertEqual(contents['lib'], '-> usr')
+        self.assertEqual(contents['usr/libc.so'], 'libc')
+        self.assertFalse('lib/libc.so' in contents)
+
+    def test_absolute_symlinks_are_resolved_inside_merged_tree(self):
+        self.add(('usr', 'dir', None), ('lib', 'symlink', '/usr'))
+        self.add(('lib/libc.so', 'file', 'libc'))
+        self.assertEqual(self.contents()['usr/libc.so'], 'libc')
+
+    def test_keeps_hardlinks(self):
+        self.add(('foo', 'file', 'foo'), ('bar', 'hardlink', 'foo'))
+        self.assertEqual(self.contents(), {
+            '.': tarfile.DIRTYPE,
+            'bar': 'foo',
+            'foo': '=> bar',
+        })
+
+    def test_hardlink_keeps_contents_of_replaced_file(self):
+        self.add(('foo', 'file', 'old'), ('bar', 'hardlink', 'foo'))
+        self.add(('foo', 'file', 'new'))
+        contents = self.contents()
+        self.assertEqual(contents['foo'], 'new')
+        self.assertEqual(contents['bar'], 'old')
+
+    def test_added_file_replaces_files_from_tars(self):
+        self.add(('etc', 'dir', None), ('etc/os-release', 'file', 'old'))
+        self.merger.add_file('etc/os-release', 'new')
+        self.assertEqual(self.contents()['etc/os-release'], 'new')
+
+    def test_added_file_replaces_symlink(self):
+        self.add(('etc', 'dir', None), ('etc/os-release', 'symlink', 'x'))
+        self.merger.add_file('etc/os-release', 'new')
+        self.assertEqual(self.contents()['etc/os-release'], 'new')
+
+    def test_reads_compressed_tars(self):
+        self.add(('foo', 'file', 'foo'), compression='gzip')
+        self.assertEqual(self.contents()['foo'], 'foo')
+
+    def test_looks_up_files_through_symlinks(self):
+        self.add(('usr', 'dir', None), ('usr/etc', 'dir', None),
+                 ('usr/etc/ld.so.conf', 'file', ''),
+                 ('etc', 'symlink', 'usr/etc'))
+        self.assertTrue(self.merger.lookup('etc/ld.so.conf').isreg())
+        self.assertEqual(self.merger.lookup('etc/missing'), None)
+        self.assertEqual(self.merger.listdir('etc'), ['ld.so.conf'])
+
+    def listing(self, root):
+        result = []
+        for dirname, subdirs, basenames in os.walk(root):
+            for basename in sorted(subdirs + basenames):
+                path = os.path.join(dirname, basename)
+                st = os.lstat(path)
+                if os.path.islink(path):
+                    value = '-> ' + os.readlink(path)
+                elif os.path.isdir(path):
+                    value = 'dir %o' % st.st_mode
+                elif stat.S_ISFIFO(st.st_mode):
+                    value = 'fifo %o' % st.st_mode
+                else:
+                    with open(path) as f:
+                        value = '%s %o %d %d' % (f.read(), st.st_mode,
+                                                 st.st_mtime, st.st_nlink)
+                result.append((os.path.relpath(path, root), value))
+        return sorted(result)
+
+    def add_overlapping_tars(self):
+        self.add(('usr', 'dir', None), ('usr/lib', 'dir', None),
+                 ('lib', 'symlink', 'usr/lib'), ('bin', 'dir', None),
+                 ('bin/sh', 'file', 'sh'), ('bin/bash', 'hardlink', 'bin/sh'))
+        self.add(('lib', 'dir', None), ('lib/libc.so', 'file', 'libc'),
+                 ('bin', 'dir', None), ('bin/sh', 'symlink', 'dash'),
+                 ('bin/dash', 'file', 'dash'), mode=0o750)
+
+    def extract_in_order(self):
+        extracted = os.path.join(self.tempdir, 'extracted')
+        os.mkdir(extracted)
+        for data in self.tars:
+            morphlib.bins.unpack_binary_from_file(StringIO.StringIO(data),
+                                                  extracted)
+        return extracted
+
+    def test_matches_extracting_tars_in_order(self):
+        self.add_overlapping_tars()
+        extracted = self.extract_in_order()
+        merged = os.path.join(self.tempdir, 'merged')
+        os.mkdir(merged)
+        self.merged().extractall(merged)
+        self.assertEqual(self.listing(merged), self.listing(extracted))
+
+    def test_extracts_like_extracting_tars_in_order(self):
+        self.add_overlapping_tars()
+        extracted = self.extract_in_order()
+        merged = os.path.join(self.tempdir, 'merged')
+        os.mkdir(merged)
+        self.merger.extract(merged, jobs=2)
+        self.assertEqual(self.listing(merged), self.listing(extracted))
+
+    def test_extracts_replaced_and_hardlinked_files_like_tars_in_order(self):
+        self.add(('usr', 'dir', None), ('usr/bin', 'dir', None),
+                 ('bin', 'symlink', 'usr/bin'),
+                 ('usr/bin/gcc', 'file', 'gcc'),
+                 ('usr/bin/cc', 'hardlink', 'usr/bin/gcc'),
+                 ('usr/bin/c++', 'hardlink', 'usr/bin/gcc'),
+                 ('usr/bin/old', 'file', 'old'))
+        self.add(('bin', 'dir', None), ('bin/old', 'file', 'new'),
+                 ('bin/pipe', 'fifo', None),
+                 ('bin/more', 'hardlink', 'bin/old'))
+        self.add(('usr/bin/gcc', 'file', 'gcc2'))
+        extracted = self.extract_in_order()
+        for jobs in (1, 3):
+            merged = os.path.join(self.tempdir, 'merged%d' % jobs)
+            os.mkdir(merged)
+            self.merger.extract(merged, jobs=jobs)
+            self.assertEqual(self.listing(merged), self.listing(extracted))
+        self.assertEqual(self.merger.listdir('missing'), [])
+
+    def assertExtractsLikeTarsInOrder(self):
+        extracted = self.extract_in_order()
+        merged = os.path.join(self.tempdir, 'merged')
+        os.mkdir(merged)
+        self.merger.extract(merged)
+        self.assertEqual(self.listing(merged), self.listing(extracted))
+
+    def test_makes_missing_parent_directories(self):
+        self.add(('usr/bin/foo', 'file', 'foo'))
+        self.assertEqual(self.contents(), {
+            '.': tarfile.DIRTYPE,
+            'usr': tarfile.DIRTYPE,
+            'usr/bin': tarfile.DIRTYPE,
+            'usr/bin/foo': 'foo',
+        })
+        self.assertExtractsLikeTarsInOrder()
+
+    def test_resolves_parent_directory_references(self):
+        self.add(('usr', 'dir', None), ('usr/../foo', 'file', 'foo'),
+                 ('../bar', 'file', 'bar'))
+        contents = self.contents()
+        self.assertEqual(contents['foo'], 'foo')
+        self.assertEqual(contents['bar'], 'bar')
+
+    def test_root_directory_member_sets_attributes_of_root(self):
+        self.add(('./', 'dir', None), mode=0o700)
+        self.assertEqual(self.merged().getmember('.').mode, 0o700)
+
+    def test_hardlink_to_symlink_is_a_symlink(self):
+        self.add(('foo', 'file', 'foo'), ('bar', 'symlink', 'foo'),
+                 ('baz', 'hardlink', 'bar'))
+        self.assertEqual(self.contents()['baz'], '-> foo')
+        self.assertExtractsLikeTarsInOrder()
+
+    def test_hardlink_to_fifo_is_a_fifo(self):
+        self.add(('pipe', 'fifo', None), ('other', 'hardlink', 'pipe'))
+        self.assertEqual(self.contents()['other'], tarfile.FIFOTYPE)
+        self.assertExtractsLikeTarsInOrder()
+
+    def test_hardlink_to_added_file_has_its_contents(self):
+        self.merger.add_file('foo', 'added')
+        self.add(('bar', 'hardlink', 'foo'))
+        self.assertEqual(self.contents()['bar'], 'added')
+
+    def test_file_is_written_through_dangling_symlink(self):
+        self.add(('etc', 'dir', None), ('etc/mtab', 'symlink', '../mtab'),
+                 ('etc/gone', 'symlink', '/missing/gone'))
+        self.add(('etc/mtab', 'file', 'mtab'), ('etc/gone', 'file', 'gone'))
+        contents = self.contents()
+        self.assertEqual(contents['etc/mtab'], '-> ../mtab')
+        self.assertEqual(contents['mtab'], 'mtab')
+        self.assertEqual(contents['etc/gone'], '-> /missing/gone')
+        self.assertFalse('missing/gone' in contents)
+
+    def test_leaves_out_what_cannot_be_extracted(self):
+        self.add(('usr', 'dir', None), ('lib', 'symlink', 'usr'),
+                 ('foo', 'file', 'foo'), ('bar', 'symlink', 'foo'),
+                 ('dangling', 'symlink', 'nowhere'),
+                 ('loop1', 'symlink', 'loop2'), ('loop2', 'symlink', 'loop1'))
+        self.add(('usr', 'file', 'not a directory'),
+                 ('lib', 'file', 'not a directory'),
+                 ('bar', 'dir', None), ('dangling', 'dir', None),
+                 ('foo/baz', 'file', 'under a file'),
+                 ('loop1/baz', 'file', 'under a loop'),
+                 ('link1', 'hardlink', 'missing'),
+                 ('link2', 'hardlink', 'usr'))
+        self.assertEqual(self.contents(), {
+            '.': tarfile.DIRTYPE,
+            'usr': tarfile.DIRTYPE,
+            'lib': '-> usr',
+            'foo': 'foo',
+            'bar': '-> foo',
+            'dangling': '-> nowhere',
+            'loop1': '-> loop2',
+            'loop2': '-> loop1',
+        })
+        self.assertEqual(self.merger.lookup('loop1'), None)
+
+    def test_extracts_added_files(self):
+        self.add(('etc', 'dir', None), ('etc/os-release', 'file', 'old'))
+        self.merger.add_file('etc/os-release', 'new', 0o600)
+        self.merger.extract(self.tempdir)
+        filename = os.path.join(self.tempdir, 'etc', 'os-release')
+        with open(filename) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertEqual(os.stat(filename).st_mode & 0o777, 0o600)
+
+    def test_adds_many_tars_in_order(self):
+        for i in xrange(10):
+            f = StringIO.StringIO()
+            tar = tarfile.open(fileobj=f, mode='w')
+            info = tarfile.TarInfo('foo')
+            info.size = 1
+            tar.addfile(info, StringIO.StringIO(str(i)))
+            tar.close()
+            self.tars.append(f.getvalue())
+        self.merger.add_tars(
+            (lambda data=data: StringIO.StringIO(data) for data in self.tars),
+            jobs=4)
+        self.assertEqual(self.contents()['foo'], '9')
+
+    def test_materialises_merged_tree_with_hardlinks(self):
+        self.add(('usr', 'dir', None), ('usr/foo', 'file', 'old'),
+                 ('foo', 'symlink', 'usr/foo'))
+        self.add(('usr', 'dir', None), ('usr/foo', 'file', 'new'))
+        source_dirs = []
+        for i, data in enumerate(self.tars):
+            dirname = os.path.join(self.tempdir, str(i))
+            os.mkdir(dirname)
+            morphlib.bins.unpack_binary_from_file(StringIO.StringIO(data),
+                                                  dirname)
+            source_dirs.append(dirname)
+        root = os.path.join(self.tempdir, 'root')
+        os.mkdir(root)
+        self.merger.materialise(root, source_dirs)
+        self.assertEqual(os.readlink(os.path.join(root, 'foo')), 'usr/foo')
+        self.assertEqual(
+            os.stat(os.path.join(root, 'usr/foo')).st_ino,
+            os.stat(os.path.join(source_dirs[1], 'usr/foo')).st_ino)
+
+    def test_materialises_directories_with_their_attributes(self):
+        self.add(('usr', 'dir', None), ('usr/bin', 'dir', None),
+                 ('usr/bin/foo', 'file', 'foo'), mode=0o750)
+        source_dir = os.path.join(self.tempdir, 'source')
+        os.mkdir(source_dir)
+        morphlib.bins.unpack_binary_from_file(
+            StringIO.StringIO(self.tars[0]), source_dir)
+        root = os.path.join(self.tempdir, 'root')
+        os.mkdir(root)
+        self.merger.materialise(root, [source_dir])
+        for path in ('usr', 'usr/bin'):
+            st = os.stat(os.path.join(root, path))
+            self.assertEqual(st.st_mode & 0o777, 0o750)
+            self.assertEqual(st.st_mtime, 0)
+
+    def test_materialises_added_files(self):
+        self.add(('etc', 'dir', None))
+        self.merger.add_file('etc/os-release', 'new')
+        source_dir = os.path.join(self.tempdir, 'source')
+        os.mkdir(source_dir)
+        root = os.path.join(self.tempdir, 'root')
+        os.mkdir(root)
+        self.merger.materialise(root, [source_dir])
+        with open(os.path.join(root, 'etc', 'os-release')) as f:
+            self.assertEqual(f.read(), 'new')
@@ -0,0 +1,279 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import contextlib
+import errno
+import fcntl
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import morphlib
+
+
+class UnpackedChunkCache(object):
+
+    '''Store of unpacked chunk artifacts, shared by all builds on a host.
+
+    Staging areas are assembled by hardlinking files out of unpacked chunk
+    artifacts, so each chunk is unpacked once and then kept here for reuse
+    by later builds, including builds run by other Morph processes at the
+    same time.
+
+    Each chunk is unpacked into ``DIR/<artifact basename>.d``. An index of
+    the unpacked chunks, with their sizes and when they were last used, is
+    kept in ``DIR/index``. Changes to the index and to the set of unpacked
+    chunks are made while holding an exclusive lock on ``DIR/lock``.
+
+    A chunk is unpacked into a temporary directory without holding the
+    lock, and then renamed into place while holding it. If another build
+    finished unpacking the same chunk first, its copy is used and ours is
+    thrown away.
+
+    While a build is using an unpacked chunk it holds a shared lock on
+    ``DIR/<artifact basename>.d.lock``. When the total size of the unpacked
+    chunks goes over ``max_size`` bytes, the least recently used chunks
+    that are not in use are removed. A ``max_size`` of zero means there is
+    no limit.
+
+    Other directories that are expensive to create and can be shared
+    between builds, such as snapshots of prepared staging areas, can be
+    kept the same way with ``get_directory``.
+
+    '''
+
+    def __init__(self, dirname, max_size=0):
+        self.dirname = dirname
+        self.max_size = max_size
+
+    def _path(self, name):
+        return os.path.join(self.dirname, name + '.d')
+
+    @contextlib.contextmanager
+    def _locked(self, path, operation):
+        with open(path, 'a') as f:
+            fcntl.flock(f.fileno(), operation)
+            try:
+                yield f
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _cache_lock(self):
+        return self._locked(os.path.join(self.dirname, 'lock'),
+                            fcntl.LOCK_EX)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.dirname, 'index')) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise  # pragma: no cover
+        except ValueError:
+            logging.warning('Unpacked chunk index is corrupt, rebuilding it')
+        return self._rebuild_index()
+
+    def _rebuild_index(self):
+        '''Index the chunks already unpacked in the cache directory.'''
+        index = {}
+        for basename in os.listdir(self.dirname):
+            path = os.path.join(self.dirname, basename)
+            if basename.endswith('.d') and os.path.isdir(path):
+                index[basename[:-len('.d')]] = {
+                    'size': self._disk_usage(path),
+                    'last-used': os.path.getmtime(path),
+                }
+        return index
+
+    def _write_index(self, index):
+        filename = os.path.join(self.dirname, 'index')
+        with morphlib.savefile.SaveFile(filename, 'w') as f:
+            json.dump(index, f)
+
+    @staticmethod
+    def _disk_usage(path):
+        total = 0
+        for dirname, subdirs, basenames in os.walk(path):
+            for basename in basenames:
+                total += os.lstat(os.path.join(dirname, basename)).st_size
+        return total
+
+    def _use(self, name):
+        '''Lock an unpacked chunk so it is not removed, and return the lock.
+
+        This must be called while holding the cache lock.
+
+        '''
+
+        f = open(self._path(name) + '.lock', 'a')
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        return f
+
+    def _remove(self, name):
+        '''Remove an unpacked chunk, unless it is in use.
+
+        This must be called while holding the cache lock.
+
+        '''
+
+        lock_filename = self._path(name) + '.lock'
+        with open(lock_filename, 'a') as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise  # pragma: no cover
+                return False
+            # Move the directory out of the way first, so that a crash
+            # while deleting it does not leave a partial chunk in place.
+            deadpath = tempfile.mkdtemp(dir=self.dirname)
+            os.rename(self._path(name), os.path.join(deadpath, 'chunk'))
+            os.remove(lock_filename)
+        shutil.rmtree(deadpath)
+        return True
+
+    def _evict(self, index, keep):
+        total = sum(entry['size'] for entry in index.itervalues())
+        if not self.max_size or total <= self.max_size:
+            return
+        by_age = sorted(index, key=lambda name: index[name]['last-used'])
+        for name in by_age:
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            if self._remove(name):
+                logging.debug('Removed unpacked chunk %s' % name)
+                total -= index.pop(name)['size']
+
+    def _publish(self, name, savedir, size):
+        '''Move a newly unpacked chunk into the cache, and lock it for use.
+
+        Return the lock for the cached chunk.
+
+        '''
+
+        with self._cache_lock():
+            index = self._read_index()
+            path = self._path(name)
+            if name in index and os.path.isdir(path):
+                # Another build unpacked this chunk while we were.
+                shutil.rmtree(savedir)
+            else:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                os.rename(savedir, path)
+                index[name] = {'size': size}
+            index[name]['last-used'] = time.time()
+            lock = self._use(name)
+            self._evict(index, keep=name)
+            self._write_index(index)
+        return lock
+
+    @contextlib.contextmanager
+    def get(self, handle, status=lambda **kwargs: None):
+        '''Use the unpacked contents of a chunk artifact.
+
+        ``handle`` is an open file handle for the chunk artifact, which is
+        unpacked if it is not already in the cache. The path to the
+        unpacked chunk is returned from the context manager, and the
+        unpacked chunk will not be removed until the context is left.
+
+        '''
+
+        name = os.path.basename(handle.name)
+
+        def unpack(savedir):
+            status(msg='Unpacking chunk from cache %(filename)s',
+                   filename=name)
+            morphlib.bins.unpack_binary_from_file(handle, savedir + '/')
+
+        with self.get_directory(name, unpack) as path:
+            yield path
+
+    @contextlib.contextmanager
+    def get_directory(self, name, populate):
+        '''Use the directory called ``name`` from the cache.
+
+        If there is no such directory yet, ``populate`` is called with the
+        path of an empty directory to fill in, which is then added to the
+        cache. The path to the cached directory is returned from the
+        context manager, and it will not be removed until the context is
+        left.
+
+        '''
+
+        lock = None
+        with self._cache_lock():
+            index = self._read_index()
+            if name in index and os.path.isdir(self._path(name)):
+                index[name]['last-used'] = time.time()
+                lock = self._use(name)
+                self._write_index(index)
+
+        if lock is None:
+            savedir = tempfile.mkdtemp(dir=self.dirname)
+            try:
+                populate(savedir)
+                size = self._disk_usage(savedir)
+            except BaseException:
+                shutil.rmtree(savedir)
+                raise
+            lock = self._publish(name, savedir, size)
+
+        try:
+            yield self._path(name)
+        finally:
+            lock.close()
+
+    def list_contents(self):
+        '''Return the index of unpacked chunks.
+
+        This is a dict mapping the basename of each unpacked artifact to a
+        dict with its ``size`` in bytes and the time it was ``last-used``.
+
+        '''
+
+        with self._cache_lock():
+            return self._read_index()
+
+    def clear(self, stale_age=60*60*24):
+        '''Remove every unpacked chunk that is not in use.
+
+        Temporary files and directories that have not been touched for
+        ``stale_age`` seconds are left over from builds that were
+        interrupted while unpacking a chunk, so they are removed as well.
+
+        '''
+
+        with self._cache_lock():
+            index = self._read_index()
+            for name in list(index):
+                if self._remove(name):
+                    del index[name]
+            self._write_index(index)
+
+            stale = time.time() - stale_age
+            for basename in os.listdir(self.dirname):
+                path = os.path.join(self.dirname, basename)
+                if (basename.startswith('tmp') and
+                        os.path.getmtime(path) < stale):
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
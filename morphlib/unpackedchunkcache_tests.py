@@ -0,0 +1,168 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import unittest
+
+import morphlib
+
+
+class UnpackedChunkCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'chunks')
+        os.mkdir(self.cachedir)
+        self.cache = morphlib.unpackedchunkcache.UnpackedChunkCache(
+            self.cachedir, max_size=150)
+        self.unpacked = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def create_chunk(self, name, size=100):
+        chunkdir = os.path.join(self.tempdir, name)
+        os.mkdir(chunkdir)
+        with open(os.path.join(chunkdir, 'file.txt'), 'w') as f:
+            f.write('x' * size)
+        chunk_tar = os.path.join(self.tempdir, name + '.chunk')
+        tf = tarfile.TarFile(name=chunk_tar, mode='w')
+        tf.add(chunkdir, arcname='.')
+        tf.close()
+        return chunk_tar
+
+    def status(self, **kwargs):
+        self.unpacked.append(kwargs['filename'])
+
+    def use(self, chunk_tar):
+        with open(chunk_tar, 'rb') as f:
+            with self.cache.get(f, status=self.status) as path:
+                return os.listdir(path)
+
+    def test_unpacks_chunk(self):
+        chunk_tar = self.create_chunk('foo')
+        self.assertEqual(self.use(chunk_tar), ['file.txt'])
+        self.assertEqual(self.unpacked, ['foo.chunk'])
+
+    def test_reuses_unpacked_chunk(self):
+        chunk_tar = self.create_chunk('foo')
+        self.use(chunk_tar)
+        self.use(chunk_tar)
+        self.assertEqual(self.unpacked, ['foo.chunk'])
+
+    def test_indexes_unpacked_chunks(self):
+        self.use(self.create_chunk('foo'))
+        contents = self.cache.list_contents()
+        self.assertEqual(contents.keys(), ['foo.chunk'])
+        self.assertEqual(contents['foo.chunk']['size'], 100)
+
+    def test_indexes_chunks_unpacked_before_index_existed(self):
+        os.makedirs(os.path.join(self.cachedir, 'foo.chunk.d'))
+        self.assertEqual(self.cache.list_contents().keys(), ['foo.chunk'])
+
+    def test_removes_least_recently_used_chunk_when_full(self):
+        foo = self.create_chunk('foo')
+        bar = self.create_chunk('bar')
+        self.use(foo)
+        self.use(bar)
+        self.assertEqual(self.cache.list_contents().keys(), ['bar.chunk'])
+        self.assertFalse(
+            os.path.exists(os.path.join(self.cachedir, 'foo.chunk.d')))
+
+    def test_does_not_remove_chunk_in_use(self):
+        foo = self.create_chunk('foo')
+        bar = self.create_chunk('bar')
+        with open(foo, 'rb') as f:
+            with self.cache.get(f) as path:
+                self.use(bar)
+                self.assertTrue(os.path.isdir(path))
+        self.assertEqual(sorted(self.cache.list_contents().keys()),
+                         ['bar.chunk', 'foo.chunk'])
+
+    def test_clear_removes_chunks_not_in_use(self):
+        foo = self.create_chunk('foo')
+        self.use(foo)
+        self.cache.clear()
+        self.assertEqual(self.cache.list_contents(), {})
+        self.assertFalse(
+            os.path.exists(os.path.join(self.cachedir, 'foo.chunk.d')))
+
+    def test_populates_missing_directory(self):
+        def populate(dirname):
+            with open(os.path.join(dirname, 'made'), 'w') as f:
+                f.write('x' * 10)
+        with self.cache.get_directory('snapshot', populate) as path:
+            self.assertEqual(os.listdir(path), ['made'])
+        self.assertEqual(self.cache.list_contents()['snapshot']['size'], 10)
+
+    def test_discards_directory_when_populating_fails(self):
+        def populate(dirname):
+            raise RuntimeError('populate failed')
+        def use():
+            with self.cache.get_directory('snapshot', populate):
+                pass
+        self.assertRaises(RuntimeError, use)
+        self.assertEqual(os.listdir(self.cachedir), ['lock'])
+
+    def test_rebuilds_corrupt_index(self):
+        self.use(self.create_chunk('foo'))
+        with open(os.path.join(self.cachedir, 'index'), 'w') as f:
+            f.write('{"foo.chunk": ')
+        self.assertEqual(self.cache.list_contents().keys(), ['foo.chunk'])
+
+    def test_uses_directory_populated_by_another_build_meanwhile(self):
+        other = morphlib.unpackedchunkcache.UnpackedChunkCache(
+            self.cachedir)
+        def populate_other(dirname):
+            with open(os.path.join(dirname, 'other'), 'w') as f:
+                f.write('other')
+        def populate(dirname):
+            with open(os.path.join(dirname, 'mine'), 'w') as f:
+                f.write('mine')
+            with other.get_directory('snapshot', populate_other):
+                pass
+        with self.cache.get_directory('snapshot', populate) as path:
+            self.assertEqual(os.listdir(path), ['other'])
+        self.assertEqual(sorted(os.listdir(self.cachedir)),
+                         ['index', 'lock', 'snapshot.d', 'snapshot.d.lock'])
+
+    def test_replaces_directory_missing_from_index(self):
+        leftover = os.path.join(self.cachedir, 'snapshot.d')
+        os.mkdir(leftover)
+        with open(os.path.join(leftover, 'partial'), 'w') as f:
+            f.write('partial')
+        with open(os.path.join(self.cachedir, 'index'), 'w') as f:
+            f.write('{}')
+        def populate(dirname):
+            with open(os.path.join(dirname, 'made'), 'w') as f:
+                f.write('made')
+        with self.cache.get_directory('snapshot', populate) as path:
+            self.assertEqual(os.listdir(path), ['made'])
+
+    def test_clear_removes_stale_temporary_files(self):
+        for basename in ('tmpdir', 'tmpnew'):
+            os.mkdir(os.path.join(self.cachedir, basename))
+        with open(os.path.join(self.cachedir, 'tmpfile'), 'w') as f:
+            f.write('partial')
+        old = time.time() - 120
+        for basename in ('tmpdir', 'tmpfile'):
+            os.utime(os.path.join(self.cachedir, basename), (old, old))
+        self.cache.clear(stale_age=60)
+        self.assertEqual(sorted(os.listdir(self.cachedir)),
+                         ['index', 'lock', 'tmpnew'])
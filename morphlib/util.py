@@ -18,7 +18,9 @@ import os
 import pipes
 import re
 import subprocess
+import sys
 import textwrap
+import threading
 
 import fs.osfs
 
@@ -132,7 +134,9 @@ def new_artifact_caches(settings):  # pragma: no cover
         os.mkdir(artifact_cachedir)
 
     lac = morphlib.localartifactcache.LocalArtifactCache(
-            fs.osfs.OSFS(artifact_cachedir))
+            fs.osfs.OSFS(artifact_cachedir),
+            settings['artifact-cache-layout'],
+            settings['deduplicate-chunk-artifacts'])
 
     rac_url = get_artifact_cache_server(settings)
     rac = None
@@ -207,9 +211,14 @@ def new_repo_caches(app):  # pragma: no cover
     cachedir = create_cachedir(app.settings)
     gits_dir = os.path.join(cachedir, 'gits')
     tarball_base_url = app.settings['tarball-server']
+    if app.settings['git-object-pool']:
+        object_pool = os.path.join(gits_dir, 'object-pool.git')
+    else:
+        object_pool = None
     repo_resolver = morphlib.repoaliasresolver.RepoAliasResolver(aliases)
     lrc = morphlib.localrepocache.LocalRepoCache(
-        app, gits_dir, repo_resolver, tarball_base_url=tarball_base_url)
+        app, gits_dir, repo_resolver, tarball_base_url=tarball_base_url,
+        object_pool=object_pool)
 
     url = get_git_resolve_cache_server(app.settings)
     if url:
@@ -494,6 +503,58 @@ def iter_trickle(iterable, limit):
         yield buf
 
 
+def map_concurrently(function, iterable, jobs):
+    '''Like map(), but call ``function`` from up to ``jobs`` threads.
+
+    The results are returned in the order of ``iterable``. If any of the
+    calls raise an exception, no more are started, and once those that
+    are running have finished, the exception raised for the earliest
+    item is raised again, so that the same error is seen whatever order
+    the calls finished in.
+
+    '''
+
+    items = list(iterable)
+    if jobs <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    results = [None] * len(items)
+    failures = []
+    lock = threading.Lock()
+    todo = iter(enumerate(items))
+
+    def worker():
+        while True:
+            with lock:
+                if failures:
+                    return
+                try:
+                    index, item = next(todo)
+                except StopIteration:
+                    return
+            try:
+                results[index] = function(item)
+            except BaseException:
+                with lock:
+                    failures.append((index, sys.exc_info()))
+
+    threads = [threading.Thread(target=worker, name='map-%d' % i)
+               for i in xrange(min(jobs, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # A timeout is needed here so that the main thread can still be
+        # interrupted with Ctrl+C while it waits.
+        while thread.is_alive():
+            thread.join(1)
+
+    if failures:
+        exc_type, exc_value, exc_tb = min(failures)[1]
+        raise exc_type, exc_value, exc_tb
+    return results
+
+
 def get_data_path(relative_path): # pragma: no cover
     '''Return path to a data file in the morphlib Python package.
 
@@ -578,9 +639,28 @@ def unshared_cmdline(args, root='/', mounts=()): # pragma: no cover
     return cmdline
 
 
+def container_readonly_paths(root, writable_paths):
+    '''List the paths below 'root' to mount read-only in a container.
+
+    Every file and directory below 'root' is covered by the returned
+    paths, apart from those in 'writable_paths' and their parents.
+    Symbolic links are left out, since they cannot be mounted over.
+    The paths are returned relative to 'root'.
+
+    '''
+
+    if not root.endswith('/'):
+        root += '/'
+    return [os.path.relpath(d, root)
+            for d in morphlib.fsutils.invert_paths(os.walk(root),
+                                                   writable_paths)
+            if not os.path.islink(d)]
+
+
 def containerised_cmdline(args, cwd='.', root='/', binds=(),
                           mount_proc=False, unshare_net=False,
-                          writable_paths=None, **kwargs): # pragma: no cover
+                          writable_paths=None, readonly_paths=None,
+                          **kwargs): # pragma: no cover
     '''
     Describe how to run 'args' inside a linux-user-chroot container.
     
@@ -604,6 +684,10 @@ def containerised_cmdline(args, cwd='.', root='/', binds=(),
     The subprocess will be run in a separate mount namespace. It can
     optionally be run in a separate network namespace too by setting
     'unshare_net'.
+
+    Finding the paths to make read-only means scanning 'root'. A caller
+    that runs many commands in the same tree can do that once with
+    container_readonly_paths() and pass the result as 'readonly_paths'.
     
     '''
 
@@ -618,9 +702,10 @@ def containerised_cmdline(args, cwd='.', root='/', binds=(),
     for src, dst in binds:
         # linux-user-chroot's mount target paths are relative to the chroot
         cmdargs.extend(('--mount-bind', src, os.path.relpath(dst, root)))
-    for d in morphlib.fsutils.invert_paths(os.walk(root), writable_paths):
-        if not os.path.islink(d):
-            cmdargs.extend(('--mount-readonly', os.path.relpath(d, root)))
+    if readonly_paths is None:
+        readonly_paths = container_readonly_paths(root, writable_paths)
+    for d in readonly_paths:
+        cmdargs.extend(('--mount-readonly', d))
     if mount_proc:
         proc_target = os.path.join(root, 'proc')
         if not os.path.exists(proc_target):
@@ -16,6 +16,7 @@
 import os
 import shutil
 import tempfile
+import time
 import unittest
 
 import morphlib
@@ -135,3 +136,63 @@ class IterTrickleTests(unittest.TestCase):
     def test_truncated_final_sequence(self):
         self.assertEqual(list(morphlib.util.iter_trickle("barquux", 3)),
                          [["b", "a", "r"], ["q", "u", "u"], ["x"]])
+
+
+class MapConcurrentlyTests(unittest.TestCase):
+
+    def test_returns_results_in_order(self):
+        def slow_square(n):
+            time.sleep(0.01 * (5 - n))
+            return n * n
+        self.assertEqual(
+            morphlib.util.map_concurrently(slow_square, range(5), 3),
+            [0, 1, 4, 9, 16])
+
+    def test_calls_function_in_turn_with_one_job(self):
+        self.assertEqual(
+            morphlib.util.map_concurrently(lambda n: n * n, range(5), 1),
+            [0, 1, 4, 9, 16])
+
+    def test_raises_error_for_earliest_item(self):
+        def fail(n):
+            time.sleep(0.01 * (5 - n))
+            if n in (1, 3):
+                raise ValueError(n)
+        with self.assertRaises(ValueError) as cm:
+            morphlib.util.map_concurrently(fail, range(5), 5)
+        self.assertEqual(cm.exception.args, (1,))
+
+    def test_stops_starting_calls_after_an_error(self):
+        called = []
+        def fail(n):
+            called.append(n)
+            raise ValueError(n)
+        self.assertRaises(ValueError, morphlib.util.map_concurrently,
+                          fail, range(100), 2)
+        self.assertTrue(len(called) < 100)
+
+
+class ContainerReadonlyPathsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        for d in ('bin', 'usr/lib', 'foo.build'):
+            os.makedirs(os.path.join(self.tempdir, d))
+        os.symlink('usr/lib', os.path.join(self.tempdir, 'lib'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_lists_paths_relative_to_root(self):
+        writable = [os.path.join(self.tempdir, 'foo.build')]
+        self.assertEqual(
+            sorted(morphlib.util.container_readonly_paths(self.tempdir,
+                                                          writable)),
+            ['bin', 'usr'])
+
+    def test_leaves_parents_of_writable_paths_writable(self):
+        writable = [os.path.join(self.tempdir, 'usr', 'lib')]
+        self.assertEqual(
+            sorted(morphlib.util.container_readonly_paths(self.tempdir,
+                                                          writable)),
+            ['bin', 'foo.build'])